@@ -10,7 +10,8 @@ An assembler for a very simple assembly language that I made up.
 import os
 import sys
 
-from constants import FROZEN, Op, Instr
+from constants import FROZEN, MEMORY_SIZE, Op, Instr
+from objfile import write_object
 
 __version__ = '0.0.0'
 
@@ -34,6 +35,15 @@ class IllegalToken(AssemblerError):
         return "Illegal token: '{}'".format(self.message)
         
         
+class Token(str):
+    """ A token, which remembers the source line it came from. """
+    
+    def __new__(cls, text, line):
+        token = super(Token, cls).__new__(cls, text)
+        token.line = line
+        return token
+        
+        
 def error(msg):
     """ Something screwed up. :( """
     sys.stderr.write("ERROR: {}\n".format(msg))
@@ -43,13 +53,13 @@ def error(msg):
     
 def tokenize(data):
     """ Returns an iterator over all the language tokens in the given assembly 
-    language data.
+    language data, as Tokens numbered by line from 1.
     
     """
     
-    for line in data.split('\n'):
+    for number, line in enumerate(data.split('\n'), 1):
         for item in line.split(';', 1)[0].strip().split():
-            yield item
+            yield Token(item, number)
             
             
 def hex_from_int(n):
@@ -57,16 +67,21 @@ def hex_from_int(n):
     return '0x{:0>2}'.format(hex(n)[2:].upper())
     
     
-def hex_from_tokens(tokens):
+def hex_from_tokens(tokens, labels=None, lines=None):
     """ Converts a stream of tokens into a human-readable whitespace-delimited 
     hex string.
     
+    If a dict is given as labels, it's filled in with the address of every 
+    label in the code. If a dict is given as lines, it's filled in with the 
+    source line of every instruction and constant that starts at an address, 
+    for tokens that come from tokenize().
+    
     """
     
     tokens = iter(tokens)
     
     # Maps label names to addresses
-    labelDict = {}
+    labelDict = {} if labels is None else labels
     
     # Maps label names to a list of their occurrences in the result list.
     unknownLabelDict = {}
@@ -147,6 +162,9 @@ def hex_from_tokens(tokens):
                 
         # Instruction
         elif token in Instr.ALL:
+            if lines is not None and hasattr(token, 'line'):
+                lines[i] = token.line
+                
             value = Instr.ALL[token]
             result.append(hex_from_int(value))
             i += 1
@@ -201,16 +219,19 @@ def hex_from_tokens(tokens):
                 
         # Assume everything else to be a constant or label reference.
         else:
+            if lines is not None and hasattr(token, 'line'):
+                lines[i] = token.line
+                
             get_constant(token)
             i += 1
             
     if unknownLabelDict:
         raise Exception('Missing labels: {}'.format(unknownLabelDict.keys()))
         
-    if len(result) > 256:
+    if len(result) > MEMORY_SIZE:
         raise AssemblerError(
-                "Program too large for memory! ({}/256 bytes)"
-                    .format(len(result))
+                "Program too large for memory! ({}/{} bytes)"
+                    .format(len(result), MEMORY_SIZE)
             )
             
     return ' '.join(result).replace('\n ', '\n').strip()
@@ -225,9 +246,13 @@ def bytes_from_hex(hexcode):
     return ''.join(chr(int(code, 16)) for code in hexcode.split())
     
     
-def pad_program(bytecode):
-    """ Returns bytecode padded with zeros to a length of 256. """
-    return bytecode + '\x00' * (256 - len(bytecode))
+def pad_program(bytecode, size=MEMORY_SIZE):
+    """ Returns bytecode padded with zeros to the given length, which is the
+    size of memory by default.
+    
+    """
+    
+    return bytecode + '\x00' * (size - len(bytecode))
     
     
 def get_filename(filePath):
@@ -254,15 +279,20 @@ def main(argv):
     print ""
     print "Translating to hex..."
     
+    labels = {}
+    lines = {}
+    
     try:
-        hexcode = hex_from_tokens(tokens)
+        hexcode = hex_from_tokens(tokens, labels, lines)
     except StopIteration:
         return error("Unexpected end of file!")
         
     print "Translating to binary..."
     bytecode = bytes_from_hex(hexcode)
     
-    print "\t* Final program size: {}/256 bytes".format(len(bytecode))
+    print "\t* Final program size: {}/{} bytes".format(
+            len(bytecode), MEMORY_SIZE
+        )
     print ""
     
     # Pad the bytecode with zeros to the maximum memory size.
@@ -276,6 +306,9 @@ def main(argv):
     
     binfilePath = os.path.join(HERE, 'memory.bin')
     
+    objfileName = '{}.obj'.format(get_filename(filePath))
+    objfilePath = os.path.join(HERE, objfileName)
+    
     print "Writing {}...".format(hexfileName)
     with open(hexfilePath, 'w') as f:
         f.write(hexcode)
@@ -284,6 +317,12 @@ def main(argv):
     with open(binfilePath, 'wb') as f:
         f.write(bytecode)
         
+    # The object file keeps the labels and lines, and leaves out the padding.
+    print "Writing {}...".format(objfileName)
+    write_object(
+            objfilePath, [(0, bytecode.rstrip('\x00'))], labels, lines
+        )
+        
     print ""
     print "Done!"
     raw_input("\nPress [ENTER] to continue...")
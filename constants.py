@@ -2,6 +2,9 @@ import sys
 
 FROZEN = getattr(sys, 'frozen', False)
 
+# Bytes of memory that the machine's 8-bit addresses can reach.
+MEMORY_SIZE = 256
+
 
 class Op:
     """ Namespace for instruction opcodes. """
@@ -277,6 +280,54 @@ class Flags:
     NEGATIVE = 0x1
     
     
+class Cycles:
+    """ Namespace for the number of clock cycles the controller spends on each 
+    kind of instruction, from FETCH_0 until it returns to FETCH_0.
+    
+    """
+    
+    NOP = 4
+    END = 4
+    
+    MOV = 8
+    LDC = 10
+    LDM = 10
+    STM = 10
+    
+    ALU = 8
+    
+    JMP = 7
+    JUMP_TAKEN = 7
+    JUMP_NOT_TAKEN = 5
+    
+    
+# Maps each conditional jump opcode to a 16-entry table, indexed by the packed
+# condition flags, of whether the jump is taken.
+BRANCH_TAKEN = {
+    Op.JEQ  :   tuple(
+                    bool(f & Flags.ZERO)
+                    for f in xrange(16)
+                ),
+    Op.JUL  :   tuple(
+                    bool(f & Flags.CARRY)
+                    for f in xrange(16)
+                ),
+    Op.JUG  :   tuple(
+                    not (f & Flags.CARRY) and not (f & Flags.ZERO)
+                    for f in xrange(16)
+                ),
+    Op.JSL  :   tuple(
+                    bool(f & Flags.NEGATIVE) != bool(f & Flags.OVERFLOW)
+                    for f in xrange(16)
+                ),
+    Op.JSG  :   tuple(
+                    not (f & Flags.ZERO) and
+                    bool(f & Flags.NEGATIVE) == bool(f & Flags.OVERFLOW)
+                    for f in xrange(16)
+                ),
+}
+
+
 class ALUOp:
     PASS_A = 0
     PASS_B = 1
@@ -0,0 +1,312 @@
+"""
+
+devices.py
+By Ryan Lam
+
+Memory-mapped devices, shared by the VM and the simulator's Memory element.
+
+Devices are registered with a DeviceMap, which decodes addresses with a table 
+that has an entry for every byte of memory, so routing a store costs a single 
+lookup no matter how many devices there are. Stores to a device's addresses 
+still update memory as usual, and the device is told about them as well, so 
+programs run exactly the same with or without devices attached.
+
+A BankedMemory gives programs more data than their 8-bit addresses can reach, 
+by switching banks of a larger store in and out of a window of memory. Large 
+images of banks are memory-mapped by open_banked_image() rather than read in.
+
+"""
+
+import sys
+import mmap
+
+from constants import MEMORY_SIZE
+
+
+# The addresses that the console is mapped to by default. helloworld.txt
+# writes its string here.
+CONSOLE_START = 0xF0
+CONSOLE_END = 0x100
+
+# The window that banks are switched into by default, and the two addresses
+# that select the bank, low byte first.
+BANK_START = 0x80
+BANK_END = 0xC0
+BANK_SELECT = 0xEE
+
+
+class DeviceMap(object):
+    """ Routes stores to the devices registered for their addresses.
+    
+    A device is any object with write(addr, value), flush(), and close() 
+    methods. table[addr] is the device mapped to addr, or None.
+    
+    Devices that change memory themselves also have an attach(machine)
+    method, which is given the VM or the simulator's Memory element. Both
+    have read_bytes(start, end) and store_bytes(addr, data) methods. write()
+    is called before the store it reports reaches memory. The VM attaches
+    its devices again whenever it loads a whole state, and calls resync() on 
+    devices that have it when undo rewrites one of their addresses.
+    
+    """
+    
+    def __init__(self, size=MEMORY_SIZE):
+        self.table = [None] * size
+        self.devices = []
+        
+    def register_device(self, device, start, end):
+        """ Maps the addresses from start up to but not including end to the 
+        given device.
+        
+        """
+        
+        if not 0 <= start < end <= len(self.table):
+            raise ValueError("Invalid device address range!")
+            
+        if any(entry is not None for entry in self.table[start:end]):
+            raise ValueError("Device address ranges can't overlap!")
+            
+        self.table[start:end] = [device] * (end - start)
+        self.devices.append(device)
+        
+    def attach(self, machine):
+        for device in self.devices:
+            if hasattr(device, 'attach'):
+                device.attach(machine)
+                
+    def write(self, addr, value):
+        device = self.table[addr]
+        
+        if device is not None:
+            device.write(addr, value)
+            
+    def resync(self, addr):
+        """ Tells the device mapped to addr, if there is one, that the byte 
+        there was changed without a store, like by undo.
+        
+        """
+        
+        device = self.table[addr]
+        
+        if device is not None and hasattr(device, 'resync'):
+            device.resync()
+            
+    def flush(self):
+        for device in self.devices:
+            device.flush()
+            
+    def close(self):
+        for device in self.devices:
+            device.close()
+            
+            
+class ConsoleDevice(object):
+    """ Writes every byte stored to it to a file, which is stdout by default.
+    
+    Bytes are collected until a newline is stored, the buffer reaches 
+    bufferSize bytes, or the device is flushed, which the VM and simulator do 
+    when the machine halts. The file can be given as a path or as an open
+    file object, like a trace sink's.
+    
+    """
+    
+    def __init__(self, file=None, bufferSize=4096):
+        if file is None:
+            file = sys.stdout
+            
+        if isinstance(file, basestring):
+            self.file = open(file, 'wb')
+            self.ownsFile = True
+        else:
+            self.file = file
+            self.ownsFile = False
+            
+        self.bufferSize = bufferSize
+        self.buffer = bytearray()
+        
+    def write(self, addr, value):
+        self.buffer.append(value)
+        
+        if value == 0x0A or len(self.buffer) >= self.bufferSize:
+            self.flush()
+            
+    def flush(self):
+        if self.buffer:
+            self.file.write(str(self.buffer))
+            self.buffer = bytearray()
+            
+        self.file.flush()
+        
+    def close(self):
+        self.flush()
+        
+        if self.ownsFile:
+            self.file.close()
+            
+            
+class BankedMemory(object):
+    """ Switches banks of a backing store into the window of memory from
+    start up to end, when a program stores to the two bytes at select.
+    
+    The backing store is a bytearray or an mmap, and holds as many banks as
+    fit in it after the first offset bytes. The bank in the window is the
+    one numbered by the select bytes, modulo the number of banks, and it's
+    live in the window: switching away saves the window to its place in the 
+    backing store, and switching to it copies it back. Only the select bytes 
+    should be mapped to this device in a DeviceMap.
+    
+    Switches go through the machine's store_bytes(), which invalidates the 
+    decoded instructions and compiled blocks that cover the window, and the 
+    store to the select bytes ends the VM's current block like any store to
+    a device, so code can run from the window too.
+    
+    Undoing a store to the select bytes switches back with resync(), and 
+    loading a whole state or snapshot re-attaches the device, which takes
+    the window to hold the bank its select bytes number without saving it.
+    The banks outside the window aren't rolled back either way, and loop 
+    detection doesn't see them.
+    
+    """
+    
+    def __init__(self, backing, start=BANK_START, end=BANK_END,
+            select=BANK_SELECT, offset=0):
+        if not 0 <= start < end <= MEMORY_SIZE:
+            raise ValueError("Invalid bank window!")
+            
+        if start - 1 <= select < end or not 0 <= select < MEMORY_SIZE - 1:
+            raise ValueError("The bank select bytes can't be in the window!")
+            
+        self.backing = backing
+        self.start = start
+        self.end = end
+        self.select = select
+        self.offset = offset
+        
+        self.bankSize = end - start
+        self.banks = (len(backing) - offset) // self.bankSize
+        
+        if self.banks <= 0:
+            raise ValueError("The backing store doesn't hold a whole bank!")
+            
+        self.machine = None
+        self.bank = None
+        
+        # Whether close() should close the backing store too.
+        self.ownsBacking = False
+        
+    def selected(self, low, high):
+        """ Gives the number of the bank selected by the given select bytes.
+        """
+        return (low | high << 8) % self.banks
+        
+    def read_bank(self, bank):
+        """ Gives a copy of a bank from the backing store. This is out of date 
+        for the bank in the window.
+        
+        """
+        
+        at = self.offset + bank * self.bankSize
+        return bytearray(self.backing[at:at + self.bankSize])
+        
+    def attach(self, machine):
+        """ Takes the window of the machine's memory to hold the bank that its 
+        select bytes number.
+        
+        """
+        
+        self.machine = machine
+        self.bank = self.selected(
+                *machine.read_bytes(self.select, self.select + 2)
+            )
+            
+    def write(self, addr, value):
+        low, high = self.machine.read_bytes(self.select, self.select + 2)
+        
+        if addr == self.select:
+            low = value
+        else:
+            high = value
+            
+        self._switch(self.selected(low, high))
+        
+    def resync(self):
+        """ Switches to the bank that the select bytes number, after they
+        were changed without a store.
+        
+        """
+        
+        self._switch(
+                self.selected(
+                    *self.machine.read_bytes(self.select, self.select + 2)
+                )
+            )
+            
+    def _switch(self, bank):
+        if bank != self.bank:
+            self._save()
+            self.machine.store_bytes(self.start, self.read_bank(bank))
+            self.bank = bank
+            
+    def flush(self):
+        """ Saves the window, so the backing store holds every bank. """
+        
+        if self.machine is not None:
+            self._save()
+            
+    def close(self):
+        self.flush()
+        
+        if self.ownsBacking:
+            self.backing.close()
+            
+    def _save(self):
+        at = self.offset + self.bank * self.bankSize
+        window = self.machine.read_bytes(self.start, self.end)
+        self.backing[at:at + self.bankSize] = str(window)
+        
+        
+def open_banked_image(filePath, writable=False, start=BANK_START,
+        end=BANK_END, select=BANK_SELECT):
+    """ Opens an image that holds the initial contents of memory followed by 
+    banks, and memory-maps it so that banks are only read when they're
+    switched in. Gives the memory, with the selected bank in its window, and
+    a BankedMemory for the rest.
+    
+    If writable is true, changes to the banks are written back to the file. 
+    Otherwise they're kept in private copy-on-write pages.
+    
+    """
+    
+    if writable:
+        mode, access = 'r+b', mmap.ACCESS_WRITE
+    else:
+        mode, access = 'rb', mmap.ACCESS_COPY
+        
+    # The mapping keeps its own handle to the file.
+    with open(filePath, mode) as f:
+        backing = mmap.mmap(f.fileno(), 0, access=access)
+        
+    try:
+        bank = BankedMemory(backing, start, end, select, offset=MEMORY_SIZE)
+    except ValueError:
+        backing.close()
+        raise
+        
+    bank.ownsBacking = True
+    
+    memory = bytearray(backing[:MEMORY_SIZE])
+    memory[start:end] = bank.read_bank(
+            bank.selected(memory[select], memory[select + 1])
+        )
+        
+    return memory, bank
+    
+    
+def console_map(file=None, size=MEMORY_SIZE):
+    """ Creates a DeviceMap with a console mapped to its default addresses. """
+    
+    devices = DeviceMap(size)
+    devices.register_device(ConsoleDevice(file), CONSOLE_START, CONSOLE_END)
+    
+    return devices
+    
\ No newline at end of file
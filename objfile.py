@@ -0,0 +1,220 @@
+"""
+
+objfile.py
+By Ryan Lam
+
+A compact binary object format for assembled programs, which keeps the labels 
+and source lines that a *.hex or *.bin file throws away.
+
+An object file is a header, a table of load segments, a symbol table of labels 
+and their addresses, and a map from addresses to source lines, followed by the 
+segments' bytes. Everything is little-endian:
+
+- The header is the magic 'SIMO', the format version, reserved flags, and the 
+  number of segments, symbols, and lines.
+- Each segment is its load address, the offset of its bytes in the file, and 
+  its length. Addresses past the end of memory are in the banks that follow
+  it, laid out as in devices.open_banked_image().
+- Each symbol is its address and the length of its name, then the name.
+- Each line is an address and the source line that the byte there came from.
+
+Segments are aligned to 16 bytes in the file, and are read straight into
+memory with readinto(), so loading costs no more than reading the bytes.
+
+"""
+
+import struct
+from collections import namedtuple
+
+from constants import MEMORY_SIZE
+
+
+MAGIC = 'SIMO'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHHIII')
+SEGMENT = struct.Struct('<III')
+SYMBOL = struct.Struct('<IB')
+LINE = struct.Struct('<II')
+
+# Segment bytes start at multiples of this many bytes into the file.
+ALIGNMENT = 16
+
+
+class InvalidObject(Exception):
+    """ A file isn't a valid object file, or doesn't fit in memory. """
+    pass
+    
+    
+class Segment(namedtuple('Segment', ('address', 'offset', 'length'))):
+    """ Where a run of bytes in an object file is loaded to. """
+    
+    __slots__ = ()
+    
+    @property
+    def end(self):
+        return self.address + self.length
+        
+        
+class ObjectFile(object):
+    """ The tables of an object file. symbols maps label names to addresses, 
+    and lines maps addresses to source line numbers. The segments' bytes stay 
+    in the file until they're loaded.
+    
+    """
+    
+    def __init__(self, filePath, version, segments, symbols, lines):
+        self.filePath = filePath
+        self.version = version
+        self.segments = segments
+        self.symbols = symbols
+        self.lines = lines
+        
+    @property
+    def size(self):
+        """ The number of bytes of memory needed to hold every segment. """
+        return max([segment.end for segment in self.segments] or [0])
+        
+    def labels(self):
+        """ Gives a dict that maps addresses to label names, like 
+        simplevm_profile.read_labels(). Where several labels share an address, 
+        the first in alphabetical order is used.
+        
+        """
+        
+        symbols = sorted(self.symbols.iteritems(), reverse=True)
+        return dict((addr, name) for name, addr in symbols)
+        
+    def load_into(self, memory):
+        """ Reads every segment into memory, which must be a bytearray. Bytes 
+        that no segment covers are left alone.
+        
+        """
+        
+        if self.size > len(memory):
+            raise InvalidObject(
+                    "Object needs {} bytes of memory, but only {} are given!"
+                        .format(self.size, len(memory))
+                )
+                
+        view = memoryview(memory)
+        
+        with open(self.filePath, 'rb') as f:
+            for segment in self.segments:
+                f.seek(segment.offset)
+                chunk = view[segment.address:segment.end]
+                
+                if f.readinto(chunk) != segment.length:
+                    raise InvalidObject("Object file is truncated!")
+                    
+                    
+def write_object(filePath, segments, symbols=None, lines=None):
+    """ Writes an object file. segments is a list of (address, data) pairs,
+    and symbols and lines are dicts like an ObjectFile's.
+    
+    """
+    
+    symbols = symbols or {}
+    lines = lines or {}
+    
+    tables = [
+        HEADER.pack(
+                MAGIC, VERSION, 0, len(segments), len(symbols), len(lines)
+            ),
+    ]
+    
+    size = HEADER.size + SEGMENT.size * len(segments)
+    
+    for name in symbols:
+        size += SYMBOL.size + len(name)
+        
+    size += LINE.size * len(lines)
+    
+    # Lay the segments out after the tables.
+    offset = align(size)
+    placed = []
+    
+    for address, data in segments:
+        tables.append(SEGMENT.pack(address, offset, len(data)))
+        placed.append((offset, data))
+        offset = align(offset + len(data))
+        
+    for name, address in sorted(symbols.iteritems()):
+        if len(name) > 0xFF:
+            raise ValueError("Label too long: {}".format(name))
+            
+        tables.append(SYMBOL.pack(address, len(name)))
+        tables.append(name)
+        
+    for address, line in sorted(lines.iteritems()):
+        tables.append(LINE.pack(address, line))
+        
+    with open(filePath, 'wb') as f:
+        f.write(''.join(tables))
+        
+        for offset, data in placed:
+            f.seek(offset)
+            f.write(str(data))
+            
+            
+def read_object(filePath):
+    """ Reads the tables of an object file, without its segments' bytes. """
+    
+    with open(filePath, 'rb') as f:
+        header = f.read(HEADER.size)
+        
+        if not header.startswith(MAGIC):
+            raise InvalidObject("Not an object file!")
+            
+        if len(header) != HEADER.size:
+            raise InvalidObject("Object file is truncated!")
+            
+        magic, version, flags, numSegments, numSymbols, numLines = (
+            HEADER.unpack(header)
+        )
+        
+        if version > VERSION:
+            raise InvalidObject(
+                    "Object file version {} is newer than {}!"
+                        .format(version, VERSION)
+                )
+                
+        try:
+            segments = [
+                Segment._make(SEGMENT.unpack(f.read(SEGMENT.size)))
+                for _ in xrange(numSegments)
+            ]
+            
+            symbols = {}
+            
+            for _ in xrange(numSymbols):
+                address, length = SYMBOL.unpack(f.read(SYMBOL.size))
+                symbols[f.read(length)] = address
+                
+            lines = dict(
+                    LINE.unpack(f.read(LINE.size)) for _ in xrange(numLines)
+                )
+                
+        except struct.error:
+            raise InvalidObject("Object file is truncated!")
+            
+    return ObjectFile(filePath, version, segments, symbols, lines)
+    
+    
+def load_object(filePath, size=MEMORY_SIZE):
+    """ Reads an object file into a new zeroed memory of the given size, and 
+    gives the memory and the ObjectFile.
+    
+    """
+    
+    obj = read_object(filePath)
+    
+    memory = bytearray(size)
+    obj.load_into(memory)
+    
+    return memory, obj
+    
+    
+def align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+    
\ No newline at end of file
@@ -11,7 +11,7 @@ simulates the hardware involved with running the assembly code.
 import sys
 import pdb
 
-from constants import ALUOp, ALUSelA, ALUSelB
+from constants import MEMORY_SIZE, ALUOp, ALUSelA, ALUSelB, State
 
 from simplesim_elements import (
     Wire, Element,
@@ -22,6 +22,9 @@ from simplesim_elements import (
 
 from simplesim_fsm import Controller
 
+from simplevm_state import MachineState
+from devices import DeviceMap, console_map, open_banked_image
+
 
 class HaltExecution(Exception):
     def __str__(self):
@@ -39,6 +42,10 @@ class Debugger(Element):
         
         self.shouldContinue = False
         
+        # When quiet, nothing is printed and there's no prompt, but halting
+        # still ends the simulation.
+        self.quiet = False
+        
         self.regFile = regFile
         self.inputState = inputState
         self.inputHalted = inputHalted
@@ -54,6 +61,12 @@ class Debugger(Element):
     def post_transition(self):
         super(Debugger, self).transition()
         
+        if self.quiet:
+            if self.inputHalted.value:
+                raise HaltExecution
+                
+            return
+            
         state = self.inputState.value
         pc = self.inputPC.value
         ir = self.inputIR.value
@@ -111,18 +124,62 @@ def error(msg):
     return 1
     
     
-def main(argv):
-    try:
-        filePath = argv[1]
-    except IndexError:
-        return error("Must provide a *.bin file!")
+class Datapath(object):
+    """ The elements of a datapath that hold the machine's state. """
+    
+    def __init__(self, pc, flags, ir, mar, mdr, regFile, mem, fsm, debugger):
+        self.pc = pc
+        self.flags = flags
+        self.ir = ir
+        self.mar = mar
+        self.mdr = mdr
+        self.regFile = regFile
+        self.mem = mem
+        self.fsm = fsm
+        self.debugger = debugger
         
-    try:
-        with open(filePath, 'rb') as f:
-            data = f.read()
-    except IOError:
-        return error("Coud not open file '{}'!".format(filePath))
+    def load_state(self, state):
+        """ Resets every element, and then seeds the datapath with the PC, 
+        flags, registers, and memory of a MachineState (see simplevm_state), 
+        with the controller at FETCH_0. Simulate with reset=False afterwards
+        to continue from the state.
+        
+        """
+        
+        Element.reset_all()
         
+        self.mem.load_bytes(str(state.memory))
+        
+        # Devices like BankedMemory have to relearn what memory holds.
+        if self.mem.devices is not None:
+            self.mem.devices.attach(self.mem)
+            
+        self.pc.state.value = state.pc
+        self.flags.state.value = state.flags
+        self.regFile.state.regs = list(state.registers)
+        self.regFile.next.regs = list(state.registers)
+        
+    def get_state(self):
+        """ Gives the PC, flags, registers, and memory as a MachineState. This 
+        is only an architectural state when the controller is at FETCH_0.
+        
+        """
+        
+        return MachineState(
+                bytearray(self.mem.state.mem),
+                bytearray(self.regFile.state.regs),
+                self.pc.state.value, self.flags.state.value,
+            )
+            
+            
+def build_datapath(data, devices=None, quiet=False):
+    """ Builds the datapath, with the given string of bytes in memory, and 
+    gives its Datapath. The elements are added to the ones that Element 
+    simulates, so only one datapath should be built per process. If quiet is 
+    true, the state isn't printed or prompted for on every cycle.
+    
+    """
+    
     controlALUSelA = Wire(bits_required(ALUSelA.NUM_ALU_A))
     controlALUSelB = Wire(bits_required(ALUSelB.NUM_ALU_B))
     controlALUOp = Wire(bits_required(ALUOp.NUM_ALU_OPS))
@@ -198,7 +255,7 @@ def main(argv):
     
     mdr = Register(8, mdrD, mdrEn, mdrQ)
     
-    mem = Memory(256, marQ, memWriteEn, mdrQ, memOut)
+    mem = Memory(MEMORY_SIZE, marQ, memWriteEn, mdrQ, memOut, devices)
     mem.load_bytes(data)
     
     debugger = Debugger(
@@ -208,20 +265,116 @@ def main(argv):
             aluA, aluB, aluOut, flagsQ,
         )
         
+    debugger.quiet = quiet
+    
+    return Datapath(pc, flags, ir, mar, mdr, regFile, mem, fsm, debugger)
+    
+    
+def simulate(datapath, devices=None, reset=True):
+    """ Simulates the datapath until the machine halts, and prints the final 
+    contents of memory. Give reset=False to continue from a state given to 
+    Datapath.load_state().
+    
+    """
+    
     try:
-        Element.simulate_datapath()
+        Element.simulate_datapath(reset)
     except HaltExecution as e:
+        if devices is not None:
+            devices.flush()
+            print ""
+            
         print e
         print ""
         
         print "Mem Dump:"
-        print ['0x{:02x}'.format(b) for b in mem.state.mem]
+        print ['0x{:02x}'.format(b) for b in datapath.mem.state.mem]
         
         return 0
     else:
         assert False
         
         
+def simulate_instructions(datapath, count, occupancy=None, maxCycles=None):
+    """ Simulates cycles until count more instructions have finished, the 
+    machine halts, or maxCycles cycles have been simulated, without resetting, 
+    and gives the number of cycles and the number of instructions finished.
+    The controller is left at FETCH_0, or at HALT after an END, whose cycles 
+    are counted like any other instruction's.
+    
+    If a dict is given as occupancy, the cycles spent in each controller
+    state are added to it.
+    
+    """
+    
+    fsm = datapath.fsm
+    
+    if maxCycles is None:
+        maxCycles = sys.maxint
+        
+    cycles = 0
+    instructions = 0
+    
+    while instructions < count and cycles < maxCycles:
+        Element.start_cycle_all()
+        
+        if occupancy is not None:
+            state = fsm.state.state
+            occupancy[state] = occupancy.get(state, 0) + 1
+            
+        cycles += 1
+        
+        Element.transition_all()
+        Element.post_transition_all()
+        
+        state = fsm.state.state
+        
+        if state == State.FETCH_0:
+            instructions += 1
+        elif state == State.HALT:
+            instructions += 1
+            break
+            
+    return cycles, instructions
+    
+    
+def main(argv):
+    try:
+        filePath = argv[1]
+    except IndexError:
+        return error("Must provide a *.bin file!")
+        
+    # With --banked, the file is memory followed by banks for a BankedMemory,
+    # and only the banks that are switched in are read.
+    banked = '--banked' in argv[2:]
+    
+    try:
+        if banked:
+            memory, bank = open_banked_image(filePath)
+            data = str(memory)
+        else:
+            with open(filePath, 'rb') as f:
+                data = f.read()
+    except IOError:
+        return error("Coud not open file '{}'!".format(filePath))
+    except ValueError as e:
+        return error(str(e))
+        
+    # With --console, bytes stored to 0xF0-0xFF are printed as they're written.
+    if '--console' in argv[2:]:
+        devices = console_map()
+    elif banked:
+        devices = DeviceMap()
+    else:
+        devices = None
+        
+    if banked:
+        devices.register_device(bank, bank.select, bank.select + 2)
+        
+    datapath = build_datapath(data, devices)
+    return simulate(datapath, devices)
+    
+    
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
     
\ No newline at end of file
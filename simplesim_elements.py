@@ -88,9 +88,10 @@ class Element(object):
             element.post_transition()
             
     @classmethod
-    def simulate_datapath(cls):
-        cls.reset_all()
-        
+    def simulate_datapath(cls, reset=True):
+        if reset:
+            cls.reset_all()
+            
         print "\n******* Simulation Started! *******"
         
         for cycle in itertools.count():
@@ -444,11 +445,15 @@ class ALU(Element):
         
         
 class Memory(Element):
-    def __init__(self, size, inputAddr, inputWriteEn, inputData, outputData):
+    def __init__(self,
+            size, inputAddr, inputWriteEn, inputData, outputData,
+            devices=None):
+            
         assert inputAddr.width == bits_required(size)
         assert inputWriteEn.width == 1
         assert inputData.width == 8
         assert outputData.width == 8
+        assert devices is None or len(devices.table) == size
         
         super(Memory, self).__init__()
         
@@ -456,6 +461,9 @@ class Memory(Element):
         
         self.size = size
         
+        # Stores are also routed to these memory-mapped devices.
+        self.devices = devices
+        
         self.inputAddr = inputAddr
         self.inputWriteEn = inputWriteEn
         self.inputData = inputData
@@ -504,7 +512,32 @@ class Memory(Element):
         
         self.outputData.reset()
         
+        if self.devices is not None:
+            self.devices.attach(self)
+            
+    def read_bytes(self, start, end):
+        """ Gives the bytes from start up to end, as they'll be after this 
+        cycle, for devices.
+        
+        """
+        
+        return bytearray(self.next.mem[start:end])
+        
+    def store_bytes(self, addr, data):
+        """ Writes bytes starting at addr by the end of this cycle, for 
+        devices.
+        
+        """
+        
+        self.next.mem[addr:addr + len(data)] = list(bytearray(data))
+        
     def transition(self):
+        if self.devices is not None and self.inputWriteEn.value:
+            addr = self.inputAddr.value
+            
+            if addr is not None:
+                self.devices.write(addr, self.inputData.value)
+                
         super(Memory, self).transition()
         self.next.mem = self.state.mem[:]
         
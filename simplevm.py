@@ -11,308 +11,1531 @@ microarchitecture involved in running the assembly language.
 """
 
 import sys
+import json
+import struct
+import hashlib
+import argparse
+from collections import namedtuple
+from cStringIO import StringIO
 
-from constants import Op
+from constants import MEMORY_SIZE, Op, Instr, Flags, BRANCH_TAKEN
+from simplevm_blocks import compile_block, instruction_cycles
+from simplevm_trace import NullSink, TeeSink, FileSink, BinarySink
+from simplevm_state import MachineState
+from simplevm_profile import Profiler, read_labels
+from simplevm_debug import Debugger, Hit
+from simplevm_undo import UndoLog, REGISTERS, NOTHING, NO_FLAGS
+from devices import DeviceMap, console_map, open_banked_image
+from objfile import InvalidObject, read_object, load_object
 
 
+# Maps each possible 8-bit result to the zero and negative flags it sets.
+ZERO_NEGATIVE = tuple(
+        Flags.ZERO if r == 0 else Flags.NEGATIVE if r & 0x80 else 0
+        for r in xrange(256)
+    )
+    
+JEQ_TAKEN = BRANCH_TAKEN[Op.JEQ]
+JUL_TAKEN = BRANCH_TAKEN[Op.JUL]
+JUG_TAKEN = BRANCH_TAKEN[Op.JUG]
+JSL_TAKEN = BRANCH_TAKEN[Op.JSL]
+JSG_TAKEN = BRANCH_TAKEN[Op.JSG]
+
+# The layout of a snapshot: the halted flag, PC, packed flags, step count,
+# cycle count, 16 registers, and memory.
+SNAPSHOT = struct.Struct('<?BBQQ16s{}s'.format(MEMORY_SIZE))
+
+class Result(
+        namedtuple(
+            'Result', ('halted', 'steps', 'pc', 'registers', 'flags', 'memory')
+        )
+    ):
+    """ The architectural state of a VM, as returned by VM.result(). """
+    
+    __slots__ = ()
+    
+    def to_dict(self):
+        """ Gives the state as a dict of JSON-friendly values, with memory as
+        a hex string.
+        
+        """
+        
+        return {
+            'halted'    :   self.halted,
+            'steps'     :   self.steps,
+            'pc'        :   self.pc,
+            'registers' :   list(self.registers),
+            'flags'     :   self.flags,
+            'memory'    :   str(self.memory).encode('hex'),
+        }
+        
+    def to_json(self):
+        return json.dumps(self.to_dict(), sort_keys=True)
+        
+    def digest(self):
+        """ Gives a hex digest of the PC, flags, registers, and memory, for 
+        comparing states without comparing them byte by byte.
+        
+        """
+        
+        state = bytearray((self.pc, self.flags))
+        state.extend(self.registers)
+        state.extend(self.memory)
+        
+        return hashlib.sha1(state).hexdigest()
+        
+        
 class InvalidFile(Exception):
     pass
     
     
-class RegFile(list):
-    def __setitem__(self, index, item):
-        super(RegFile, self).__setitem__(index, item & 0xFF)
+class InvalidInstruction(Exception):
+    """ The VM tried to execute an opcode that isn't in the ISA. """
+    
+    def __init__(self, pc, op):
+        super(InvalidInstruction, self).__init__(pc, op)
+        self.pc = pc
+        self.op = op
         
+    def __str__(self):
+        return "Invalid instruction 0x{:02x} at address 0x{:02x}!".format(
+                self.op, self.pc
+            )
+            
+            
+class InfiniteLoop(Exception):
+    """ The VM reached the same architectural state twice, so it can never 
+    halt. pc is the address where the state repeated, and period is the
+    number of instructions between the repeats.
+    
+    """
+    
+    def __init__(self, pc, period):
+        super(InfiniteLoop, self).__init__(pc, period)
+        self.pc = pc
+        self.period = period
         
-def error(msg):
-    """ Something screwed up. :( """
-    sys.stderr.write("ERROR: {}\n".format(msg))
-    raw_input("\nPress [ENTER] to continue...")
-    return 1
+    def __str__(self):
+        return "Infinite loop at address 0x{:02x} (period: {} steps)!".format(
+                self.pc, self.period
+            )
+            
+            
+class VM(object):
+    """ Executes SIMPL machine code one instruction at a time.
     
+    Instructions are dispatched through a 256-entry table of handlers indexed 
+    by opcode. Each instruction is decoded once into a record of
+    (handler, regA, regB, const, nextPC), and the record is cached by address 
+    until a store overwrites one of the instruction's bytes. Handlers take the 
+    last four fields of the record and return the address of the next 
+    instruction, or None if the instruction halted the machine.
     
-def load_memory(filePath):
-    if filePath.endswith('.hex'):
-        with open(filePath, 'r') as f:
-            data = f.read()
+    run() goes a step further and translates each block of code it reaches
+    into a Python function (see simplevm_blocks), so that a loop iteration 
+    costs a single call. Blocks follow jumps and fall through conditional 
+    jumps, so they can cover scattered bytes, but they're cached and 
+    invalidated the same way as records.
+    
+    Condition flags are evaluated lazily. Arithmetic handlers only record
+    (op, a, result) for the last instruction that set the flags, plus the last 
+    one that changed carry and overflow, and get_flags() works out the packed 
+    flags from those records when a conditional jump or a caller needs them.
+    
+    If a trace sink (see simplevm_trace) is given, it receives a record before 
+    each instruction is executed, and run() executes one instruction at a time 
+    so that none are missed. Without one, the VM produces no output at all.
+    
+    If countCycles is true, the VM also counts the clock cycles that the 
+    datapath in simplesim would have spent on each instruction, including the 
+    difference between taken and untaken conditional jumps.
+    
+    If detectLoops is true, the VM compares its whole architectural state at 
+    backward jumps against a saved copy, and raises InfiniteLoop as soon as a 
+    state repeats. The copy is replaced after 1, 2, 4, 8... checks (Brent's 
+    algorithm), so a loop is caught within about twice its length, and 
+    detection uses constant memory however long the program runs.
+    
+    If a DeviceMap (see devices) is given, every STM is also routed to the 
+    device mapped to its address, if there is one, and the devices are
+    flushed when the machine halts. The devices are attached to the VM, so
+    that ones like BankedMemory can change memory through store_bytes().
+    
+    If a Debugger (see simplevm_debug) is given, run() stops at its first 
+    breakpoint, watchpoint, or register condition hit, and sets its hit.
+    Blocks are then compiled to end before breakpoints and to check the 
+    watchpoints and conditions that are set, so a run with nothing set is as 
+    fast as one without a debugger.
+    
+    If undoSize is given, the VM keeps an UndoLog (see simplevm_undo) of the 
+    last undoSize instructions, and step_back() and run_back_until() can
+    undo them. Like a trace sink, the log makes run() execute one
+    instruction at a time. Bytes already sent to devices aren't taken back,
+    but undoing a bank switch switches back (see devices.BankedMemory).
+    
+    Registers and memory are bytearrays. get_state() and set_state() copy
+    them, along with the PC and flags, to and from a MachineState (see 
+    simplevm_state).
+    
+    Anything that writes to the VM's memory from outside must go through 
+    store() or call flush_cache() afterwards, or stale instructions may run.
+    
+    """
+    
+    # Maps opcodes to the names of their handler methods.
+    HANDLERS = {
+        Op.NOP  :   '_op_nop',
+        Op.END  :   '_op_end',
+        Op.MOV  :   '_op_mov',
+        Op.LDC  :   '_op_ldc',
+        Op.LDM  :   '_op_ldm',
+        Op.STM  :   '_op_stm',
+        Op.INC  :   '_op_inc',
+        Op.DEC  :   '_op_dec',
+        Op.NEG  :   '_op_neg',
+        Op.BCM  :   '_op_bcm',
+        Op.USR  :   '_op_usr',
+        Op.SSR  :   '_op_ssr',
+        Op.USL  :   '_op_usl',
+        Op.ADD  :   '_op_add',
+        Op.SUB  :   '_op_sub',
+        Op.AND  :   '_op_and',
+        Op.OR   :   '_op_or',
+        Op.CMP  :   '_op_cmp',
+        Op.JMP  :   '_op_jmp',
+        Op.JEQ  :   '_op_jeq',
+        Op.JUL  :   '_op_jul',
+        Op.JUG  :   '_op_jug',
+        Op.JSL  :   '_op_jsl',
+        Op.JSG  :   '_op_jsg',
+    }
+    
+    def __init__(self, memory, trace=None, countCycles=False,
+            detectLoops=False, devices=None, debugger=None, undoSize=0):
+        if len(memory) != MEMORY_SIZE:
+            raise ValueError(
+                    "VM memory must be exactly {} bytes!".format(MEMORY_SIZE)
+                )
+                
+        self.undoLog = None
+        self.set_trace(trace)
+        
+        self.countCycles = countCycles
+        self.cycles = 0
+        
+        self.detectLoops = detectLoops
+        
+        # The MachineState saved for loop detection and the step count it was
+        # saved at, and the number of checks left before it's replaced and the
+        # number of checks between replacements.
+        self._loopState = None
+        self._loopSteps = 0
+        self._loopCountdown = 1
+        self._loopInterval = 1
+        
+        self.memory = bytearray(memory)
+        self.registers = bytearray(16)
+        self.pc = 0
+        
+        # Packed flags as of the last time they were evaluated.
+        self._flags = 0
+        
+        # The (op, a, result) record of the last instruction that set the
+        # flags, and of the last one that changed carry and overflow, since
+        # the flags were evaluated.
+        self._pending = None
+        self._cvPending = None
+        
+        self.steps = 0
+        self.halted = False
+        
+        self.handlers = [None] * 256
+        
+        for op, name in self.HANDLERS.iteritems():
+            self.handlers[op] = getattr(self, name)
             
-        memory = bytearray(int(c, 16) for c in data.split())
+        self.devices = devices
         
-        while len(memory) < 256:
-            memory.append(0)
+        if devices is not None:
+            self.handlers[Op.STM] = self._op_stm_mapped
             
-        if len(memory) != 256:
-            raise InvalidFile("Invalid *.hex file!")
+        # Decoded instruction records, indexed by address.
+        self.decoded = [None] * MEMORY_SIZE
+        
+        # Compiled blocks, indexed by start address. Each one is a tuple of
+        # (function, most instructions, frozenset of addresses covered).
+        self.blocks = [None] * MEMORY_SIZE
+        
+        # Number of cached records and blocks that cover each byte of memory.
+        self._codeRefs = bytearray(MEMORY_SIZE)
+        
+        self.set_debugger(debugger)
+        
+        if undoSize:
+            self.set_undo_log(UndoLog(self, undoSize))
             
-    elif filePath.endswith('.bin'):
-        with open(filePath, 'rb') as f:
-            data = f.read()
+        if devices is not None:
+            devices.attach(self)
             
-        memory = bytearray(data)
+    def set_trace(self, trace):
+        """ Replaces the VM's trace sink, which can be None. """
+        self.trace = trace
+        self._update_sink()
         
-        if len(memory) != 256:
-            raise InvalidFile("Invalid *.bin file!")
+    def set_undo_log(self, undoLog):
+        """ Replaces the VM's undo log, which can be None. """
+        self.undoLog = undoLog
+        self._update_sink()
+        
+    def _update_sink(self):
+        """ Works out the sink that receives a record of every instruction, 
+        which combines the trace sink and the undo log.
+        
+        """
+        
+        sinks = [
+            sink for sink in (self.undoLog, self.trace)
+            if not (sink is None or isinstance(sink, NullSink))
+        ]
+        
+        if not sinks:
+            self._sink = None
+        elif len(sinks) == 1:
+            self._sink = sinks[0]
+        else:
+            self._sink = TeeSink(*sinks)
             
-    else:
-        raise InvalidFile("Must provide a *.hex or *.bin file!")
+        self._tracing = self._sink is not None
         
-    return memory
-    
-    
-def main(argv):
-    try:
-        filePath = argv[1]
-    except IndexError:
-        return error("Must provide a *.hex or *.bin file!")
+    def set_debugger(self, debugger):
+        """ Replaces the VM's debugger, which can be None. """
         
-    try:
-        memory = load_memory(filePath)
-    except InvalidFile as e:
-        return error(str(e))
+        self.debugger = debugger
+        self._debugGeneration = None
+        self.flush_cache()
         
-    registers = RegFile([0] * 15)
-    pc = 0
-    
-    class Flags:
-        zero = False
-        carry = False
-        overflow = False
-        negative = False
+    def get_flags(self):
+        """ Gives the condition flags packed the same way as the datapath's 
+        flags register.
+        
+        """
+        
+        flags = self._flags
         
-        @classmethod
-        def update(cls, op, a, result):
-            a &= 0xFF
-            result &= 0xFF
+        pending = self._pending
+        if pending is not None:
+            flags = (
+                (flags & (Flags.CARRY | Flags.OVERFLOW)) |
+                ZERO_NEGATIVE[pending[2]]
+            )
             
-            cls.zero = (result == 0)
+            self._pending = None
             
-            aSign = a & 0x80
-            rSign = result & 0x80
+        # Carry and overflow only change when an addition or subtraction
+        # changes the sign of its first operand, in which case exactly one
+        # of them is set.
+        pending = self._cvPending
+        if pending is not None:
+            op, a, result = pending
+            flags &= Flags.ZERO | Flags.NEGATIVE
             
-            if aSign != rSign:
-                if op in (Op.INC, Op.ADD):
-                    cls.carry = (result < a)
-                    cls.overflow = (result > a)
-                    
-                elif op in (Op.DEC, Op.SUB, Op.CMP):
-                    cls.carry = (result > a)
-                    cls.overflow = (result < a)
-                    
-            cls.negative = bool(rSign)
+            if (result < a) == (op in (Op.INC, Op.ADD)):
+                flags |= Flags.CARRY
+            else:
+                flags |= Flags.OVERFLOW
+                
+            self._cvPending = None
             
-    def get_regs(regs):
-        return ((regs >> 4) & 0xF, regs & 0xF)
+        self._flags = flags
+        return flags
         
-    while 1:
-        op = memory[pc]
+    def set_flags(self, flags):
+        """ Overwrites the condition flags with the given packed flags. """
+        self._flags = flags & 0xF
+        self._pending = None
+        self._cvPending = None
+        self._loopState = None
+        
+    def cpi(self):
+        """ Gives the average number of cycles per instruction so far, if 
+        cycles are being counted.
+        
+        """
         
-        print "PC: {}\tInstruction: {}\tRegisters: {}".format(
-                pc, hex(op), registers
+        if not self.steps:
+            return 0.0
+            
+        return float(self.cycles) / self.steps
+        
+    def result(self):
+        """ Gives a copy of the VM's architectural state. """
+        return Result(
+                self.halted, self.steps, self.pc,
+                list(self.registers), self.get_flags(),
+                bytearray(self.memory),
             )
             
-        if op == Op.NOP:
-            pc += 1
+    def get_state(self):
+        """ Gives a copy of the VM's architectural state as a MachineState. """
+        return MachineState(
+                self.memory, self.registers, self.pc, self.get_flags()
+            )
             
-        elif op == Op.END:
-            print "Program halted!"
-            break
+    def set_state(self, state):
+        """ Puts the VM into the state given by a MachineState. The step and 
+        cycle counts are kept, and the VM is no longer halted.
+        
+        """
+        
+        self.halted = False
+        self._load(state.pc, state.flags, state.registers, state.memory)
+        
+    def _load(self, pc, flags, registers, memory):
+        """ Overwrites the architectural state. Cached code is only dropped if 
+        memory changes.
+        
+        """
+        
+        self.pc = pc
+        self.set_flags(flags)
+        self.registers[:] = registers
+        
+        if self.memory != memory:
+            self.memory[:] = memory
+            self.flush_cache()
             
-        elif op == Op.MOV:
-            regA, regB = get_regs(memory[pc + 1])
-            registers[regA] = registers[regB]
-            pc += 2
+        # Devices like BankedMemory have to relearn what memory holds.
+        if self.devices is not None:
+            self.devices.attach(self)
             
-        elif op == Op.LDC:
-            reg, _ = get_regs(memory[pc + 1])
-            const = memory[pc + 2]
+        self._loopState = None
+        
+        # The undo records lead back to a different state.
+        if self.undoLog is not None:
+            self.undoLog.clear()
+            
+    def snapshot(self):
+        """ Gives the VM's state, step count, and cycle count as a string of 
+        SNAPSHOT.size bytes, which can be pickled or sent to another process 
+        and given to restore() or from_snapshot().
+        
+        """
+        
+        return SNAPSHOT.pack(
+                self.halted, self.pc, self.get_flags(),
+                self.steps, self.cycles,
+                str(self.registers), str(self.memory),
+            )
             
-            registers[reg] = const
+    def restore(self, snapshot):
+        """ Puts the VM back into the state saved in a snapshot. Cached code is 
+        only dropped if the snapshot's memory is different.
+        
+        """
+        
+        if len(snapshot) != SNAPSHOT.size:
+            raise ValueError("Invalid snapshot!")
             
-            pc += 3
+        halted, pc, flags, steps, cycles, registers, memory = (
+            SNAPSHOT.unpack(snapshot)
+        )
+        
+        self.halted = halted
+        self.steps = steps
+        self.cycles = cycles
+        
+        self._load(pc, flags, registers, memory)
+        
+    @classmethod
+    def from_snapshot(cls, snapshot, *args, **kwargs):
+        """ Creates a VM in the state saved in a snapshot. Any other arguments 
+        are passed on to the constructor.
+        
+        """
+        
+        vm = cls(bytearray(MEMORY_SIZE), *args, **kwargs)
+        vm.restore(snapshot)
+        return vm
+        
+    def decode(self, pc):
+        """ Decodes the instruction at the given address, caches the decoded 
+        record, and returns it.
+        
+        """
+        
+        memory = self.memory
+        op = memory[pc]
+        
+        handler = self.handlers[op]
+        
+        if handler is None:
+            raise InvalidInstruction(pc, op)
             
-        elif op == Op.LDM:
-            regA, regB = get_regs(memory[pc + 1])
-            registers[regA] = memory[registers[regB]]
-            pc += 2
+        operands = memory[(pc + 1) & 0xFF]
+        const = 0
+        
+        if op in Instr.REG_CONST:
+            const = memory[(pc + 2) & 0xFF]
+            length = 3
+        elif op in Instr.CONST:
+            const = operands
+            length = 2
+        elif op in Instr.REG or op in Instr.REG_REG:
+            length = 2
+        else:
+            length = 1
             
-        elif op == Op.STM:
-            regA, regB = get_regs(memory[pc + 1])
-            memory[registers[regB]] = registers[regA]
-            pc += 2
+        record = (
+                handler,
+                operands >> 4, operands & 0xF, const,
+                (pc + length) & 0xFF,
+            )
             
-        elif op == Op.INC:
-            reg, _ = get_regs(memory[pc + 1])
+        codeRefs = self._codeRefs
+        for i in xrange(length):
+            codeRefs[(pc + i) & 0xFF] += 1
             
-            a = registers[reg]
-            result = a + 1
-            registers[reg] = result
+        self.decoded[pc] = record
+        return record
+        
+    def compile(self, pc):
+        """ Compiles the block that starts at the given address, caches it, and 
+        returns it. Returns None if the block's first instruction is
+        invalid.
+        
+        """
+        
+        debugger = self.debugger
+        
+        # Blocks that loop internally would skip the loop checks between
+        # passes, so they're only used without loop detection.
+        if debugger is None:
+            block = compile_block(
+                    self.memory, pc, self.countCycles,
+                    self.devices is not None, not self.detectLoops,
+                )
+        else:
+            block = compile_block(
+                    self.memory, pc, self.countCycles,
+                    self.devices is not None, not self.detectLoops,
+                    debugger.breakpoints, debugger.watchMemory,
+                    debugger.watchRegisters,
+                )
+                
+        if block is None:
+            return None
             
-            Flags.update(op, a, result)
+        codeRefs = self._codeRefs
+        for addr in block[2]:
+            codeRefs[addr] += 1
             
-            pc += 2
+        self.blocks[pc] = block
+        return block
+        
+    def invalidate(self, addr):
+        """ Drops every cached record and block that covers the given address.
+        """
+        
+        decoded = self.decoded
+        codeRefs = self._codeRefs
+        
+        # No instruction is longer than 3 bytes.
+        for start in (addr, addr - 1, addr - 2):
+            start &= 0xFF
+            record = decoded[start]
             
-        elif op == Op.DEC:
-            reg, _ = get_regs(memory[pc + 1])
+            if record is None:
+                continue
+                
+            length = (record[4] - start) & 0xFF
             
-            a = registers[reg]
-            result = a - 1
-            registers[reg] = result
+            if (addr - start) & 0xFF < length:
+                decoded[start] = None
+                
+                for i in xrange(length):
+                    codeRefs[(start + i) & 0xFF] -= 1
+                    
+        # Blocks can be long, but stores into code are rare enough that it's
+        # cheaper to scan for them here than to index them by address.
+        blocks = self.blocks
+        
+        for start, block in enumerate(blocks):
+            if block is not None and addr in block[2]:
+                blocks[start] = None
+                
+                for covered in block[2]:
+                    codeRefs[covered] -= 1
+                    
+    def flush_cache(self):
+        """ Drops every cached record and block. """
+        self.decoded[:] = [None] * MEMORY_SIZE
+        self.blocks[:] = [None] * MEMORY_SIZE
+        self._codeRefs[:] = bytearray(MEMORY_SIZE)
+        
+    def store(self, addr, value):
+        """ Writes a byte to memory, invalidating any cached instruction that 
+        it overwrites.
+        
+        """
+        
+        if self.memory[addr] != value:
+            self.memory[addr] = value
+            self._loopState = None
             
-            Flags.update(op, a, result)
+            if self._codeRefs[addr]:
+                self.invalidate(addr)
+                
+    def store_bytes(self, addr, data):
+        """ Writes a string of bytes to memory starting at addr, invalidating 
+        any cached instructions that they overwrite.
+        
+        """
+        
+        end = addr + len(data)
+        memory = self.memory
+        
+        if memory[addr:end] != data:
+            memory[addr:end] = data
+            self._loopState = None
             
-            pc += 2
+            codeRefs = self._codeRefs
             
-        elif op == Op.NEG:
-            reg, _ = get_regs(memory[pc + 1])
+            for i in xrange(addr, end):
+                if codeRefs[i]:
+                    self.invalidate(i)
+                    
+    def read_bytes(self, start, end):
+        """ Gives a copy of the bytes of memory from start up to end. """
+        return bytearray(self.memory[start:end])
+        
+    def check_loop(self, pc, steps):
+        """ Checks for an infinite loop at a backward jump to the given 
+        address, after the given total number of steps, and raises
+        InfiniteLoop if the machine's state has been seen before.
+        
+        Any cycle through memory has to go backwards at least once, whether by 
+        a jump or by wrapping around from 0xFF to 0x00, so checking whenever 
+        the PC doesn't increase is enough to catch every loop.
+        
+        """
+        
+        flags = self.get_flags()
+        saved = self._loopState
+        
+        if (saved is not None and saved.pc == pc and saved.flags == flags and
+                saved.registers == self.registers and
+                saved.memory == self.memory):
+            raise InfiniteLoop(pc, steps - self._loopSteps)
             
-            a = registers[reg]
-            result = -a
-            registers[reg] = result
+        self._loopCountdown -= 1
+        
+        if not self._loopCountdown:
+            self._loopState = MachineState(
+                    self.memory, self.registers, pc, flags
+                )
+            self._loopSteps = steps
+            
+            self._loopInterval *= 2
+            self._loopCountdown = self._loopInterval
+            
+    def step(self):
+        """ Executes a single instruction. Returns False if the machine is 
+        halted, or True otherwise.
+        
+        """
+        
+        if self.halted:
+            return False
             
-            Flags.update(op, a, result)
+        if self._tracing:
+            self._sink.record(self.pc, self.memory[self.pc], self.registers)
             
-            pc += 2
+        record = self.decoded[self.pc] or self.decode(self.pc)
+        
+        if self.countCycles:
+            self._count_cycles(self.pc)
             
-        elif op == Op.BCM:
-            reg, _ = get_regs(memory[pc + 1])
+        pc = record[0](record[1], record[2], record[3], record[4])
+        self.steps += 1
+        
+        if pc is None:
+            self.halted = True
             
-            a = registers[reg]
-            result = ~a
-            registers[reg] = result
+            if self.devices is not None:
+                self.devices.flush()
+                
+            return False
             
-            Flags.update(op, a, result)
+        backward = pc <= self.pc
+        self.pc = pc
+        
+        if backward and self.detectLoops:
+            self.check_loop(pc, self.steps)
             
-            pc += 2
+        return True
+        
+    def run(self, maxSteps=None):
+        """ Executes instructions until the machine halts or maxSteps 
+        instructions have been executed, whichever comes first. Returns the 
+        number of instructions executed.
+        
+        """
+        
+        if self.halted:
+            return 0
+            
+        if self.debugger is not None:
+            return self._run_debug(maxSteps)
+            
+        if self._tracing:
+            return self._run_traced(maxSteps)
+            
+        blocks = self.blocks
+        decoded = self.decoded
+        registers = self.registers
+        memory = self.memory
+        codeRefs = self._codeRefs
+        detectLoops = self.detectLoops
+        budget = step_budget(maxSteps)
+        
+        pc = self.pc
+        steps = 0
+        
+        try:
+            while steps < budget:
+                block = blocks[pc] or self.compile(pc)
+                
+                if block is not None and steps + block[1] <= budget:
+                    start = pc
+                    pc, count = block[0](
+                            self, registers, memory, codeRefs, budget - steps
+                        )
+                    steps += count
+                    
+                    if self.halted:
+                        break
+                        
+                    if detectLoops and pc <= start:
+                        self.check_loop(pc, self.steps + steps)
+                        
+                else:
+                    # Not enough steps left for the whole block, or the
+                    # instruction here is invalid.
+                    handler, regA, regB, const, nextPC = (
+                        decoded[pc] or self.decode(pc)
+                    )
+                    
+                    if self.countCycles:
+                        self._count_cycles(pc)
+                        
+                    nextPC = handler(regA, regB, const, nextPC)
+                    steps += 1
+                    
+                    if nextPC is None:
+                        self.halted = True
+                        break
+                        
+                    backward = nextPC <= pc
+                    pc = nextPC
+                    
+                    if detectLoops and backward:
+                        self.check_loop(pc, self.steps + steps)
+                        
+        finally:
+            self.pc = pc
+            self.steps += steps
+            
+            if self.halted and self.devices is not None:
+                self.devices.flush()
+                
+        return steps
+        
+    def _count_cycles(self, pc):
+        """ Adds the cycles that the datapath would spend on the instruction at 
+        the given address to the cycle count. Must be called before the 
+        instruction is executed, since jumps depend on the flags.
+        
+        """
+        
+        op = self.memory[pc]
+        
+        if op in BRANCH_TAKEN:
+            taken = BRANCH_TAKEN[op][self.get_flags()]
+            self.cycles += instruction_cycles(op, taken)
+        else:
+            self.cycles += instruction_cycles(op)
             
-        elif op == Op.USR:
-            reg, _ = get_regs(memory[pc + 1])
+    def _run_traced(self, maxSteps):
+        """ Like run(), but records every instruction to the trace sink and
+        the undo log.
+        
+        """
+        
+        decoded = self.decoded
+        registers = self.registers
+        memory = self.memory
+        record = self._sink.record
+        budget = step_budget(maxSteps)
+        
+        pc = self.pc
+        steps = 0
+        
+        try:
+            while steps < budget:
+                record(pc, memory[pc], registers)
+                
+                handler, regA, regB, const, nextPC = (
+                    decoded[pc] or self.decode(pc)
+                )
+                
+                if self.countCycles:
+                    self._count_cycles(pc)
+                    
+                nextPC = handler(regA, regB, const, nextPC)
+                steps += 1
+                
+                if nextPC is None:
+                    self.halted = True
+                    break
+                    
+                backward = nextPC <= pc
+                pc = nextPC
+                
+                if self.detectLoops and backward:
+                    self.check_loop(pc, self.steps + steps)
+                    
+        finally:
+            self.pc = pc
+            self.steps += steps
+            self._sink.flush()
             
-            a = registers[reg]
-            result = (a >> 1) & 0x7F
-            registers[reg] = result
+            if self.halted and self.devices is not None:
+                self.devices.flush()
+                
+        return steps
+        
+    def _run_debug(self, maxSteps):
+        """ Like run(), but stops at the first hit of the debugger's 
+        breakpoints, watchpoints, and register conditions. A breakpoint at the 
+        PC that the run starts from is ignored, so that a run can resume from 
+        one.
+        
+        """
+        
+        debugger = self.debugger
+        debugger.hit = None
+        
+        # Blocks were compiled for the debugger's points as they were.
+        if self._debugGeneration != debugger.generation:
+            self.flush_cache()
+            self._debugGeneration = debugger.generation
+            
+        blocks = self.blocks
+        decoded = self.decoded
+        registers = self.registers
+        memory = self.memory
+        codeRefs = self._codeRefs
+        detectLoops = self.detectLoops
+        breakpoints = debugger.breakpoints
+        
+        tracing = self._tracing
+        record = self._sink.record if tracing else None
+        budget = step_budget(maxSteps)
+        
+        pc = self.pc
+        steps = 0
+        
+        try:
+            while steps < budget:
+                if breakpoints[pc] and steps:
+                    debugger.hit = Hit('breakpoint', pc, None)
+                    break
+                    
+                if tracing:
+                    block = None
+                else:
+                    block = blocks[pc] or self.compile(pc)
+                    
+                if block is not None and steps + block[1] <= budget:
+                    start = pc
+                    pc, count = block[0](
+                            self, registers, memory, codeRefs, budget - steps
+                        )
+                    steps += count
+                    
+                    if self.halted or debugger.hit is not None:
+                        break
+                        
+                    if detectLoops and pc <= start:
+                        self.check_loop(pc, self.steps + steps)
+                        
+                else:
+                    op = memory[pc]
+                    
+                    if tracing:
+                        record(pc, op, registers)
+                        
+                    handler, regA, regB, const, nextPC = (
+                        decoded[pc] or self.decode(pc)
+                    )
+                    
+                    addr = registers[regB]
+                    
+                    if self.countCycles:
+                        self._count_cycles(pc)
+                        
+                    nextPC = handler(regA, regB, const, nextPC)
+                    steps += 1
+                    
+                    if nextPC is None:
+                        self.halted = True
+                        break
+                        
+                    backward = nextPC <= pc
+                    pc = nextPC
+                    
+                    hit = debugger.check(op, regA, addr, registers, memory)
+                    
+                    if hit is not None:
+                        debugger.hit = hit
+                        break
+                        
+                    if detectLoops and backward:
+                        self.check_loop(pc, self.steps + steps)
+                        
+        finally:
+            self.pc = pc
+            self.steps += steps
+            
+            if tracing:
+                self._sink.flush()
+                
+            if self.halted and self.devices is not None:
+                self.devices.flush()
+                
+        return steps
+        
+    def step_back(self, count=1):
+        """ Undoes up to count instructions, or as many as the undo log has 
+        records for. Returns the number of instructions undone.
+        
+        """
+        
+        undoLog = self.undoLog
+        
+        if undoLog is None:
+            raise ValueError("The VM has no undo log!")
             
-            Flags.update(op, a, result)
+        undone = 0
+        
+        while undone < count:
+            entry = undoLog.pop()
             
-            pc += 2
+            if entry is None:
+                break
+                
+            pc, target, value, flags = entry
             
-        elif op == Op.SSR:
-            reg, _ = get_regs(memory[pc + 1])
+            if target < REGISTERS:
+                self.store(target, value)
+                
+                if self.devices is not None:
+                    self.devices.resync(target)
+                    
+            elif target != NOTHING:
+                self.registers[target - REGISTERS] = value
+                
+            # The instruction may have overwritten itself, so this has to wait
+            # until memory is restored. The flags haven't changed since a jump
+            # used them.
+            if self.countCycles:
+                op = self.memory[pc]
+                
+                if op in BRANCH_TAKEN:
+                    taken = BRANCH_TAKEN[op][self.get_flags()]
+                    self.cycles -= instruction_cycles(op, taken)
+                else:
+                    self.cycles -= instruction_cycles(op)
+                    
+            if flags != NO_FLAGS:
+                self.set_flags(flags)
+                
+            self.pc = pc
+            self.steps -= 1
+            self.halted = False
             
-            a = registers[reg]
-            result = (a >> 1) | (a & 0x80)
-            registers[reg] = result
+            undone += 1
             
-            Flags.update(op, a, result)
+        self._loopState = None
+        return undone
+        
+    def run_until(self, predicate, maxSteps=None):
+        """ Executes instructions one at a time until predicate(vm) is true, 
+        the machine halts, or maxSteps instructions have been executed.
+        Returns the number of instructions executed.
+        
+        """
+        
+        budget = step_budget(maxSteps)
+        steps = 0
+        
+        while steps < budget and not self.halted and not predicate(self):
+            self.step()
+            steps += 1
             
-            pc += 2
+        return steps
+        
+    def run_back_until(self, predicate, maxSteps=None):
+        """ Undoes instructions until predicate(vm) is true, the undo log runs 
+        out, or maxSteps instructions have been undone. Returns the number of 
+        instructions undone.
+        
+        """
+        
+        budget = step_budget(maxSteps)
+        undone = 0
+        
+        while undone < budget and not predicate(self):
+            if not self.step_back():
+                break
+                
+            undone += 1
             
-        elif op == Op.USL:
-            reg, _ = get_regs(memory[pc + 1])
+        return undone
+        
+    def run_until_halt(self):
+        """ Executes instructions until the machine halts, and gives the final 
+        architectural state.
+        
+        """
+        
+        self.run()
+        return self.result()
+        
+    def _op_nop(self, regA, regB, const, nextPC):
+        return nextPC
+        
+    def _op_end(self, regA, regB, const, nextPC):
+        return None
+        
+    def _op_mov(self, regA, regB, const, nextPC):
+        self.registers[regA] = self.registers[regB]
+        return nextPC
+        
+    def _op_ldc(self, regA, regB, const, nextPC):
+        self.registers[regA] = const
+        return nextPC
+        
+    def _op_ldm(self, regA, regB, const, nextPC):
+        registers = self.registers
+        registers[regA] = self.memory[registers[regB]]
+        return nextPC
+        
+    def _op_stm(self, regA, regB, const, nextPC):
+        registers = self.registers
+        memory = self.memory
+        
+        addr = registers[regB]
+        value = registers[regA]
+        
+        if memory[addr] != value:
+            memory[addr] = value
             
-            a = registers[reg]
-            result = a << 1
-            registers[reg] = result
+            if self._codeRefs[addr]:
+                self.invalidate(addr)
+                
+        return nextPC
+        
+    def _op_stm_mapped(self, regA, regB, const, nextPC):
+        """ Replaces _op_stm when devices are attached. """
+        
+        registers = self.registers
+        self.devices.write(registers[regB], registers[regA])
+        
+        return self._op_stm(regA, regB, const, nextPC)
+        
+    def _op_inc(self, regA, regB, const, nextPC):
+        registers = self.registers
+        
+        a = registers[regA]
+        result = (a + 1) & 0xFF
+        registers[regA] = result
+        
+        self._pending = pending = (Op.INC, a, result)
+        
+        if (a ^ result) & 0x80:
+            self._cvPending = pending
             
-            Flags.update(op, a, result)
+        return nextPC
+        
+    def _op_dec(self, regA, regB, const, nextPC):
+        registers = self.registers
+        
+        a = registers[regA]
+        result = (a - 1) & 0xFF
+        registers[regA] = result
+        
+        self._pending = pending = (Op.DEC, a, result)
+        
+        if (a ^ result) & 0x80:
+            self._cvPending = pending
             
-            pc += 2
+        return nextPC
+        
+    def _op_neg(self, regA, regB, const, nextPC):
+        registers = self.registers
+        
+        a = registers[regA]
+        result = -a & 0xFF
+        registers[regA] = result
+        
+        self._pending = (Op.NEG, a, result)
+        
+        return nextPC
+        
+    def _op_bcm(self, regA, regB, const, nextPC):
+        registers = self.registers
+        
+        a = registers[regA]
+        result = ~a & 0xFF
+        registers[regA] = result
+        
+        self._pending = (Op.BCM, a, result)
+        
+        return nextPC
+        
+    def _op_usr(self, regA, regB, const, nextPC):
+        registers = self.registers
+        
+        a = registers[regA]
+        result = (a >> 1) & 0x7F
+        registers[regA] = result
+        
+        self._pending = (Op.USR, a, result)
+        
+        return nextPC
+        
+    def _op_ssr(self, regA, regB, const, nextPC):
+        registers = self.registers
+        
+        a = registers[regA]
+        result = (a >> 1) | (a & 0x80)
+        registers[regA] = result
+        
+        self._pending = (Op.SSR, a, result)
+        
+        return nextPC
+        
+    def _op_usl(self, regA, regB, const, nextPC):
+        registers = self.registers
+        
+        a = registers[regA]
+        result = (a << 1) & 0xFF
+        registers[regA] = result
+        
+        self._pending = (Op.USL, a, result)
+        
+        return nextPC
+        
+    def _op_add(self, regA, regB, const, nextPC):
+        registers = self.registers
+        
+        a = registers[regA]
+        result = (a + registers[regB]) & 0xFF
+        registers[regA] = result
+        
+        self._pending = pending = (Op.ADD, a, result)
+        
+        if (a ^ result) & 0x80:
+            self._cvPending = pending
             
-        elif op == Op.ADD:
-            regA, regB = get_regs(memory[pc + 1])
+        return nextPC
+        
+    def _op_sub(self, regA, regB, const, nextPC):
+        registers = self.registers
+        
+        a = registers[regA]
+        result = (a - registers[regB]) & 0xFF
+        registers[regA] = result
+        
+        self._pending = pending = (Op.SUB, a, result)
+        
+        if (a ^ result) & 0x80:
+            self._cvPending = pending
             
-            a = registers[regA]
-            result = a + registers[regB]
-            registers[regA] = result
+        return nextPC
+        
+    def _op_and(self, regA, regB, const, nextPC):
+        registers = self.registers
+        
+        a = registers[regA]
+        result = a & registers[regB]
+        registers[regA] = result
+        
+        self._pending = (Op.AND, a, result)
+        
+        return nextPC
+        
+    def _op_or(self, regA, regB, const, nextPC):
+        registers = self.registers
+        
+        a = registers[regA]
+        result = a | registers[regB]
+        registers[regA] = result
+        
+        self._pending = (Op.OR, a, result)
+        
+        return nextPC
+        
+    def _op_cmp(self, regA, regB, const, nextPC):
+        registers = self.registers
+        
+        a = registers[regA]
+        result = (a - registers[regB]) & 0xFF
+        
+        self._pending = pending = (Op.CMP, a, result)
+        
+        if (a ^ result) & 0x80:
+            self._cvPending = pending
             
-            Flags.update(op, a, result)
+        return nextPC
+        
+    def _op_jmp(self, regA, regB, const, nextPC):
+        return const
+        
+    def _op_jeq(self, regA, regB, const, nextPC):
+        if JEQ_TAKEN[self.get_flags()]:
+            return const
+        else:
+            return nextPC
             
-            pc += 2
+    def _op_jul(self, regA, regB, const, nextPC):
+        if JUL_TAKEN[self.get_flags()]:
+            return const
+        else:
+            return nextPC
             
-        elif op == Op.SUB:
-            regA, regB = get_regs(memory[pc + 1])
+    def _op_jug(self, regA, regB, const, nextPC):
+        if JUG_TAKEN[self.get_flags()]:
+            return const
+        else:
+            return nextPC
             
-            a = registers[regA]
-            result = a - registers[regB]
-            registers[regA] = result
+    def _op_jsl(self, regA, regB, const, nextPC):
+        if JSL_TAKEN[self.get_flags()]:
+            return const
+        else:
+            return nextPC
             
-            Flags.update(op, a, result)
+    def _op_jsg(self, regA, regB, const, nextPC):
+        if JSG_TAKEN[self.get_flags()]:
+            return const
+        else:
+            return nextPC
             
-            pc += 2
             
-        elif op == Op.AND:
-            regA, regB = get_regs(memory[pc + 1])
+def step_budget(maxSteps):
+    """ Gives the most instructions that a run limited to maxSteps may
+    execute: no limit for None, and none at all for a limit that isn't 
+    positive.
+    
+    """
+    
+    if maxSteps is None:
+        return sys.maxint
+        
+    return max(maxSteps, 0)
+    
+    
+def error(msg, pause=True):
+    """ Something screwed up. :( """
+    sys.stderr.write("ERROR: {}\n".format(msg))
+    
+    if pause:
+        raw_input("\nPress [ENTER] to continue...")
+        
+    return 1
+    
+    
+def load_memory(filePath):
+    if filePath.endswith('.hex'):
+        with open(filePath, 'r') as f:
+            data = f.read()
             
-            a = registers[regA]
-            result = a & registers[regB]
-            registers[regA] = result
+        memory = bytearray(int(c, 16) for c in data.split())
+        
+        if len(memory) < MEMORY_SIZE:
+            memory.extend(bytearray(MEMORY_SIZE - len(memory)))
+            
+        if len(memory) != MEMORY_SIZE:
+            raise InvalidFile("Invalid *.hex file!")
+            
+    elif filePath.endswith('.bin'):
+        with open(filePath, 'rb') as f:
+            data = f.read(MEMORY_SIZE + 1)
+            
+        memory = bytearray(data)
+        
+        if len(memory) != MEMORY_SIZE:
+            raise InvalidFile("Invalid *.bin file!")
+            
+    elif filePath.endswith('.obj'):
+        try:
+            memory, obj = load_object(filePath)
+        except InvalidObject as e:
+            raise InvalidFile(str(e))
             
-            Flags.update(op, a, result)
+    else:
+        raise InvalidFile("Must provide a *.hex, *.bin, or *.obj file!")
+        
+    return memory
+    
+    
+def parse_address(text):
+    """ Parses a byte, like an address, given in hex with or without 0x. """
+    
+    try:
+        value = int(text, 16)
+    except ValueError:
+        value = None
+        
+    if value is None or not 0 <= value <= 0xFF:
+        raise argparse.ArgumentTypeError("invalid address: {}".format(text))
+        
+    return value
+    
+    
+def parse_condition(text):
+    """ Parses a register condition like r3=0x10 into (3, 0x10). """
+    
+    reg, _, value = text.partition('=')
+    
+    try:
+        reg = int(reg.lower().lstrip('r'))
+    except ValueError:
+        reg = None
+        
+    if reg is None or not 0 <= reg < 16:
+        raise argparse.ArgumentTypeError("invalid register: {}".format(text))
+        
+    return reg, parse_address(value)
+    
+    
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+            prog=argv[0],
+            description="Runs a *.hex, *.bin, or *.obj file in the SIMPL VM.",
+        )
+        
+    parser.add_argument('file', help="the *.hex, *.bin, or *.obj file to run")
+    parser.add_argument(
+            '-q', '--quiet', action='store_true',
+            help=(
+                "don't trace each instruction or prompt for addresses; "
+                "print the final state as JSON instead"
+            ),
+        )
+    parser.add_argument(
+            '--max-steps', type=int, default=None,
+            help="stop after this many instructions",
+        )
+    parser.add_argument(
+            '--cycles', action='store_true',
+            help="count the cycles the datapath would take, and report CPI",
+        )
+    parser.add_argument(
+            '--detect-loops', action='store_true',
+            help="stop with an error if the program can never halt",
+        )
+    parser.add_argument(
+            '--profile', action='store_true',
+            help="count what each instruction does, and report the hot spots",
+        )
+    parser.add_argument(
+            '--labels', metavar='SOURCE', default=None,
+            help=(
+                "annotate the profile with the labels in this assembly or "
+                "object file, which are read from the *.obj file being run "
+                "by default"
+            ),
+        )
+    parser.add_argument(
+            '--console', action='store_true',
+            help=(
+                "print bytes stored to 0xF0-0xFF as they're written, or "
+                "include them in the JSON with --quiet"
+            ),
+        )
+    parser.add_argument(
+            '--banked', action='store_true',
+            help=(
+                "treat the *.bin file as memory followed by banks that "
+                "programs switch in by storing to 0xEE-0xEF"
+            ),
+        )
+    parser.add_argument(
+            '--trace', metavar='PATH', default=None,
+            help="write the instruction trace to this file",
+        )
+    parser.add_argument(
+            '--binary-trace', action='store_true',
+            help="write the trace file in the compact binary format",
+        )
+    parser.add_argument(
+            '--break', metavar='ADDR', dest='breakpoints', action='append',
+            type=parse_address, default=[],
+            help="stop before the instruction at this address runs",
+        )
+    parser.add_argument(
+            '--watch', metavar='ADDR', dest='watches', action='append',
+            type=parse_address, default=[],
+            help="stop after STM writes to this address",
+        )
+    parser.add_argument(
+            '--read-watch', metavar='ADDR', dest='read_watches',
+            action='append', type=parse_address, default=[],
+            help="stop after LDM reads from this address",
+        )
+    parser.add_argument(
+            '--when', metavar='rN=VALUE', dest='conditions', action='append',
+            type=parse_condition, default=[],
+            help="stop after an instruction sets a register to this value",
+        )
+        
+    return parser.parse_args(argv[1:])
+    
+    
+def main(argv):
+    if len(argv) < 2:
+        return error("Must provide a *.hex, *.bin, or *.obj file!")
+        
+    args = parse_args(argv)
+    pause = not args.quiet
+    
+    try:
+        if args.banked:
+            memory, bank = open_banked_image(args.file)
+        else:
+            memory = load_memory(args.file)
+            bank = None
             
-            pc += 2
+    except (InvalidFile, IOError, ValueError) as e:
+        return error(str(e), pause)
+        
+    if args.trace is not None:
+        if args.binary_trace:
+            trace = BinarySink(args.trace)
+        else:
+            trace = FileSink(args.trace)
             
-        elif op == Op.OR:
-            regA, regB = get_regs(memory[pc + 1])
+    elif args.quiet:
+        trace = None
+        
+    else:
+        trace = FileSink(sys.stdout)
+        
+    # In quiet mode, console output goes into the JSON instead of stdout.
+    if not args.console:
+        console = devices = None
+    elif args.quiet:
+        console = StringIO()
+        devices = console_map(console)
+    else:
+        console = sys.stdout
+        devices = console_map(console)
+        
+    if bank is not None:
+        if devices is None:
+            devices = DeviceMap()
             
-            a = registers[regA]
-            result = a | registers[regB]
-            registers[regA] = result
+        devices.register_device(bank, bank.select, bank.select + 2)
+        
+    if args.breakpoints or args.watches or args.read_watches or (
+            args.conditions):
+        debugger = Debugger()
+        
+        for addr in args.breakpoints:
+            debugger.add_breakpoint(addr)
             
-            Flags.update(op, a, result)
+        for addr in args.watches:
+            debugger.add_watchpoint(addr)
             
-            pc += 2
+        for addr in args.read_watches:
+            debugger.add_watchpoint(addr, read=True, write=False)
             
-        elif op == Op.CMP:
-            regA, regB = get_regs(memory[pc + 1])
+        for reg, value in args.conditions:
+            debugger.add_condition(reg, value)
             
-            a = registers[regA]
-            result = a - registers[regB]
+    else:
+        debugger = None
+        
+    vm = VM(memory, trace, args.cycles, args.detect_loops, devices, debugger)
+    
+    if not args.profile:
+        profiler = None
+    elif trace is None:
+        profiler = Profiler(vm.memory)
+        vm.set_trace(profiler)
+    else:
+        profiler = Profiler(vm.memory)
+        vm.set_trace(TeeSink(trace, profiler))
+        
+    try:
+        vm.run(args.max_steps)
+    except (InvalidInstruction, InfiniteLoop) as e:
+        return error(str(e), pause)
+    finally:
+        if trace is not None:
+            trace.close()
+            
+    if args.quiet:
+        result = vm.result().to_dict()
+        
+        if args.cycles:
+            result['cycles'] = vm.cycles
+            result['cpi'] = vm.cpi()
             
-            Flags.update(op, a, result)
+        if console is not None:
+            devices.flush()
+            result['output'] = console.getvalue()
             
-            pc += 2
+        if profiler is not None:
+            result['profile'] = profiler.to_dict()
             
-        elif op == Op.JMP:
-            pc = memory[pc + 1]
+        if debugger is not None and debugger.hit is not None:
+            result['hit'] = dict(debugger.hit._asdict())
             
-        elif op == Op.JEQ:
-            if Flags.zero:
-                pc = memory[pc + 1]
-            else:
-                pc += 2
-                
-        elif op == Op.JUL:
-            if Flags.carry:
-                pc = memory[pc + 1]
-            else:
-                pc += 2
-                
-        elif op == Op.JUG:
-            if not Flags.carry and not Flags.zero:
-                pc = memory[pc + 1]
-            else:
-                pc += 2
-                
-        elif op == Op.JSL:
-            if Flags.negative != Flags.overflow:
-                pc = memory[pc + 1]
-            else:
-                pc += 2
-                
-        elif op == Op.JSG:
-            if not Flags.zero and Flags.negative == Flags.overflow:
-                pc = memory[pc + 1]
-            else:
-                pc += 2
-                
+        print json.dumps(result, sort_keys=True)
+        return 0
+        
+    if console is not None:
+        devices.flush()
+        print ""
+        
+    if vm.halted:
+        print "Program halted!"
+    elif debugger is not None and debugger.hit is not None:
+        print "{}!".format(debugger.hit)
+    else:
+        print "Step limit reached!"
+        
+    if args.cycles:
+        print "Cycles: {} (CPI: {:.3f})".format(vm.cycles, vm.cpi())
+        
+    if profiler is not None:
+        if args.labels:
+            labels = read_labels(args.labels)
+        elif args.file.endswith('.obj'):
+            labels = read_object(args.file).labels()
         else:
-            raise Exception("Invalid instruction!")
+            labels = None
             
-        pc %= 256
+        print profiler.report(labels)
         
     print "Done!"
     
     print "Memory dump:"
-    print [hex(b) for b in memory]
+    print [hex(b) for b in vm.memory]
     
     while 1:
         addrIn = raw_input("Examine address: ")
@@ -327,7 +1550,7 @@ def main(argv):
             continue
             
         try:
-            contents = memory[addr]
+            contents = vm.memory[addr]
         except IndexError:
             sys.stderr.write("Invalid address.\n")
             continue
@@ -0,0 +1,746 @@
+"""
+
+simplevm_aot.py
+By Ryan Lam
+
+Translates a whole SIMPL image ahead of time into a standalone Python module, 
+for frozen images whose code never changes, so that running the program
+costs no decoding or per-instruction dispatch at all.
+
+SIMPL has no computed jumps, so every instruction the program can reach is 
+found by following its jumps from address 0. The reachable code is split into 
+regions at the assembler's labels, and each region becomes one function, with 
+the registers and flags it uses held in local variables. Inside a function, 
+blocks that run on through jumps, as in simplevm_blocks, are picked by a 
+dispatch loop over their start addresses, and a block that jumps back to its 
+own start loops in place without going through the dispatch. Jumps to other 
+regions return to a top-level loop that calls the next region's function.
+
+The generated module only uses the standard library. It has a Machine with 
+regs, mem, pc, flags, steps, and (if cycles were counted) cycles, and 
+run(machine=None, limit=None), which runs until the program halts or has run
+at least limit instructions, checked between blocks. Run as a script, it
+prints the final state as JSON, like simplevm -q.
+
+Stores aren't routed to devices. A store that would change one of the 
+translated instructions raises SelfModifyingCode, since the translation would 
+no longer match the image, and reaching an invalid instruction raises 
+InvalidInstruction, as in the VM.
+
+"""
+
+import re
+import sys
+import argparse
+
+from constants import MEMORY_SIZE, Op, Instr, Flags, BRANCH_TAKEN
+from simplevm import InvalidFile, load_memory, error
+from simplevm_blocks import (
+    MAX_BLOCK_LENGTH, TERMINATORS, CONDITIONS, RESULTS, ADD_LIKE, SUB_LIKE,
+    instruction_length, instruction_cycles,
+)
+from simplevm_profile import read_labels
+from objfile import read_object
+
+
+# Hex digits per line of the image and code tables in generated modules.
+HEX_LINE_LENGTH = 64
+
+INDENT = '    '
+
+# The line that folds the zero and negative flags of the result in r into the
+# flags local.
+FOLD_FLAGS = 'flags = flags & CARRY_OVERFLOW | ZERO_NEGATIVE[r]'
+
+
+class Instruction(object):
+    """ A decoded instruction in the image: its address, opcode, registers, 
+    constant, and length (None if it's invalid).
+    
+    """
+    
+    def __init__(self, memory, addr):
+        self.addr = addr
+        self.op = memory[addr]
+        self.length = instruction_length(self.op)
+        
+        operands = memory[(addr + 1) & 0xFF]
+        
+        self.regA = operands >> 4
+        self.regB = operands & 0xF
+        
+        if self.op in Instr.REG_CONST:
+            self.const = memory[(addr + 2) & 0xFF]
+        else:
+            self.const = operands
+            
+    @property
+    def nextPC(self):
+        return (self.addr + self.length) & 0xFF
+        
+    def successors(self):
+        """ Gives the addresses that can run after this instruction. """
+        
+        op = self.op
+        
+        if self.length is None or op == Op.END:
+            return ()
+        elif op == Op.JMP:
+            return (self.const,)
+        elif op in CONDITIONS:
+            return (self.const, self.nextPC)
+        else:
+            return (self.nextPC,)
+            
+    def registers(self):
+        """ Gives the registers the instruction reads or writes. """
+        
+        op = self.op
+        
+        if op in Instr.REG or op in Instr.REG_CONST:
+            return (self.regA,)
+        elif op in Instr.REG_REG:
+            return (self.regA, self.regB)
+        else:
+            return ()
+            
+            
+class Block(object):
+    """ A run of instructions that are translated together. Like the VM's 
+    blocks (see simplevm_blocks.find_block()), a block carries on through
+    jumps to their targets, and past conditional jumps into the code they fall 
+    through to. It ends at END, at an invalid instruction, at the most 
+    instructions allowed, or just before it would leave its region or reach an 
+    address it already contains.
+    
+    """
+    
+    def __init__(self, instructions):
+        self.instructions = instructions
+        self.start = instructions[0].addr
+        
+    def exits(self):
+        """ Gives the addresses that the block can leave for. """
+        
+        for instruction in self.instructions[:-1]:
+            if instruction.op in CONDITIONS:
+                yield instruction.const
+                
+        for addr in self.instructions[-1].successors():
+            yield addr
+            
+    @property
+    def loops(self):
+        """ Whether the block can jump back to its own start. """
+        return self.start in self.exits()
+        
+        
+class Region(object):
+    """ The blocks between one label and the next, translated into a single 
+    function.
+    
+    """
+    
+    def __init__(self, name):
+        self.name = name
+        self.blocks = []
+        
+        
+def find_regions(memory, labels=None, entry=0):
+    """ Finds every block reachable from the entry point, split into regions
+    at the given labels (a dict that maps addresses to names). Gives the list 
+    of Regions in address order, each with its blocks in address order.
+    
+    """
+    
+    labels = labels or {}
+    starts = sorted(labels)
+    
+    decoded = {}
+    
+    def decode(addr):
+        if addr not in decoded:
+            decoded[addr] = Instruction(memory, addr)
+            
+        return decoded[addr]
+        
+    def region_of(addr):
+        """ Gives the address of the nearest label at or before addr. """
+        
+        owner = None
+        
+        for start in starts:
+            if start > addr:
+                break
+                
+            owner = start
+            
+        return owner
+        
+    regions = {}
+    names = set()
+    
+    found = set()
+    pending = [entry]
+    
+    while pending:
+        addr = pending.pop()
+        
+        if addr in found:
+            continue
+            
+        found.add(addr)
+        owner = region_of(addr)
+        
+        if owner not in regions:
+            name = region_name(labels.get(owner), owner, names)
+            regions[owner] = Region(name)
+            
+        instructions = []
+        contained = set()
+        instruction = decode(addr)
+        
+        while True:
+            instructions.append(instruction)
+            contained.add(instruction.addr)
+            
+            if instruction.length is None or instruction.op == Op.END:
+                break
+                
+            if instruction.op == Op.JMP:
+                following = instruction.const
+            else:
+                following = instruction.nextPC
+                
+            if (following in contained or
+                    region_of(following) != owner or
+                    len(instructions) == MAX_BLOCK_LENGTH):
+                break
+                
+            instruction = decode(following)
+            
+        block = Block(instructions)
+        
+        regions[owner].blocks.append(block)
+        pending.extend(block.exits())
+        
+    for region in regions.itervalues():
+        region.blocks.sort(key=lambda block: block.start)
+        
+    return [regions[owner] for owner in sorted(regions)]
+    
+    
+def region_name(label, addr, names):
+    """ Gives a unique function name for the region at a label. """
+    
+    if label is None:
+        name = 'region_start'
+    else:
+        name = 'region_' + re.sub(r'\W', '_', label)
+        
+    if name in names:
+        name = '{}_{:02x}'.format(name, addr or 0)
+        
+    names.add(name)
+    return name
+    
+    
+class BlockWriter(object):
+    """ Generates the Python source for one block, which is run with
+    pc set to its start, and either carries on to another block by setting
+    pc and continuing the dispatch loop, or returns.
+    
+    Flags are evaluated lazily, as in the VM. The local r holds the result of 
+    the last instruction to set the zero and negative flags, and they're only 
+    folded into the flags local before a conditional jump or when the block 
+    exits. Carry and overflow are rare, so they're set as soon as they change.
+    
+    """
+    
+    def __init__(self, block, countCycles):
+        self.block = block
+        self.countCycles = countCycles
+        
+        self.lines = []
+        self.pendingFlags = False
+        
+        # Instructions and cycles run so far, excluding any conditional jump
+        # being written.
+        self.count = 0
+        self.spent = 0
+        
+    def emit(self, line, depth=0):
+        self.lines.append(INDENT * depth + line)
+        
+    def account(self, count, cycles, depth):
+        """ Lines that make the locals up to date before leaving the block. """
+        
+        if self.pendingFlags:
+            self.emit(FOLD_FLAGS, depth)
+            
+        self.emit('steps += {}'.format(count), depth)
+        
+        if self.countCycles:
+            self.emit('cycles += {}'.format(cycles), depth)
+            
+    def jump(self, target, count, cycles, depth):
+        """ Lines that leave the block for the one at target. A block that 
+        jumps back to its start goes around its own loop while the step
+        limit allows.
+        
+        """
+        
+        self.account(count, cycles, depth)
+        
+        if self.block.loops:
+            if target == self.block.start:
+                self.emit('if steps < limit:', depth)
+                self.emit('continue', depth + 1)
+                
+            self.emit('pc = {}'.format(target), depth)
+            self.emit('break', depth)
+        else:
+            self.emit('pc = {}'.format(target), depth)
+            self.emit('continue', depth)
+            
+    def write(self):
+        """ Gives the block's lines, indented to run inside the dispatch. """
+        
+        block = self.block
+        depth = 0
+        
+        if block.loops:
+            self.emit('while 1:')
+            depth = 1
+            
+        for instruction in block.instructions:
+            self.write_instruction(instruction, depth)
+            
+        last = block.instructions[-1]
+        
+        if last.length is not None and last.op not in TERMINATORS:
+            self.jump(last.nextPC, self.count, self.spent, depth)
+            
+        return self.lines
+        
+    def write_instruction(self, instruction, depth):
+        isLast = instruction is self.block.instructions[-1]
+        op = instruction.op
+        addr = instruction.addr
+        
+        regA = 'r{}'.format(instruction.regA)
+        regB = 'r{}'.format(instruction.regB)
+        
+        if instruction.length is None:
+            self.account(self.count, self.spent, depth)
+            self.emit('pc = {}'.format(addr), depth)
+            self.emit(
+                    'raise InvalidInstruction({}, {})'.format(addr, op), depth
+                )
+            return
+            
+        self.count += 1
+        
+        if op not in CONDITIONS:
+            self.spent += instruction_cycles(op)
+            
+        if op == Op.NOP:
+            pass
+            
+        elif op == Op.END:
+            self.account(self.count, self.spent, depth)
+            self.emit('pc = {}'.format(addr), depth)
+            self.emit('m.halted = True', depth)
+            self.emit('return pc', depth)
+            
+        elif op == Op.MOV:
+            self.emit('{} = {}'.format(regA, regB), depth)
+            
+        elif op == Op.LDC:
+            self.emit('{} = {}'.format(regA, instruction.const), depth)
+            
+        elif op == Op.LDM:
+            self.emit('{} = mem[{}]'.format(regA, regB), depth)
+            
+        elif op == Op.STM:
+            self.emit(
+                    'if CODE[{1}] and mem[{1}] != {0}:'.format(regA, regB),
+                    depth
+                )
+            # The store hasn't run, so it isn't counted.
+            self.account(
+                    self.count - 1, self.spent - instruction_cycles(op),
+                    depth + 1
+                )
+            self.emit('pc = {}'.format(addr), depth + 1)
+            self.emit(
+                    'raise SelfModifyingCode({}, {})'.format(addr, regB),
+                    depth + 1
+                )
+            self.emit('mem[{}] = {}'.format(regB, regA), depth)
+            
+        elif op in RESULTS:
+            # The first operand is only copied if it's needed for carry and
+            # overflow after it's overwritten.
+            first = regA
+            
+            if op in ADD_LIKE or op in SUB_LIKE:
+                if op != Op.CMP:
+                    first = 'a'
+                    self.emit('a = {}'.format(regA), depth)
+                    
+            result = re.sub(r'\bb\b', regB, RESULTS[op])
+            result = re.sub(r'\ba\b', first, result)
+            
+            if op == Op.CMP:
+                self.emit('r = {}'.format(result), depth)
+            else:
+                self.emit('r = {} = {}'.format(regA, result), depth)
+                
+            # Carry and overflow only change when the sign of the first
+            # operand does, and then exactly one of them is set.
+            if op in ADD_LIKE:
+                change = 'CARRY if r < {} else OVERFLOW'
+            elif op in SUB_LIKE:
+                change = 'OVERFLOW if r < {} else CARRY'
+            else:
+                change = None
+                
+            if change is not None:
+                self.emit('if ({} ^ r) & 0x80:'.format(first), depth)
+                self.emit(
+                        'flags = flags & ZERO_NEGATIVE_MASK | ({})'
+                            .format(change.format(first)),
+                        depth + 1
+                    )
+                    
+            self.pendingFlags = True
+            
+        elif op == Op.JMP:
+            # Unless this is the end of the block, the block carries on at the
+            # target.
+            if isLast:
+                self.jump(instruction.const, self.count, self.spent, depth)
+                
+        elif op in CONDITIONS:
+            if self.pendingFlags:
+                self.emit(FOLD_FLAGS, depth)
+                self.pendingFlags = False
+                
+            self.emit('if {}[flags]:'.format(CONDITIONS[op]), depth)
+            self.jump(
+                    instruction.const, self.count,
+                    self.spent + instruction_cycles(op, True), depth + 1
+                )
+                
+            self.spent += instruction_cycles(op, False)
+            
+            if isLast:
+                self.jump(instruction.nextPC, self.count, self.spent, depth)
+                
+        else:
+            assert False
+            
+            
+def write_dispatch(blocks, countCycles, depth):
+    """ Gives the lines that run the block that starts at pc, as a tree of 
+    comparisons, or break out of the dispatch loop if none of the blocks
+    start there.
+    
+    """
+    
+    lines = []
+    
+    if len(blocks) > 4:
+        middle = len(blocks) // 2
+        
+        lines.append(
+                INDENT * depth + 'if pc < {}:'.format(blocks[middle].start)
+            )
+        lines.extend(write_dispatch(blocks[:middle], countCycles, depth + 1))
+        lines.append(INDENT * depth + 'else:')
+        lines.extend(write_dispatch(blocks[middle:], countCycles, depth + 1))
+        
+        return lines
+        
+    for i, block in enumerate(blocks):
+        test = 'if' if i == 0 else 'elif'
+        
+        lines.append(
+                INDENT * depth + '{} pc == {}:'.format(test, block.start)
+            )
+        lines.extend(
+                INDENT * (depth + 1) + line
+                for line in BlockWriter(block, countCycles).write()
+            )
+            
+    lines.append(INDENT * depth + 'else:')
+    lines.append(INDENT * (depth + 1) + 'break')
+    
+    return lines
+    
+    
+def write_region(region, countCycles):
+    """ Gives the lines of a region's function, which takes the Machine, the 
+    address to start at, and the step count to stop at, and returns the
+    address of the next instruction to run.
+    
+    """
+    
+    used = sorted(
+            set(
+                reg
+                for block in region.blocks
+                for instruction in block.instructions
+                for reg in instruction.registers()
+            )
+        )
+        
+    saved = ['flags', 'steps'] + (['cycles'] if countCycles else [])
+    
+    lines = ['def {}(m, pc, limit):'.format(region.name)]
+    body = ['regs = m.regs', 'mem = m.mem']
+    body.extend('r{0} = regs[{0}]'.format(reg) for reg in used)
+    body.extend('{0} = m.{0}'.format(name) for name in saved)
+    body.append('try:')
+    body.append(INDENT + 'while steps < limit:')
+    body.extend(write_dispatch(region.blocks, countCycles, 2))
+    body.append('finally:')
+    body.append(INDENT + 'm.pc = pc')
+    body.extend(INDENT + 'regs[{0}] = r{0}'.format(reg) for reg in used)
+    body.extend(INDENT + 'm.{0} = {0}'.format(name) for name in saved)
+    body.append('return pc')
+    
+    lines.extend(INDENT + line for line in body)
+    return lines
+    
+    
+def hex_table(name, data):
+    """ Gives the lines that define a bytearray constant. """
+    
+    digits = str(data).encode('hex')
+    
+    lines = ['{} = bytearray(('.format(name)]
+    lines.extend(
+            INDENT + repr(digits[i:i + HEX_LINE_LENGTH])
+            for i in xrange(0, len(digits), HEX_LINE_LENGTH)
+        )
+    lines.append(").decode('hex'))")
+    
+    return lines
+    
+    
+def translate(memory, labels=None, countCycles=False, source=None):
+    """ Translates an image into the source of a standalone Python module. 
+    labels is a dict that maps addresses to label names, and source is the
+    name of the image, for the module's docstring.
+    
+    """
+    
+    if len(memory) != MEMORY_SIZE:
+        raise ValueError(
+                "Images must be exactly {} bytes!".format(MEMORY_SIZE)
+            )
+            
+    regions = find_regions(memory, labels)
+    
+    code = bytearray(MEMORY_SIZE)
+    
+    for region in regions:
+        for block in region.blocks:
+            for instruction in block.instructions:
+                for i in xrange(instruction.length or 1):
+                    code[(instruction.addr + i) & 0xFF] = 1
+                    
+    lines = ['"""', '']
+    lines.append(
+            'Translated from {} by simplevm_aot. Don\'t edit.'
+                .format(source or 'a SIMPL image')
+        )
+    lines.extend(['', '"""', '', 'import sys', 'import json', '', ''])
+    
+    lines.extend([
+        'ZERO = {}'.format(Flags.ZERO),
+        'CARRY = {}'.format(Flags.CARRY),
+        'OVERFLOW = {}'.format(Flags.OVERFLOW),
+        'NEGATIVE = {}'.format(Flags.NEGATIVE),
+        '',
+        'ZERO_NEGATIVE_MASK = ZERO | NEGATIVE',
+        'CARRY_OVERFLOW = CARRY | OVERFLOW',
+        '',
+        'ZERO_NEGATIVE = tuple(',
+        '        ZERO if r == 0 else NEGATIVE if r & 0x80 else 0',
+        '        for r in xrange(256)',
+        '    )',
+        '',
+    ])
+    
+    # Tables of whether each conditional jump is taken, by packed flags.
+    for op, name in sorted(CONDITIONS.iteritems()):
+        lines.append(
+                '{} = {!r}'.format(name, tuple(map(int, BRANCH_TAKEN[op])))
+            )
+            
+    lines.append('')
+    lines.extend(hex_table('IMAGE', memory))
+    lines.append('')
+    lines.append('# Bytes that hold translated instructions.')
+    lines.extend(hex_table('CODE', code))
+    lines.extend(['', ''])
+    
+    lines.extend(MODULE_CLASSES.format(
+            initCycles='\n        self.cycles = 0' if countCycles else '',
+            cyclesKey=(
+                "\n            'cycles'    :   self.cycles,"
+                if countCycles else ''
+            ),
+        ).splitlines())
+        
+    for region in regions:
+        lines.extend(['', ''])
+        lines.extend(write_region(region, countCycles))
+        
+    lines.extend(['', '', 'REGIONS = [None] * {}'.format(MEMORY_SIZE), ''])
+    
+    for region in regions:
+        for block in region.blocks:
+            lines.append(
+                    'REGIONS[{}] = {}'.format(block.start, region.name)
+                )
+                
+    lines.extend(['', ''])
+    lines.extend(MODULE_FUNCTIONS.splitlines())
+    
+    return '\n'.join(lines) + '\n'
+    
+    
+MODULE_CLASSES = '''\
+class InvalidInstruction(Exception):
+    def __init__(self, pc, op):
+        Exception.__init__(self, pc, op)
+        self.pc = pc
+        self.op = op
+        
+    def __str__(self):
+        return "Invalid instruction 0x{{:02x}} at 0x{{:02x}}!".format(
+                self.op, self.pc
+            )
+            
+            
+class SelfModifyingCode(Exception):
+    def __init__(self, pc, addr):
+        Exception.__init__(self, pc, addr)
+        self.pc = pc
+        self.addr = addr
+        
+    def __str__(self):
+        return "Store at 0x{{:02x}} would change code at 0x{{:02x}}!".format(
+                self.pc, self.addr
+            )
+            
+            
+class Machine(object):
+    """ The state of the machine, starting from the image. """
+    
+    def __init__(self):
+        self.regs = bytearray(16)
+        self.mem = bytearray(IMAGE)
+        self.pc = 0
+        self.flags = 0
+        self.steps = 0{initCycles}
+        self.halted = False
+        
+    def to_dict(self):
+        return {{
+            'halted'    :   self.halted,
+            'steps'     :   self.steps,
+            'pc'        :   self.pc,
+            'registers' :   list(self.regs),
+            'flags'     :   self.flags,
+            'memory'    :   str(self.mem).encode('hex'),{cyclesKey}
+        }}'''
+        
+        
+MODULE_FUNCTIONS = '''\
+def run(machine=None, limit=None):
+    """ Runs the program until it halts, or until it has run at least limit 
+    more instructions, and returns the Machine.
+    
+    """
+    
+    m = machine or Machine()
+    limit = m.steps + (sys.maxint if limit is None else limit)
+    
+    pc = m.pc
+    
+    while not m.halted and m.steps < limit:
+        region = REGIONS[pc]
+        
+        if region is None:
+            raise ValueError("No translated code at 0x{:02x}!".format(pc))
+            
+        pc = region(m, pc, limit)
+        
+    return m
+    
+    
+if __name__ == '__main__':
+    print json.dumps(run().to_dict(), sort_keys=True)'''
+    
+    
+def main(argv):
+    parser = argparse.ArgumentParser(
+            prog=argv[0],
+            description=(
+                "Translates a SIMPL image into a standalone Python module."
+            ),
+        )
+        
+    parser.add_argument('file', help="the *.hex, *.bin, or *.obj to translate")
+    parser.add_argument(
+            '-o', '--output', default=None,
+            help="the module to write, by default next to the image",
+        )
+    parser.add_argument(
+            '--labels', metavar='SOURCE', default=None,
+            help=(
+                "split functions at the labels in this source or *.obj file "
+                "(by default, the labels in a *.obj file being translated)"
+            ),
+        )
+    parser.add_argument(
+            '--cycles', action='store_true',
+            help="count the cycles the datapath would take",
+        )
+        
+    args = parser.parse_args(argv[1:])
+    
+    try:
+        memory = load_memory(args.file)
+    except InvalidFile as e:
+        return error(str(e))
+        
+    if args.labels is not None:
+        labels = read_labels(args.labels)
+    elif args.file.endswith('.obj'):
+        labels = read_object(args.file).labels()
+    else:
+        labels = {}
+        
+    output = args.output
+    
+    if output is None:
+        output = re.sub(r'\.\w+$', '', args.file) + '.py'
+        
+    source = translate(memory, labels, args.cycles, args.file)
+    
+    with open(output, 'w') as f:
+        f.write(source)
+        
+    print "Wrote {}.".format(output)
+    return 0
+    
+    
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
+    
\ No newline at end of file
@@ -0,0 +1,323 @@
+"""
+
+simplevm_batch.py
+By Ryan Lam
+
+Runs a stream of *.hex, *.bin, and *.obj images through the VM on a pool of 
+worker processes, and streams out one line of JSON per image as soon as it 
+finishes.
+
+Jobs come from JSON-lines files (one object per line, with a "path" and 
+optionally an "id", "max_steps", "detect_loops", and "console"), or from 
+directories or glob patterns of images. Results are printed in the order the 
+jobs finish, which is not necessarily the order they were given in. A line
+that isn't a valid job is reported as a job with a status of "error",
+without stopping the rest of the batch.
+
+If a job has "console" set, bytes that it stores to the console addresses
+(see devices) are returned in its result as "output".
+
+Loop detection is on by default, so a program that can never halt is
+reported with a status of "loop" as soon as it repeats a state, instead of 
+running until its step limit.
+
+"""
+
+import os
+import sys
+import glob
+import json
+import argparse
+import multiprocessing
+from Queue import Queue
+from cStringIO import StringIO
+
+from simplevm import VM, InfiniteLoop, load_memory
+from devices import console_map
+
+
+# Runaway programs are stopped after this many instructions by default.
+DEFAULT_MAX_STEPS = 10 ** 7
+
+
+def job_id(job):
+    """ Gives a job's ID: its "id" if it has one, or else its "path", or
+    None if it has neither.
+    
+    """
+    
+    if not isinstance(job, dict):
+        return None
+        
+    return job.get('id', job.get('path'))
+    
+    
+def failed(job, e):
+    """ Gives the result of a job that couldn't be run because of the given 
+    exception or message.
+    
+    """
+    
+    return {
+        'id'        :   job_id(job),
+        'status'    :   'error',
+        'error'     :   str(e),
+    }
+    
+    
+def load_job(job):
+    """ Loads the image that a job names. """
+    
+    if 'path' not in job:
+        raise ValueError("The job has no path!")
+        
+    return load_memory(job['path'])
+    
+    
+def run_guarded(function, job):
+    """ Calls function with a job in a worker, and gives its result, or an 
+    error result if it raised. Pool callbacks only ever see results, so a
+    job that raised would otherwise never be accounted for.
+    
+    """
+    
+    try:
+        return function(job)
+    except Exception as e:
+        return failed(job, e)
+        
+        
+def run_job(job):
+    """ Runs a single job in the VM, and gives its result as a dict of 
+    JSON-friendly values. Bad images are reported as results with a status
+    of 'error'.
+    
+    """
+    
+    jobID = job_id(job)
+    
+    if job.get('console'):
+        console = StringIO()
+        devices = console_map(console)
+    else:
+        devices = None
+        
+    try:
+        vm = VM(
+                load_job(job),
+                detectLoops=job.get('detect_loops', True),
+                devices=devices,
+            )
+        vm.run(job.get('max_steps', DEFAULT_MAX_STEPS))
+        
+    except InfiniteLoop as e:
+        return {
+            'id'        :   jobID,
+            'status'    :   'loop',
+            'steps'     :   vm.steps,
+            'pc'        :   e.pc,
+            'period'    :   e.period,
+        }
+        
+    except Exception as e:
+        return failed(job, e)
+        
+    result = vm.result()
+    
+    summary = {
+        'id'        :   jobID,
+        'status'    :   'halted' if result.halted else 'timeout',
+        'steps'     :   result.steps,
+        'pc'        :   result.pc,
+        'digest'    :   result.digest(),
+    }
+    
+    if devices is not None:
+        devices.flush()
+        summary['output'] = console.getvalue()
+        
+    return summary
+    
+    
+def run_batch(jobs, workers=None, maxInFlight=None, function=run_job):
+    """ Runs jobs on a pool of worker processes, and yields their results as 
+    they finish. Each job is run by calling function with it in a worker, so 
+    function must be defined at the top level of a module. If it raises, the 
+    job's result is an error (see failed()), and so is the result of a job
+    that has an "error" already, which isn't run at all.
+    
+    At most maxInFlight jobs are handed to the pool at a time, so jobs can be 
+    read lazily from an arbitrarily long stream. By default, this is a few 
+    times the number of workers.
+    
+    """
+    
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+        
+    if maxInFlight is None:
+        maxInFlight = workers * 4
+        
+    pool = multiprocessing.Pool(workers)
+    finished = Queue()
+    inFlight = 0
+    
+    try:
+        for job in jobs:
+            while inFlight >= maxInFlight:
+                yield finished.get()
+                inFlight -= 1
+                
+            if 'error' in job:
+                finished.put(failed(job, job['error']))
+            else:
+                pool.apply_async(
+                        run_guarded, (function, job), callback=finished.put
+                    )
+                    
+            inFlight += 1
+            
+        while inFlight:
+            yield finished.get()
+            inFlight -= 1
+            
+        pool.close()
+        
+    except:
+        pool.terminate()
+        raise
+        
+    finally:
+        pool.join()
+        
+        
+def jobs_from_lines(lines, defaults, name='-'):
+    """ Yields jobs from lines of JSON, skipping blank lines. Fields that a
+    job leaves out are taken from the defaults dict. A line that isn't a JSON 
+    object gives a job with only an "id", which is the name of the source and 
+    the line number, and an "error".
+    
+    """
+    
+    for lineNumber, line in enumerate(lines, 1):
+        line = line.strip()
+        
+        if not line:
+            continue
+            
+        try:
+            fields = json.loads(line)
+            
+            if not isinstance(fields, dict):
+                raise ValueError("A job must be a JSON object!")
+                
+        except ValueError as e:
+            yield {
+                'id'        :   '{}:{}'.format(name, lineNumber),
+                'error'     :   "Invalid job: {}".format(e),
+            }
+            continue
+            
+        job = dict(defaults)
+        job.update(fields)
+        
+        yield job
+        
+        
+def jobs_from_pattern(pattern, defaults):
+    """ Yields a job for every *.hex, *.bin, or *.obj image in a directory, or 
+    every image that matches a glob pattern.
+    
+    """
+    
+    if os.path.isdir(pattern):
+        paths = sorted(
+                glob.glob(os.path.join(pattern, '*.hex')) +
+                glob.glob(os.path.join(pattern, '*.bin')) +
+                glob.glob(os.path.join(pattern, '*.obj'))
+            )
+    else:
+        paths = glob.iglob(pattern)
+        
+    for path in paths:
+        job = dict(defaults)
+        job['path'] = path
+        
+        yield job
+        
+        
+def jobs_from_sources(sources, defaults):
+    """ Yields the jobs from every source in turn. A source is '-' for JSON 
+    lines on stdin, a *.jsonl file, a directory, or a glob pattern.
+    
+    """
+    
+    for source in sources:
+        if source == '-':
+            for job in jobs_from_lines(sys.stdin, defaults):
+                yield job
+                
+        elif source.endswith('.jsonl'):
+            with open(source, 'r') as f:
+                for job in jobs_from_lines(f, defaults, source):
+                    yield job
+                    
+        else:
+            for job in jobs_from_pattern(source, defaults):
+                yield job
+                
+                
+def main(argv):
+    parser = argparse.ArgumentParser(
+            prog=argv[0],
+            description="Runs many SIMPL images through the VM in parallel.",
+        )
+        
+    parser.add_argument(
+            'sources', nargs='+', metavar='SOURCE',
+            help=(
+                "a directory or glob pattern of *.hex/*.bin images, a *.jsonl "
+                "file of jobs, or '-' to read jobs from stdin"
+            ),
+        )
+    parser.add_argument(
+            '-j', '--workers', type=int, default=None,
+            help="number of worker processes (default: one per CPU)",
+        )
+    parser.add_argument(
+            '--max-steps', type=int, default=DEFAULT_MAX_STEPS,
+            help="stop each image after this many instructions",
+        )
+    parser.add_argument(
+            '--in-flight', type=int, default=None,
+            help="most jobs to hand to the workers at a time",
+        )
+    parser.add_argument(
+            '--no-detect-loops', dest='detect_loops', action='store_false',
+            help="run programs that can never halt until their step limit",
+        )
+    parser.add_argument(
+            '--console', action='store_true',
+            help="include bytes stored to 0xF0-0xFF in each result",
+        )
+        
+    args = parser.parse_args(argv[1:])
+    
+    defaults = {
+        'max_steps'     :   args.max_steps,
+        'detect_loops'  :   args.detect_loops,
+        'console'       :   args.console,
+    }
+    
+    jobs = jobs_from_sources(args.sources, defaults)
+    
+    for result in run_batch(jobs, args.workers, args.in_flight):
+        sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+        sys.stdout.flush()
+        
+    return 0
+    
+    
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
+    
\ No newline at end of file
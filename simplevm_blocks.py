@@ -0,0 +1,571 @@
+"""
+
+simplevm_blocks.py
+By Ryan Lam
+
+Translates runs of SIMPL machine code into Python functions, so that the VM
+can execute a whole block of instructions with a single call.
+
+A block isn't limited to one basic block. It carries on through unconditional 
+jumps to their targets, and past conditional jumps into the code they fall 
+through to, with an early return for when the jump is taken. So a pair like
+DEC and JMP, or a compare and a jump followed by more code, costs the VM a 
+single dispatch. A block ends at END, at the most instructions allowed, or
+just before it would reach an address it already contains.
+
+If a block ends by jumping back to its own start, it can also be compiled to 
+loop inside the function, until it leaves by one of its other exits or runs
+out of the steps it was given. Simple counted loops skip most of their passes 
+arithmetically (see simplevm_induction).
+
+"""
+
+from constants import Op, Instr, Cycles, BRANCH_TAKEN
+from simplevm_induction import find_counted_loop
+from simplevm_debug import Hit, WRITES_REGISTER
+
+
+# The most instructions that will be translated into a single block.
+MAX_BLOCK_LENGTH = 64
+
+# The most compiled blocks to keep around before starting over.
+MAX_CACHED_BLOCKS = 4096
+
+# Instructions that end a basic block. Blocks only stop at END, but they can
+# leave early at any of the others.
+TERMINATORS = frozenset(
+        (
+            Op.END,
+            Op.JMP,
+            Op.JEQ,
+            Op.JUL,
+            Op.JUG,
+            Op.JSL,
+            Op.JSG,
+        )
+    )
+    
+    
+# Python expressions for the result of each register-only operation, in terms
+# of the operands a and b.
+RESULTS = {
+    Op.INC  :   '(a + 1) & 0xFF',
+    Op.DEC  :   '(a - 1) & 0xFF',
+    Op.NEG  :   '-a & 0xFF',
+    Op.BCM  :   '~a & 0xFF',
+    Op.USR  :   '(a >> 1) & 0x7F',
+    Op.SSR  :   '(a >> 1) | (a & 0x80)',
+    Op.USL  :   '(a << 1) & 0xFF',
+    Op.ADD  :   '(a + b) & 0xFF',
+    Op.SUB  :   '(a - b) & 0xFF',
+    Op.AND  :   'a & b',
+    Op.OR   :   'a | b',
+    Op.CMP  :   '(a - b) & 0xFF',
+}
+
+# Operations that set the carry and overflow flags like an addition.
+ADD_LIKE = frozenset((Op.INC, Op.ADD))
+
+# Operations that set the carry and overflow flags like a subtraction.
+SUB_LIKE = frozenset((Op.DEC, Op.SUB, Op.CMP))
+
+# Conditional jumps, and the names the generated code uses for their tables of
+# whether they are taken.
+CONDITIONS = {
+    Op.JEQ  :   'JEQ_TAKEN',
+    Op.JUL  :   'JUL_TAKEN',
+    Op.JUG  :   'JUG_TAKEN',
+    Op.JSL  :   'JSL_TAKEN',
+    Op.JSG  :   'JSG_TAKEN',
+}
+
+# Cycles spent on each instruction other than a conditional jump.
+CYCLES = {
+    Op.NOP  :   Cycles.NOP,
+    Op.END  :   Cycles.END,
+    Op.MOV  :   Cycles.MOV,
+    Op.LDC  :   Cycles.LDC,
+    Op.LDM  :   Cycles.LDM,
+    Op.STM  :   Cycles.STM,
+    Op.JMP  :   Cycles.JMP,
+}
+
+CYCLES.update((op, Cycles.ALU) for op in RESULTS)
+
+# Maps (start address, bytes of the block's instructions in order, whether
+# cycles are counted, whether stores go to devices, whether it may loop, what
+# the debugger watches) to compiled block functions. Blocks are
+# position-dependent, so the start address is part of the key, and the bytes
+# determine every address the block goes through.
+_cache = {}
+
+
+def instruction_length(op):
+    """ Gives the length of an instruction in bytes, or None if the opcode 
+    isn't in the ISA.
+    
+    """
+    
+    if op in Instr.REG_CONST:
+        return 3
+    elif op in Instr.REG or op in Instr.REG_REG or op in Instr.CONST:
+        return 2
+    elif op in (Op.NOP, Op.END):
+        return 1
+    else:
+        return None
+        
+        
+def instruction_cycles(op, taken=True):
+    """ Gives the number of cycles the datapath spends on an instruction. 
+    Conditional jumps take longer when they're taken.
+    
+    """
+    
+    if op in CONDITIONS:
+        if taken:
+            return Cycles.JUMP_TAKEN
+        else:
+            return Cycles.JUMP_NOT_TAKEN
+            
+    return CYCLES[op]
+    
+    
+def find_block(memory, pc, stops=None):
+    """ Finds the block that starts at the given address. Returns a list of 
+    (address, op, operands, const) tuples in the order they would run if no 
+    conditional jumps were taken, which is empty if the first instruction is 
+    invalid.
+    
+    If stops is given, the block also ends before any instruction other than 
+    the first whose address is set in it.
+    
+    """
+    
+    instructions = []
+    starts = set()
+    addr = pc
+    
+    while len(instructions) < MAX_BLOCK_LENGTH and addr not in starts:
+        if stops is not None and stops[addr] and instructions:
+            break
+            
+        op = memory[addr]
+        length = instruction_length(op)
+        
+        if length is None:
+            break
+            
+        operands = memory[(addr + 1) & 0xFF]
+        
+        if op in Instr.REG_CONST:
+            const = memory[(addr + 2) & 0xFF]
+        else:
+            const = operands
+            
+        instructions.append((addr, op, operands, const))
+        starts.add(addr)
+        
+        if op == Op.END:
+            break
+        elif op == Op.JMP:
+            addr = const
+        else:
+            addr = (addr + length) & 0xFF
+            
+    return instructions
+    
+    
+def block_addresses(instructions):
+    """ Gives the addresses of every byte of a block's instructions, in order. 
+    Addresses can repeat if instructions overlap.
+    
+    """
+    
+    return [
+        (addr + i) & 0xFF
+        for addr, op, _, _ in instructions
+        for i in xrange(instruction_length(op))
+    ]
+    
+    
+def generate_source(instructions, countCycles=False, devices=False,
+        loops=False, counted=False, watchMemory=False, watchRegisters=()):
+    """ Generates the Python source for a block function.
+    
+    The generated function takes the VM, its registers, its memory, its code 
+    reference counts, and the most instructions it may execute, and returns a 
+    tuple of the next address and the number of instructions it executed. A 
+    block that ends in END sets the VM's halted flag and returns the address
+    of the END instruction.
+    
+    If loops is true and the block ends by jumping to its own start, the 
+    function loops instead of returning, for as long as another whole pass
+    fits in the limit it was given. If counted is true as well, the block is
+    a counted loop (see simplevm_induction), and the function starts by 
+    skipping passes with the CountedLoop named LOOP in its globals.
+    
+    If countCycles is true, the function also adds the cycles the datapath 
+    would have spent on the block to the VM's cycle count. If devices is true, 
+    stores are also routed through the VM's device map.
+    
+    If watchMemory is true, loads and stores check the VM debugger's 
+    watchpoints, and after writing any of the registers in watchRegisters,
+    the function checks the debugger's conditions for it. On a hit, it sets
+    the debugger's hit and returns the address of the next instruction.
+    
+    """
+    
+    used = set()
+    written = set()
+    setsCarry = False
+    
+    for addr, op, operands, const in instructions:
+        regA = operands >> 4
+        regB = operands & 0xF
+        
+        if op in Instr.REG:
+            used.add(regA)
+            written.add(regA)
+        elif op in Instr.REG_REG:
+            used.update((regA, regB))
+            
+            if op not in (Op.STM, Op.CMP):
+                written.add(regA)
+                
+        elif op in Instr.REG_CONST:
+            used.add(regA)
+            written.add(regA)
+            
+        if op in ADD_LIKE or op in SUB_LIKE:
+            setsCarry = True
+            
+    start = instructions[0][0]
+    last = instructions[-1]
+    looping = loops and last[1] == Op.JMP and last[3] == start
+    
+    # Flags are evaluated lazily, as in the VM's handlers. The locals a and r
+    # always hold the operand and result of the last flag-setting instruction
+    # so far, so only its opcode needs to be tracked here.
+    lastFlagOp = None
+    
+    # Set if the VM's flag records are read before a pass sets any flags, in
+    # which case a looping block has to store them at the end of every pass.
+    readsOldFlags = []
+    
+    def write_back_flags():
+        """ Lines that store the lazy flag records back into the VM. Storing 
+        them more than once is harmless, since evaluating a record again
+        gives the same flags.
+        
+        """
+        
+        lines = []
+        
+        if lastFlagOp is not None:
+            lines.append('vm._pending = ({}, a, r)'.format(lastFlagOp))
+        else:
+            readsOldFlags.append(True)
+            
+        if setsCarry:
+            lines.append('vm._cvPending = cv')
+            
+        return lines
+        
+    def write_back():
+        """ Lines that store the locals back into the VM. """
+        
+        lines = ['regs[{0}] = r{0}'.format(reg) for reg in sorted(written)]
+        lines.extend(write_back_flags())
+        
+        return lines
+        
+    # Cycles spent so far, excluding any conditional jump being compiled.
+    spent = 0
+    
+    def charge(cycles):
+        """ Lines that add to the VM's cycle count, if it's being kept. """
+        
+        if countCycles:
+            return ['vm.cycles += {}'.format(cycles)]
+        else:
+            return []
+            
+    def leave(pc, count):
+        """ A line that returns from the block. In a looping block, the 
+        instructions run in earlier passes are counted in the local done.
+        
+        """
+        
+        if looping:
+            return 'return {}, done + {}'.format(pc, count)
+        else:
+            return 'return {}, {}'.format(pc, count)
+            
+    def stop(hit, pc, count):
+        """ Lines that record a debugger hit and return from the block. """
+        
+        lines = ['vm.debugger.hit = Hit({})'.format(hit)]
+        lines.extend(write_back())
+        lines.extend(charge(spent))
+        lines.append(leave(pc, count))
+        
+        return lines
+        
+    prologue = []
+    
+    for reg in sorted(used):
+        prologue.append('r{0} = regs[{0}]'.format(reg))
+        
+    if setsCarry:
+        prologue.append('cv = vm._cvPending')
+        
+    if devices:
+        prologue.append('devs = vm.devices.table')
+        
+    if watchMemory:
+        prologue.append('reads = vm.debugger.reads')
+        prologue.append('writes = vm.debugger.writes')
+        
+    for reg in watchRegisters:
+        prologue.append('cond{0} = vm.debugger.conditions[{0}]'.format(reg))
+        
+    body = []
+    
+    for count, (addr, op, operands, const) in enumerate(instructions, 1):
+        regA = 'r{}'.format(operands >> 4)
+        regB = 'r{}'.format(operands & 0xF)
+        
+        length = instruction_length(op)
+        nextPC = (addr + length) & 0xFF
+        isLast = count == len(instructions)
+        
+        if op not in CONDITIONS:
+            spent += instruction_cycles(op)
+            
+        if op == Op.NOP:
+            pass
+            
+        elif op == Op.END:
+            body.extend(write_back())
+            body.extend(charge(spent))
+            body.append('vm.halted = True')
+            body.append(leave(addr, count))
+            
+        elif op == Op.MOV:
+            body.append('{} = {}'.format(regA, regB))
+            
+        elif op == Op.LDC:
+            body.append('{} = {}'.format(regA, const))
+            
+        elif op == Op.LDM:
+            if watchMemory:
+                # The address has to be kept in case regA is regB.
+                body.append('at = {}'.format(regB))
+                body.append('{} = mem[at]'.format(regA))
+                body.append('if reads[at]:')
+                body.extend(
+                        '    ' + line
+                        for line in stop("'read', at, mem[at]", nextPC, count)
+                    )
+            else:
+                body.append('{} = mem[{}]'.format(regA, regB))
+                
+        elif op == Op.STM:
+            # A device can change memory or the machine's state, so a store
+            # to one leaves the block, like a store over cached code does.
+            if devices:
+                body.append('dev = devs[{}]'.format(regB))
+                body.append('if dev is not None:')
+                body.extend('    ' + line for line in write_back())
+                body.append('    dev.write({}, {})'.format(regB, regA))
+                body.append('    vm.store({}, {})'.format(regB, regA))
+                
+                if watchMemory:
+                    hit = "'write', {}, {}".format(regB, regA)
+                    
+                    body.append('    if writes[{}]:'.format(regB))
+                    body.append(
+                            '        vm.debugger.hit = Hit({})'.format(hit)
+                        )
+                        
+                body.extend('    ' + line for line in charge(spent))
+                body.append('    ' + leave(nextPC, count))
+                
+            if watchMemory:
+                hit = "'write', {}, {}".format(regB, regA)
+                
+                body.append('if writes[{}]:'.format(regB))
+                body.append('    vm.store({}, {})'.format(regB, regA))
+                body.extend('    ' + line for line in stop(hit, nextPC, count))
+                
+            # Leave the block if the store overwrote cached code, since the
+            # rest of this block may be part of it.
+            body.append('if mem[{1}] != {0}:'.format(regA, regB))
+            body.append('    mem[{1}] = {0}'.format(regA, regB))
+            body.append('    if refs[{}]:'.format(regB))
+            body.extend('        ' + line for line in write_back())
+            body.extend('        ' + line for line in charge(spent))
+            body.append('        vm.invalidate({})'.format(regB))
+            body.append('        ' + leave(nextPC, count))
+            
+        elif op in RESULTS:
+            body.append('a = {}'.format(regA))
+            
+            if op in Instr.REG_REG:
+                body.append('b = {}'.format(regB))
+                
+            body.append('r = {}'.format(RESULTS[op]))
+            
+            if op != Op.CMP:
+                body.append('{} = r'.format(regA))
+                
+            if op in ADD_LIKE or op in SUB_LIKE:
+                body.append('if (a ^ r) & 0x80:')
+                body.append('    cv = ({}, a, r)'.format(op))
+                
+            lastFlagOp = op
+            
+        elif op == Op.JMP:
+            # Unless this is the end of the block, the block carries on at the
+            # target.
+            if isLast and not looping:
+                body.extend(write_back())
+                body.extend(charge(spent))
+                body.append(leave(const, count))
+                
+        elif op in CONDITIONS:
+            if op == Op.JEQ and lastFlagOp is not None:
+                body.append('if r == 0:')
+            else:
+                body.extend(write_back_flags())
+                body.append(
+                        'if {}[vm.get_flags()]:'.format(CONDITIONS[op])
+                    )
+                    
+            taken = spent + instruction_cycles(op, True)
+            spent += instruction_cycles(op, False)
+            
+            body.extend('    ' + line for line in write_back())
+            body.extend('    ' + line for line in charge(taken))
+            body.append('    ' + leave(const, count))
+            
+            if isLast:
+                body.extend(write_back())
+                body.extend(charge(spent))
+                body.append(leave(nextPC, count))
+                
+        else:
+            assert False
+            
+        reg = operands >> 4
+        
+        if op in WRITES_REGISTER and reg in watchRegisters:
+            hit = "'register', {}, {}".format(reg, regA)
+            
+            body.append('if cond{}[{}]:'.format(reg, regA))
+            body.extend('    ' + line for line in stop(hit, nextPC, count))
+            
+    if last[1] not in TERMINATORS:
+        body.extend(write_back())
+        body.extend(charge(spent))
+        body.append(leave(nextPC, len(instructions)))
+        
+    if looping:
+        # Count the pass, and go around again unless there isn't room for
+        # another one.
+        size = len(instructions)
+        
+        body.append('done += {}'.format(size))
+        body.extend(charge(spent))
+        
+        if readsOldFlags:
+            body.extend(write_back_flags())
+            
+        body.append('if done + {} > limit:'.format(size))
+        body.extend('    ' + line for line in write_back())
+        body.append('    return {}, done'.format(start))
+        
+        if counted:
+            # Skip passes before the registers are loaded into locals.
+            prologue.insert(0, 'done = LOOP.fast_forward(vm, limit)')
+        else:
+            prologue.append('done = 0')
+            
+        prologue.append('while 1:')
+        body = ['    ' + line for line in body]
+        
+    lines = ['def block(vm, regs, mem, refs, limit):']
+    lines.extend('    ' + line for line in prologue + body)
+    
+    return '\n'.join(lines) + '\n'
+    
+    
+def compile_block(memory, pc, countCycles=False, devices=False,
+        loops=False, stops=None, watchMemory=False, watchRegisters=()):
+    """ Compiles the block that starts at the given address. Returns a tuple
+    of (function, most instructions in one pass, frozenset of the addresses
+    its instructions cover), or None if the first instruction is invalid.
+    
+    If countCycles is true, the block also keeps the VM's cycle count, and if 
+    devices is true, it routes stores through the VM's device map. If loops
+    is true, a block that jumps back to its start loops inside the function.
+    
+    For debugging, stops is a table of breakpoint addresses that the block 
+    mustn't run past, and watchMemory and watchRegisters are as for 
+    generate_source().
+    
+    """
+    
+    instructions = find_block(memory, pc, stops)
+    
+    if not instructions:
+        return None
+        
+    # The VM has to check for a breakpoint at the start on every pass.
+    if stops is not None and stops[pc]:
+        loops = False
+        
+    addresses = block_addresses(instructions)
+    data = str(bytearray(memory[addr] for addr in addresses))
+    
+    key = (
+        pc, data, countCycles, devices, loops, watchMemory, watchRegisters
+    )
+    
+    try:
+        function = _cache[key]
+        
+    except KeyError:
+        # Skipping passes would skip the register conditions in them.
+        if loops and not watchRegisters:
+            loop = find_counted_loop(
+                    instructions,
+                    sum(instruction_cycles(op, False)
+                        for _, op, _, _ in instructions),
+                )
+        else:
+            loop = None
+            
+        source = generate_source(
+                instructions, countCycles, devices, loops, loop is not None,
+                watchMemory, watchRegisters,
+            )
+            
+        namespace = dict(
+                (name, BRANCH_TAKEN[op])
+                for op, name in CONDITIONS.iteritems()
+            )
+        namespace['LOOP'] = loop
+        namespace['Hit'] = Hit
+        
+        code = compile(source, '<block 0x{:02x}>'.format(pc), 'exec')
+        exec code in namespace
+        
+        if len(_cache) >= MAX_CACHED_BLOCKS:
+            _cache.clear()
+            
+        function = _cache[key] = namespace['block']
+        
+    return function, len(instructions), frozenset(addresses)
+    
\ No newline at end of file
@@ -0,0 +1,297 @@
+"""
+
+simplevm_crosscheck.py
+By Ryan Lam
+
+Differential testing of the two implementations of the ISA: runs each image in 
+the VM and on simplesim's datapath side by side, and compares their PC,
+flags, registers, and memory every time the controller gets back to FETCH_0,
+so the first instruction that the two disagree on is found, along with 
+everything it left different.
+
+States are compared as flat byte strings (see MachineState.key()), which is a 
+single memcmp per instruction, and are only broken down into differences once 
+they disagree. When the machine halts, the datapath has already moved its PC 
+past the END instruction, while the VM leaves its PC on it, so the PC is 
+expected to be one further on the datapath.
+
+Images are checked on a pool of worker processes, like simplevm_batch, with
+one line of JSON per image as soon as it's done. Each worker builds a single 
+datapath, and reloads it for every image.
+
+"""
+
+import sys
+import json
+import argparse
+from collections import namedtuple
+
+from constants import MEMORY_SIZE, State
+from simplevm import VM, InvalidInstruction, step_budget
+from simplevm_batch import (
+    run_batch, jobs_from_sources, job_id, load_job, failed,
+)
+from simplevm_handoff import MAX_INSTRUCTION_CYCLES
+import simplesim
+
+
+# The datapath is far slower than the VM, so runaway programs are stopped
+# much sooner than in simplevm_batch.
+DEFAULT_MAX_STEPS = 10 ** 4
+
+# An instruction that takes this many cycles is taken to have hung the
+# datapath.
+MAX_CYCLES = 4 * MAX_INSTRUCTION_CYCLES
+
+# The datapath each process checks images on, built the first time it's
+# needed (see simplesim.build_datapath()).
+_datapath = None
+
+
+class Divergence(
+        namedtuple(
+            'Divergence', ('step', 'pc', 'op', 'vm', 'sim', 'error')
+        )
+    ):
+    """ The first instruction after which the VM and the datapath disagree:
+    its step number (counting from 1), address, and opcode, and the states
+    they were left in. If the datapath failed instead, sim is None and error
+    is its message.
+    
+    """
+    
+    __slots__ = ()
+    
+    def differences(self):
+        """ Gives a dict that maps the names of the parts of the state that 
+        differ, like 'pc', 'r10', or 'mem[0x3f]', to (VM value, datapath
+        value) pairs.
+        
+        """
+        
+        vm = self.vm
+        sim = self.sim
+        
+        if sim is None:
+            return {}
+            
+        differences = {}
+        
+        if vm.pc != sim.pc:
+            differences['pc'] = (vm.pc, sim.pc)
+            
+        if vm.flags != sim.flags:
+            differences['flags'] = (vm.flags, sim.flags)
+            
+        for reg, (a, b) in enumerate(zip(vm.registers, sim.registers)):
+            if a != b:
+                differences['r{}'.format(reg)] = (a, b)
+                
+        for addr, (a, b) in enumerate(zip(vm.memory, sim.memory)):
+            if a != b:
+                differences['mem[0x{:02x}]'.format(addr)] = (a, b)
+                
+        return differences
+        
+    def to_dict(self):
+        result = {
+            'step'          :   self.step,
+            'pc'            :   self.pc,
+            'op'            :   self.op,
+            'differences'   :   self.differences(),
+        }
+        
+        if self.error is not None:
+            result['error'] = self.error
+            
+        return result
+        
+        
+class Comparison(
+        namedtuple(
+            'Comparison', ('status', 'steps', 'cycles', 'divergence')
+        )
+    ):
+    """ The outcome of checking an image: its status, the instructions run
+    and cycles simulated, and the Divergence if there was one.
+    
+    The status is 'match' if both halted in the same state, 'timeout' if they 
+    agreed up to the step limit, 'diverged', or 'invalid' if the program 
+    reached an invalid instruction, which isn't compared.
+    
+    """
+    
+    __slots__ = ()
+    
+    def to_dict(self):
+        result = {
+            'status'    :   self.status,
+            'steps'     :   self.steps,
+            'cycles'    :   self.cycles,
+        }
+        
+        if self.divergence is not None:
+            result['divergence'] = self.divergence.to_dict()
+            
+        return result
+        
+        
+def get_datapath():
+    """ Gives this process's datapath, building it if it hasn't been yet. """
+    
+    global _datapath
+    
+    if _datapath is None:
+        _datapath = simplesim.build_datapath(
+                '\x00' * MEMORY_SIZE, quiet=True
+            )
+            
+    return _datapath
+    
+    
+def compare(memory, maxSteps=DEFAULT_MAX_STEPS):
+    """ Runs an image in the VM and on the datapath, one instruction at a
+    time, until they disagree, the machine halts, or maxSteps instructions
+    have run. Gives a Comparison.
+    
+    """
+    
+    vm = VM(bytearray(memory))
+    
+    datapath = get_datapath()
+    datapath.load_state(vm.get_state())
+    
+    fsm = datapath.fsm
+    budget = step_budget(maxSteps)
+    cycles = 0
+    
+    while not vm.halted and vm.steps < budget:
+        pc = vm.pc
+        op = vm.memory[pc]
+        
+        try:
+            vm.step()
+        except InvalidInstruction:
+            return Comparison('invalid', vm.steps, cycles, None)
+            
+        expected = vm.get_state()
+        
+        if vm.halted:
+            expected.pc = (expected.pc + 1) & 0xFF
+            
+        try:
+            spent, finished = simplesim.simulate_instructions(
+                    datapath, 1, maxCycles=MAX_CYCLES
+                )
+            cycles += spent
+            
+            if not finished:
+                raise RuntimeError(
+                        "Instruction didn't finish in {} cycles!"
+                            .format(MAX_CYCLES)
+                    )
+                    
+            actual = datapath.get_state()
+            halted = fsm.state.state == State.HALT
+            
+        except Exception as e:
+            divergence = Divergence(vm.steps, pc, op, expected, None, str(e))
+            return Comparison('diverged', vm.steps, cycles, divergence)
+            
+        if halted != vm.halted or actual.key() != expected.key():
+            error = None
+            
+            if halted != vm.halted:
+                error = "Only the {} halted!".format(
+                        'VM' if vm.halted else 'datapath'
+                    )
+                    
+            divergence = Divergence(vm.steps, pc, op, expected, actual, error)
+            return Comparison('diverged', vm.steps, cycles, divergence)
+            
+    status = 'match' if vm.halted else 'timeout'
+    return Comparison(status, vm.steps, cycles, None)
+    
+    
+def check_job(job):
+    """ Checks a single job, like simplevm_batch.run_job(), and gives its 
+    result as a dict of JSON-friendly values. A job that can't be checked,
+    like one without a path, gives a result with a status of 'error'.
+    
+    """
+    
+    try:
+        comparison = compare(
+                load_job(job),
+                job.get('max_steps', DEFAULT_MAX_STEPS),
+            )
+            
+    except Exception as e:
+        return failed(job, e)
+        
+    result = comparison.to_dict()
+    result['id'] = job_id(job)
+    
+    return result
+    
+    
+def main(argv):
+    parser = argparse.ArgumentParser(
+            prog=argv[0],
+            description=(
+                "Checks that the SIMPL VM and the simulated datapath agree "
+                "after every instruction, over many images in parallel."
+            ),
+        )
+        
+    parser.add_argument(
+            'sources', nargs='+', metavar='SOURCE',
+            help=(
+                "a directory or glob pattern of *.hex/*.bin images, a *.jsonl "
+                "file of jobs, or '-' to read jobs from stdin"
+            ),
+        )
+    parser.add_argument(
+            '-j', '--workers', type=int, default=None,
+            help="number of worker processes (default: one per CPU)",
+        )
+    parser.add_argument(
+            '--max-steps', type=int, default=DEFAULT_MAX_STEPS,
+            help="stop checking each image after this many instructions",
+        )
+    parser.add_argument(
+            '--in-flight', type=int, default=None,
+            help="most jobs to hand to the workers at a time",
+        )
+        
+    args = parser.parse_args(argv[1:])
+    
+    jobs = jobs_from_sources(args.sources, {'max_steps' : args.max_steps})
+    counts = {}
+    
+    for result in run_batch(jobs, args.workers, args.in_flight, check_job):
+        sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+        sys.stdout.flush()
+        
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+        
+    sys.stderr.write(
+            "{} images: {}\n".format(
+                sum(counts.itervalues()),
+                ", ".join(
+                    "{} {}".format(n, status)
+                    for status, n in sorted(counts.iteritems())
+                ) or "none",
+            )
+        )
+        
+    # Fail if anything diverged or couldn't be checked, for scripts.
+    if counts.get('diverged') or counts.get('error'):
+        return 1
+        
+    return 0
+    
+    
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
+    
\ No newline at end of file
@@ -0,0 +1,155 @@
+"""
+
+simplevm_debug.py
+By Ryan Lam
+
+Breakpoints, watchpoints, and register conditions for the VM.
+
+Every kind of point is kept in a lookup table, so checking one
+costs a single index whether or not anything is set. Breakpoints are checked 
+before the instruction at their address runs. Watchpoints and register 
+conditions are checked after the instruction that reads or writes them, so
+the state the VM stops in includes the access.
+
+"""
+
+from collections import namedtuple
+
+from constants import MEMORY_SIZE, Op, Instr
+
+
+# Instructions that write their first register.
+WRITES_REGISTER = frozenset(
+        op for op in (Instr.REG | Instr.REG_REG | Instr.REG_CONST)
+        if isinstance(op, int) and op not in (Op.STM, Op.CMP)
+    )
+    
+    
+class Hit(namedtuple('Hit', ('kind', 'target', 'value'))):
+    """ What stopped a run. kind is 'breakpoint', 'read', 'write', or 
+    'register', and target is the PC, memory address, or register number
+    that was hit. value is the byte that was read or written, or None for a 
+    breakpoint.
+    
+    """
+    
+    __slots__ = ()
+    
+    def __str__(self):
+        if self.kind == 'breakpoint':
+            return "Breakpoint at 0x{:02x}".format(self.target)
+        elif self.kind == 'read':
+            text = "Read 0x{1:02x} from 0x{0:02x}"
+        elif self.kind == 'write':
+            text = "Wrote 0x{1:02x} to 0x{0:02x}"
+        else:
+            text = "Set r{0} to 0x{1:02x}"
+            
+        return text.format(self.target, self.value)
+        
+        
+class Debugger(object):
+    """ The points a VM stops at when it's given this debugger.
+    
+    - breakpoints[pc] is set to stop before the instruction at pc runs.
+    - reads[addr] and writes[addr] are set to stop after an LDM or STM of
+      addr.
+    - conditions[reg][value] is set to stop after an instruction writes value 
+      to register reg.
+      
+    The tables should be changed through the methods below, which keep track
+    of what the VM has to check. When the VM stops, hit is set to the Hit
+    that stopped it, and it's cleared at the start of every run.
+    
+    """
+    
+    def __init__(self):
+        self.breakpoints = bytearray(MEMORY_SIZE)
+        self.reads = bytearray(MEMORY_SIZE)
+        self.writes = bytearray(MEMORY_SIZE)
+        self.conditions = [bytearray(256) for _ in xrange(16)]
+        
+        self.hit = None
+        
+        # Whether any watchpoints are set, the registers with conditions, and
+        # a count of changes, so the VM knows when to recompile its blocks.
+        self.watchMemory = False
+        self.watchRegisters = ()
+        self.generation = 0
+        
+    def add_breakpoint(self, addr):
+        self.breakpoints[addr] = 1
+        self._changed()
+        
+    def remove_breakpoint(self, addr):
+        self.breakpoints[addr] = 0
+        self._changed()
+        
+    def add_watchpoint(self, addr, read=False, write=True):
+        """ Stops after addr is read by LDM, written by STM, or both. """
+        
+        if read:
+            self.reads[addr] = 1
+            
+        if write:
+            self.writes[addr] = 1
+            
+        self._changed()
+        
+    def remove_watchpoint(self, addr):
+        self.reads[addr] = 0
+        self.writes[addr] = 0
+        self._changed()
+        
+    def add_condition(self, reg, values):
+        """ Stops after an instruction writes one of the given values to a 
+        register. values can be a single value, a collection of values, or a 
+        function that takes a value and returns whether to stop.
+        
+        """
+        
+        if isinstance(values, int):
+            values = (values,)
+            
+        if callable(values):
+            matches = values
+        else:
+            matches = frozenset(values).__contains__
+            
+        table = self.conditions[reg]
+        
+        for value in xrange(256):
+            if matches(value):
+                table[value] = 1
+                
+        self._changed()
+        
+    def remove_condition(self, reg):
+        self.conditions[reg][:] = bytearray(256)
+        self._changed()
+        
+    def check(self, op, regA, addr, registers, memory):
+        """ Gives the Hit for an instruction that has just run, or None. addr 
+        must be the value its second register had before it ran.
+        
+        """
+        
+        if op == Op.LDM and self.reads[addr]:
+            return Hit('read', addr, memory[addr])
+            
+        if op == Op.STM and self.writes[addr]:
+            return Hit('write', addr, memory[addr])
+            
+        if op in WRITES_REGISTER and self.conditions[regA][registers[regA]]:
+            return Hit('register', regA, registers[regA])
+            
+        return None
+        
+    def _changed(self):
+        self.watchMemory = any(self.reads) or any(self.writes)
+        self.watchRegisters = tuple(
+                reg for reg, table in enumerate(self.conditions) if any(table)
+            )
+            
+        self.generation += 1
+        
\ No newline at end of file
@@ -0,0 +1,166 @@
+"""
+
+simplevm_handoff.py
+By Ryan Lam
+
+Runs a program in the VM up to the region of interest, and then hands the 
+machine over to the simulator, so that only that region is simulated cycle by 
+cycle.
+
+The VM is stopped at an instruction boundary: at a PC, at the first boundary
+at or after a cycle count, after a number of steps, or once a predicate is
+true (see VM.run_until()). Its PC, flags, registers, and memory then seed the 
+datapath's registers, register file, and memory, with the controller at 
+FETCH_0, which is exactly the state the datapath would have been in if it had 
+run the program from the start.
+
+"""
+
+import sys
+import argparse
+
+from constants import Cycles
+from simplevm import (
+    VM, InvalidFile, InvalidInstruction,
+    load_memory, parse_address, error, step_budget,
+)
+from simplevm_blocks import CYCLES
+from simplevm_debug import Debugger
+from devices import console_map
+import simplesim
+
+
+# The most cycles that any instruction takes, so running a number of
+# instructions equal to the cycles left divided by this can't overshoot.
+MAX_INSTRUCTION_CYCLES = max(
+        max(CYCLES.itervalues()), Cycles.JUMP_TAKEN, Cycles.JUMP_NOT_TAKEN
+    )
+    
+    
+def run_to_pc(vm, pc, maxSteps=None):
+    """ Runs the VM until it's about to execute the instruction at pc, it 
+    halts, or it has executed maxSteps instructions, and returns the number
+    of instructions executed. The VM's own debugger, if it has one, is put
+    back afterwards.
+    
+    """
+    
+    if vm.pc == pc:
+        return 0
+        
+    previous = vm.debugger
+    
+    debugger = Debugger()
+    debugger.add_breakpoint(pc)
+    
+    vm.set_debugger(debugger)
+    
+    try:
+        return vm.run(maxSteps)
+    finally:
+        vm.set_debugger(previous)
+        
+        
+def run_to_cycle(vm, cycles, maxSteps=None):
+    """ Runs the VM until the first instruction boundary at or after the given 
+    cycle count, it halts, or it has executed maxSteps instructions, and 
+    returns the number of instructions executed. The VM must count cycles.
+    
+    """
+    
+    if not vm.countCycles:
+        raise ValueError("The VM must count cycles to run to a cycle count!")
+        
+    budget = step_budget(maxSteps)
+    steps = 0
+    
+    while vm.cycles < cycles and not vm.halted and steps < budget:
+        chunk = max((cycles - vm.cycles) // MAX_INSTRUCTION_CYCLES, 1)
+        chunk = min(chunk, budget - steps)
+        
+        steps += vm.run(chunk)
+        
+    return steps
+    
+    
+def hand_off(vm, devices=None):
+    """ Builds the simulator's datapath in the VM's current state, and gives 
+    its simplesim.Datapath. Simulate it with simplesim.simulate() and 
+    reset=False.
+    
+    """
+    
+    datapath = simplesim.build_datapath(str(vm.memory), devices)
+    datapath.load_state(vm.get_state())
+    
+    return datapath
+    
+    
+def main(argv):
+    parser = argparse.ArgumentParser(
+            prog=argv[0],
+            description=(
+                "Runs a program in the SIMPL VM up to a point, and simulates "
+                "the rest on the datapath."
+            ),
+        )
+        
+    parser.add_argument('file', help="the *.hex, *.bin, or *.obj file to run")
+    
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+            '--pc', type=parse_address, default=None,
+            help="hand off before the instruction at this address runs",
+        )
+    group.add_argument(
+            '--cycles', type=int, default=None,
+            help="hand off at the first instruction after this many cycles",
+        )
+    group.add_argument(
+            '--steps', type=int, default=None,
+            help="hand off after this many instructions",
+        )
+        
+    parser.add_argument(
+            '--console', action='store_true',
+            help="print bytes stored to 0xF0-0xFF as they're written",
+        )
+        
+    args = parser.parse_args(argv[1:])
+    
+    try:
+        memory = load_memory(args.file)
+    except InvalidFile as e:
+        return error(str(e))
+        
+    devices = console_map() if args.console else None
+    vm = VM(memory, countCycles=True, devices=devices)
+    
+    try:
+        if args.pc is not None:
+            run_to_pc(vm, args.pc)
+        elif args.cycles is not None:
+            run_to_cycle(vm, args.cycles)
+        else:
+            vm.run(args.steps)
+            
+    except InvalidInstruction as e:
+        return error(str(e))
+        
+    if devices is not None:
+        devices.flush()
+        
+    print "Fast-forwarded {} instructions ({} cycles) to PC 0x{:02x}.".format(
+            vm.steps, vm.cycles, vm.pc
+        )
+        
+    if vm.halted:
+        print "Program halted before the hand-off!"
+        return 0
+        
+    return simplesim.simulate(hand_off(vm, devices), devices, reset=False)
+    
+    
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
+    
\ No newline at end of file
@@ -0,0 +1,314 @@
+"""
+
+simplevm_induction.py
+By Ryan Lam
+
+Fast-forwarding of counted loops in the VM's compiled blocks.
+
+A counted loop is a block that jumps back to its own start, whose other 
+instructions are only INC, DEC, ADD, SUB, CMP, NOP, and JMP, and whose only 
+exit is a JEQ right after a CMP. Each ADD or SUB must add a register that the 
+loop doesn't write, so every register changes by the same amount on every
+pass. The pass that exits can then be found by solving a linear congruence 
+modulo 256, and the registers and flags after any number of passes can be 
+computed without running them.
+
+"""
+
+from constants import Op
+
+
+# Instructions that a counted loop can do arithmetic with.
+ARITHMETIC = frozenset((Op.INC, Op.DEC, Op.ADD, Op.SUB, Op.CMP))
+
+# Maps each odd number to its multiplicative inverse modulo 256.
+INVERSES = dict(
+        (x, y)
+        for x in xrange(1, 256, 2)
+        for y in xrange(1, 256, 2)
+        if x * y & 0xFF == 1
+    )
+    
+# Loops with fewer passes than this left to skip are run normally, since
+# running them is cheaper than working out where they end.
+MIN_PASSES = 4
+
+# The most tables to keep in _distances before starting over.
+MAX_CACHED_DISTANCES = 4096
+
+# Maps (offset, step) to a table that gives, for each value x, the fewest
+# times step has to be subtracted from x to reach a value whose sign changes
+# when offset is added to it, or None if that never happens. See
+# sign_change_distances().
+_distances = {}
+
+
+class CountedLoop(object):
+    """ A counted loop, with its arithmetic instructions as a list of (op, 
+    regA, regB) tuples, the index in that list of the CMP that decides its 
+    exit, and the number of instructions and cycles in a pass that doesn't 
+    exit.
+    
+    """
+    
+    def __init__(self, body, exit, length, cycles):
+        self.body = body
+        self.exit = exit
+        self.length = length
+        self.cycles = cycles
+        
+    def run_pass(self, values):
+        """ Runs the arithmetic of one pass on a list of register values, in 
+        place, and gives the (op, a, result) flag records of its instructions 
+        in order.
+        
+        """
+        
+        records = []
+        
+        for op, regA, regB in self.body:
+            a = values[regA]
+            
+            if op == Op.INC:
+                result = (a + 1) & 0xFF
+            elif op == Op.DEC:
+                result = (a - 1) & 0xFF
+            elif op == Op.ADD:
+                result = (a + values[regB]) & 0xFF
+            else:
+                result = (a - values[regB]) & 0xFF
+                
+            if op != Op.CMP:
+                values[regA] = result
+                
+            records.append((op, a, result))
+            
+        return records
+        
+    def fast_forward(self, vm, limit):
+        """ Skips as many whole passes as possible without going past the
+        pass that exits, while leaving room for one more pass within limit 
+        instructions. Updates the VM's registers, flags, and cycle count as
+        if the passes had run, and returns the number of instructions
+        skipped.
+        
+        """
+        
+        passes = limit // self.length - 1
+        
+        if passes < MIN_PASSES:
+            return 0
+            
+        start = list(vm.registers)
+        values = list(start)
+        
+        # Every register, and so every operand and result in the flag
+        # records, changes by a fixed amount each pass, which the first two
+        # passes give.
+        first = self.run_pass(values)
+        deltas = [(value - old) & 0xFF for value, old in zip(values, start)]
+        second = self.run_pass(values)
+        
+        exit = self.exit
+        exitPass = passes_until_zero(
+                first[exit][2], (second[exit][2] - first[exit][2]) & 0xFF
+            )
+            
+        if exitPass is not None:
+            passes = min(passes, exitPass)
+            
+            if passes < MIN_PASSES:
+                return 0
+                
+        # Zero and negative come from the last record of the last pass.
+        # Carry and overflow come from the last record whose operand and
+        # result have different signs, if there is one.
+        last = passes - 1
+        latest = None
+        
+        for position in reversed(xrange(len(first))):
+            back = self.passes_since_sign_change(first, second, position, last)
+            
+            if back is not None and (latest is None or back < latest[0]):
+                latest = (back, position)
+                
+        registers = vm.registers
+        
+        for reg, delta in enumerate(deltas):
+            if delta:
+                registers[reg] = (start[reg] + passes * delta) & 0xFF
+                
+        vm._pending = record_after(first, second, len(first) - 1, last)
+        
+        if latest is not None:
+            back, position = latest
+            vm._cvPending = record_after(first, second, position, last - back)
+            
+        if vm.countCycles:
+            vm.cycles += passes * self.cycles
+            
+        return passes * self.length
+        
+    def passes_since_sign_change(self, first, second, position, last):
+        """ Gives how many passes before pass number last the record at the 
+        given position last had an operand and result with different signs, 
+        given the records of the first two passes, or None if it never did.
+        
+        """
+        
+        op, a0, r0 = first[position]
+        op, a1, r1 = second[position]
+        
+        step = (a1 - a0) & 0xFF
+        offset = (r0 - a0) & 0xFF
+        drift = (r1 - a1 - offset) & 0xFF
+        
+        if drift == 0:
+            # The result is always the operand plus the same offset.
+            a = (a0 + last * step) & 0xFF
+            back = sign_change_distances(offset, step)[a]
+            
+            if back is not None and back <= last:
+                return back
+                
+            return None
+            
+        # Otherwise this is a CMP of two registers that change by different
+        # amounts. The pair repeats within 256 passes, so look that far back.
+        for back in xrange(min(last, 255) + 1):
+            op, a, r = record_after(first, second, position, last - back)
+            
+            if (a ^ r) & 0x80:
+                return back
+                
+        return None
+        
+        
+def record_after(first, second, position, done):
+    """ Gives the record at the given position in the pass after done passes, 
+    given the records of the first two passes.
+    
+    """
+    
+    op, a0, r0 = first[position]
+    op, a1, r1 = second[position]
+    
+    return (
+        op,
+        (a0 + done * (a1 - a0)) & 0xFF,
+        (r0 + done * (r1 - r0)) & 0xFF,
+    )
+    
+    
+def sign_change_distances(offset, step):
+    """ Gives a table that maps each value x to the fewest times that step
+    has to be subtracted from x to reach a value that changes sign when
+    offset is added to it, modulo 256, or to None if that never happens.
+    
+    """
+    
+    key = (offset, step)
+    
+    try:
+        return _distances[key]
+        
+    except KeyError:
+        pass
+        
+    changes = [bool((x ^ (x + offset)) & 0x80) for x in xrange(256)]
+    distances = [None] * 256
+    
+    # Adding step repeatedly walks cycles of values. Walk each cycle that
+    # has a change in it once, starting from a change.
+    for x in xrange(256):
+        if not changes[x] or distances[x] is not None:
+            continue
+            
+        distance = 0
+        value = x
+        
+        while True:
+            distances[value] = distance
+            value = (value + step) & 0xFF
+            
+            if value == x:
+                break
+                
+            if changes[value]:
+                distance = 0
+            else:
+                distance += 1
+                
+    if len(_distances) >= MAX_CACHED_DISTANCES:
+        _distances.clear()
+        
+    _distances[key] = distances
+    return distances
+    
+    
+def passes_until_zero(value, step):
+    """ Gives the fewest passes after which a value that changes by step
+    every pass is zero, modulo 256, or None if it never is.
+    
+    """
+    
+    if value == 0:
+        return 0
+        
+    if step == 0:
+        return None
+        
+    # Solve value + passes * step = 0 (mod 256). step is a power of two times
+    # an odd number, and only the odd part can be inverted.
+    low = step & -step
+    
+    if value % low:
+        return None
+        
+    return (-value & 0xFF) // low * INVERSES[step // low] % (256 // low)
+    
+    
+def find_counted_loop(instructions, cycles):
+    """ Gives a CountedLoop for a block's instructions, in the order that 
+    find_block gives them, or None if they aren't a counted loop. cycles is
+    the number of cycles a pass that doesn't exit takes.
+    
+    """
+    
+    last = instructions[-1]
+    
+    if last[1] != Op.JMP or last[3] != instructions[0][0]:
+        return None
+        
+    body = []
+    written = set()
+    exit = None
+    
+    for i, (addr, op, operands, const) in enumerate(instructions):
+        regA = operands >> 4
+        regB = operands & 0xF
+        
+        if op in ARITHMETIC:
+            body.append((op, regA, regB))
+            
+            if op != Op.CMP:
+                written.add(regA)
+                
+        elif op == Op.JEQ:
+            if exit is not None or instructions[i - 1][1] != Op.CMP:
+                return None
+                
+            exit = len(body) - 1
+            
+        elif op not in (Op.NOP, Op.JMP):
+            return None
+            
+    if exit is None:
+        return None
+        
+    for op, regA, regB in body:
+        if op in (Op.ADD, Op.SUB) and regB in written:
+            return None
+            
+    return CountedLoop(body, exit, len(instructions), cycles)
+    
\ No newline at end of file
@@ -0,0 +1,245 @@
+"""
+
+simplevm_lockstep.py
+By Ryan Lam
+
+A VM that runs many instances of a SIMPL machine in lockstep, using NumPy to 
+execute each instruction on every instance at once. This is meant for running 
+the same program over large sets of inputs, like divide.txt with different 
+values of x and y.
+
+Requires NumPy.
+
+"""
+
+import numpy as np
+
+from constants import MEMORY_SIZE, Op, Flags, BRANCH_TAKEN
+from simplevm import Result, step_budget
+from simplevm_blocks import instruction_length
+
+
+# Instruction lengths in bytes, indexed by opcode. Invalid opcodes are 0.
+LENGTHS = np.array(
+        [instruction_length(op) or 0 for op in xrange(256)],
+        dtype=np.uint8,
+    )
+    
+# Branch condition tables, as arrays that can be indexed by arrays of flags.
+TAKEN = dict(
+        (op, np.array(table, dtype=bool))
+        for op, table in BRANCH_TAKEN.iteritems()
+    )
+    
+# Register-only operations, as functions of NumPy arrays a and b of operands.
+# The results are masked to 8 bits afterwards.
+OPERATIONS = {
+    Op.INC  :   lambda a, b: a + 1,
+    Op.DEC  :   lambda a, b: a - 1,
+    Op.NEG  :   lambda a, b: -a,
+    Op.BCM  :   lambda a, b: ~a,
+    Op.USR  :   lambda a, b: (a >> 1) & 0x7F,
+    Op.SSR  :   lambda a, b: (a >> 1) | (a & 0x80),
+    Op.USL  :   lambda a, b: a << 1,
+    Op.ADD  :   lambda a, b: a + b,
+    Op.SUB  :   lambda a, b: a - b,
+    Op.AND  :   lambda a, b: a & b,
+    Op.OR   :   lambda a, b: a | b,
+    Op.CMP  :   lambda a, b: a - b,
+}
+
+ADD_LIKE = frozenset((Op.INC, Op.ADD))
+SUB_LIKE = frozenset((Op.DEC, Op.SUB, Op.CMP))
+
+
+class LockstepVM(object):
+    """ Runs N SIMPL machines in lockstep.
+    
+    The machines' state is kept in NumPy arrays: memory is (N, 256), registers 
+    are (N, 16), and the PC, packed flags, step counts, and halted flags are 
+    (N,). Each step fetches the instruction at every running machine's PC, 
+    groups the machines by opcode, and executes each group with vectorized 
+    operations. Machines can diverge freely, and since nothing is cached, 
+    self-modifying code needs no special handling.
+    
+    Halted machines are masked out of every step. A machine that reaches an 
+    invalid opcode is halted with its entry in `invalid` set, instead of 
+    raising an exception like the VM does.
+    
+    """
+    
+    def __init__(self, memories):
+        memory = np.array(memories, dtype=np.uint8)
+        
+        if memory.ndim != 2 or memory.shape[1] != MEMORY_SIZE:
+            raise ValueError(
+                    "Memories must have a shape of (N, {})!"
+                        .format(MEMORY_SIZE)
+                )
+                
+        n = memory.shape[0]
+        
+        self.memory = memory
+        self.registers = np.zeros((n, 16), dtype=np.uint8)
+        self.pc = np.zeros(n, dtype=np.uint8)
+        self.flags = np.zeros(n, dtype=np.uint8)
+        
+        self.steps = np.zeros(n, dtype=np.int64)
+        self.halted = np.zeros(n, dtype=bool)
+        self.invalid = np.zeros(n, dtype=bool)
+        
+    @classmethod
+    def from_image(cls, image, n):
+        """ Creates a VM with n copies of the same 256-byte memory image. The 
+        copies can then be given different inputs through the memory array.
+        
+        """
+        
+        image = np.frombuffer(bytes(bytearray(image)), dtype=np.uint8)
+        return cls(np.tile(image, (n, 1)))
+        
+    def __len__(self):
+        return self.memory.shape[0]
+        
+    def step(self):
+        """ Executes one instruction on every running machine. Returns the 
+        number of machines that are still running.
+        
+        """
+        
+        rows = np.flatnonzero(~self.halted)
+        
+        if not rows.size:
+            return 0
+            
+        memory = self.memory
+        registers = self.registers
+        
+        pc = self.pc[rows]
+        ops = memory[rows, pc]
+        operands = memory[rows, (pc + 1) & 0xFF]
+        consts = memory[rows, (pc + 2) & 0xFF]
+        
+        lengths = LENGTHS[ops]
+        nextPC = (pc + lengths) & 0xFF
+        
+        invalid = lengths == 0
+        
+        if invalid.any():
+            self.invalid[rows[invalid]] = True
+            self.halted[rows[invalid]] = True
+            
+        for op in np.unique(ops[~invalid]):
+            op = int(op)
+            group = ops == op
+            idx = rows[group]
+            
+            regA = operands[group] >> 4
+            regB = operands[group] & 0xF
+            
+            if op == Op.NOP:
+                pass
+                
+            elif op == Op.END:
+                nextPC[group] = pc[group]
+                self.halted[idx] = True
+                
+            elif op == Op.MOV:
+                registers[idx, regA] = registers[idx, regB]
+                
+            elif op == Op.LDC:
+                registers[idx, regA] = consts[group]
+                
+            elif op == Op.LDM:
+                registers[idx, regA] = memory[idx, registers[idx, regB]]
+                
+            elif op == Op.STM:
+                memory[idx, registers[idx, regB]] = registers[idx, regA]
+                
+            elif op in OPERATIONS:
+                a = registers[idx, regA].astype(np.int16)
+                b = registers[idx, regB].astype(np.int16)
+                result = OPERATIONS[op](a, b) & 0xFF
+                
+                if op != Op.CMP:
+                    registers[idx, regA] = result
+                    
+                self._set_flags(op, idx, a, result)
+                
+            elif op == Op.JMP:
+                nextPC[group] = operands[group]
+                
+            elif op in TAKEN:
+                taken = TAKEN[op][self.flags[idx]]
+                nextPC[group] = np.where(
+                        taken, operands[group], nextPC[group]
+                    )
+                    
+            else:
+                assert False
+                
+        valid = ~invalid
+        
+        self.pc[rows[valid]] = nextPC[valid]
+        self.steps[rows[valid]] += 1
+        
+        return int(np.count_nonzero(~self.halted))
+        
+    def _set_flags(self, op, idx, a, result):
+        """ Updates the flags of the given machines after a register-only 
+        operation, with the same rules as the VM.
+        
+        """
+        
+        flags = self.flags[idx]
+        
+        newFlags = np.where(result == 0, Flags.ZERO, 0)
+        newFlags |= np.where(result & 0x80, Flags.NEGATIVE, 0)
+        
+        carryOverflow = flags & (Flags.CARRY | Flags.OVERFLOW)
+        
+        if op in ADD_LIKE or op in SUB_LIKE:
+            signChanged = ((a ^ result) & 0x80) != 0
+            
+            if op in ADD_LIKE:
+                carry = result < a
+            else:
+                carry = result > a
+                
+            carryOverflow = np.where(
+                    signChanged,
+                    np.where(carry, Flags.CARRY, Flags.OVERFLOW),
+                    carryOverflow,
+                )
+                
+        self.flags[idx] = newFlags | carryOverflow
+        
+    def run(self, maxSteps=None):
+        """ Steps the machines until they have all halted, or until maxSteps 
+        steps have been taken. Returns the number of machines that are still 
+        running.
+        
+        """
+        
+        running = int(np.count_nonzero(~self.halted))
+        budget = step_budget(maxSteps)
+        steps = 0
+        
+        while running and steps < budget:
+            running = self.step()
+            steps += 1
+            
+        return running
+        
+    def result(self, i):
+        """ Gives the architectural state of machine i, in the same form as 
+        VM.result().
+        
+        """
+        
+        return Result(
+                bool(self.halted[i]), int(self.steps[i]), int(self.pc[i]),
+                [int(r) for r in self.registers[i]], int(self.flags[i]),
+                bytearray(self.memory[i].tostring()),
+            )
+            
\ No newline at end of file
@@ -0,0 +1,218 @@
+"""
+
+simplevm_profile.py
+By Ryan Lam
+
+An instruction-level profiler for the VM. The profiler is a trace sink, so a
+VM without one runs at full speed, and a VM with one runs on the same 
+per-instruction path as a traced VM.
+
+"""
+
+from constants import MEMORY_SIZE, Op, Instr, BRANCH_TAKEN
+import assembler
+from objfile import read_object
+
+
+# Maps opcodes to their mnemonics.
+MNEMONICS = dict((op, name) for name, op in Instr.ALL.iteritems())
+
+
+class Profiler(object):
+    """ Counts what a program does, in preallocated lists:
+    
+    - pcCounts: how many times the instruction at each address ran.
+    - opCounts: how many times each opcode ran.
+    - taken, notTaken: outcomes of the conditional jump at each address.
+    - loads, stores: how many times LDM and STM accessed each address.
+    
+    memory must be the memory the VM executes from (vm.memory), so that LDM
+    and STM operands are read as they are when they run. Since a jump's outcome 
+    is only known from the next instruction's address, the last jump before
+    the VM stops isn't counted until it's resumed.
+    
+    """
+    
+    def __init__(self, memory):
+        self.memory = memory
+        
+        self.pcCounts = [0] * MEMORY_SIZE
+        self.opCounts = [0] * 256
+        self.taken = [0] * MEMORY_SIZE
+        self.notTaken = [0] * MEMORY_SIZE
+        self.loads = [0] * MEMORY_SIZE
+        self.stores = [0] * MEMORY_SIZE
+        
+        # The address of the last conditional jump if its outcome isn't known
+        # yet, and the address it falls through to.
+        self._jump = None
+        self._fallThrough = None
+        
+    def record(self, pc, op, registers):
+        self.pcCounts[pc] += 1
+        self.opCounts[op] += 1
+        
+        if self._jump is not None:
+            if pc == self._fallThrough:
+                self.notTaken[self._jump] += 1
+            else:
+                self.taken[self._jump] += 1
+                
+            self._jump = None
+            
+        if op in BRANCH_TAKEN:
+            self._jump = pc
+            self._fallThrough = (pc + 2) & 0xFF
+        elif op == Op.LDM:
+            self.loads[registers[self.memory[(pc + 1) & 0xFF] & 0xF]] += 1
+        elif op == Op.STM:
+            self.stores[registers[self.memory[(pc + 1) & 0xFF] & 0xF]] += 1
+            
+    def flush(self):
+        pass
+        
+    def close(self):
+        pass
+        
+    def total(self):
+        """ Gives the number of instructions profiled. """
+        return sum(self.opCounts)
+        
+    def to_dict(self):
+        """ Gives the nonzero counts as a dict of JSON-friendly values, keyed 
+        by hex address or mnemonic.
+        
+        """
+        
+        def nonzero(counts, name):
+            return dict(
+                    (name(i), count)
+                    for i, count in enumerate(counts) if count
+                )
+                
+        return {
+            'pc'        :   nonzero(self.pcCounts, '0x{:02x}'.format),
+            'ops'       :   nonzero(self.opCounts, MNEMONICS.get),
+            'taken'     :   nonzero(self.taken, '0x{:02x}'.format),
+            'not_taken' :   nonzero(self.notTaken, '0x{:02x}'.format),
+            'loads'     :   nonzero(self.loads, '0x{:02x}'.format),
+            'stores'    :   nonzero(self.stores, '0x{:02x}'.format),
+        }
+        
+    def report(self, labels=None, top=16):
+        """ Gives a text report of the hottest instructions, the opcode mix, 
+        and the busiest memory addresses. Addresses are annotated with the 
+        nearest label at or before them, if labels (which maps addresses to 
+        names) is given.
+        
+        """
+        
+        total = self.total() or 1
+        lines = []
+        
+        def where(addr):
+            if not labels:
+                return '0x{:02x}'.format(addr)
+                
+            return '0x{:02x} {:<16}'.format(addr, label_for(addr, labels))
+            
+        lines.append("Hot spots:")
+        
+        hot = sorted(
+                (addr for addr in xrange(MEMORY_SIZE) if self.pcCounts[addr]),
+                key=lambda addr: -self.pcCounts[addr],
+            )
+            
+        for addr in hot[:top]:
+            count = self.pcCounts[addr]
+            line = "  {} {:<4} {:>10} {:6.2f}%".format(
+                    where(addr), MNEMONICS.get(self.memory[addr], '???'),
+                    count, 100.0 * count / total,
+                )
+                
+            if self.taken[addr] or self.notTaken[addr]:
+                line += "  taken {}, not taken {}".format(
+                        self.taken[addr], self.notTaken[addr]
+                    )
+                    
+            lines.append(line)
+            
+        lines.append("Opcodes:")
+        
+        ops = sorted(
+                (op for op in xrange(256) if self.opCounts[op]),
+                key=lambda op: -self.opCounts[op],
+            )
+            
+        for op in ops:
+            count = self.opCounts[op]
+            line = "  {:<4} {:>10} {:6.2f}%".format(
+                    MNEMONICS.get(op, '0x{:02x}'.format(op)), count,
+                    100.0 * count / total
+                )
+                
+            lines.append(line)
+            
+        busy = sorted(
+                (
+                    addr for addr in xrange(MEMORY_SIZE)
+                    if self.loads[addr] or self.stores[addr]
+                ),
+                key=lambda addr: -(self.loads[addr] + self.stores[addr]),
+            )
+            
+        if busy:
+            lines.append("Memory:")
+            
+        for addr in busy[:top]:
+            line = "  {} loads {:>10} stores {:>10}".format(
+                    where(addr), self.loads[addr], self.stores[addr]
+                )
+                
+            lines.append(line)
+            
+        return '\n'.join(lines)
+        
+        
+def read_labels(filePath):
+    """ Assembles a source file, or reads the symbol table of a *.obj file,
+    and gives a dict that maps addresses to the names of the labels there.
+    
+    """
+    
+    if filePath.endswith('.obj'):
+        return read_object(filePath).labels()
+        
+    with open(filePath, 'r') as f:
+        data = f.read()
+        
+    labels = {}
+    assembler.hex_from_tokens(assembler.tokenize(data), labels)
+    
+    # Where several labels share an address, the alphabetically first name
+    # is used.
+    return dict(
+            (addr, name)
+            for name, addr in sorted(labels.iteritems(), reverse=True)
+        )
+        
+        
+def label_for(addr, labels):
+    """ Gives the name of the nearest label at or before an address, with an 
+    offset if the address isn't the label's, like 'loop+4'.
+    
+    """
+    
+    start = addr
+    
+    while start >= 0 and start not in labels:
+        start -= 1
+        
+    if start < 0:
+        return ''
+        
+    if start == addr:
+        return labels[start]
+        
+    return '{}+{}'.format(labels[start], addr - start)
+    
\ No newline at end of file
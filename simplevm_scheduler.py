@@ -0,0 +1,225 @@
+"""
+
+simplevm_scheduler.py
+By Ryan Lam
+
+Interleaves many VMs in one process by giving each a turn of a fixed number
+of instructions at a time, so that thousands of small jobs all make progress 
+and none of them can run past its budget, without threads or OS timeouts.
+
+Turns are shared out by stride scheduling: every task has a virtual time
+that goes up by the instructions it runs divided by its priority, and the
+task with the lowest virtual time goes next. Tasks with the same priority
+take turns round-robin, and a task with twice the priority of another runs 
+about twice as many instructions.
+
+"""
+
+import sys
+import time
+import heapq
+import itertools
+
+from simplevm import InfiniteLoop
+
+
+# Instructions each task runs per turn by default.
+DEFAULT_SLICE_STEPS = 1000
+
+
+class Task(object):
+    """ A VM being run by a Scheduler, and how it's allowed to run.
+    
+    - budget is the most instructions the task may run, or None for no limit.
+    - deadline is the time by the scheduler's clock after which the task is 
+      stopped, or None for no limit. It's checked before each turn, so a task 
+      can run up to one turn past it.
+    - priority is the share of instructions the task gets, relative to the 
+      other tasks.
+    - callback is called with the task once it's done.
+    
+    Once a task is done, status is set to 'halted', 'budget', 'deadline', 
+    'loop', 'hit' (for a debugger stop), 'error', or 'cancelled', and error
+    is set to the exception that stopped it, if any.
+    
+    """
+    
+    def __init__(self, vm, budget=None, deadline=None, priority=1,
+            callback=None, name=None):
+        if priority <= 0:
+            raise ValueError("A task's priority must be positive!")
+            
+        if budget is not None and budget < 0:
+            raise ValueError("A task's budget can't be negative!")
+            
+        self.vm = vm
+        self.budget = budget
+        self.deadline = deadline
+        self.priority = priority
+        self.callback = callback
+        self.name = name
+        
+        # Instructions run and turns taken under this scheduler.
+        self.steps = 0
+        self.turns = 0
+        
+        self.status = None
+        self.error = None
+        
+        # Virtual time, for the scheduler's queue.
+        self._pass = 0.0
+        
+    @property
+    def done(self):
+        return self.status is not None
+        
+    def __repr__(self):
+        return "Task({!r}, status={!r}, steps={})".format(
+                self.name, self.status, self.steps
+            )
+            
+            
+class Scheduler(object):
+    """ Runs tasks in turns of up to sliceSteps instructions each. clock is
+    the function deadlines are measured with.
+    
+    """
+    
+    def __init__(self, sliceSteps=DEFAULT_SLICE_STEPS, clock=time.time):
+        if sliceSteps <= 0:
+            raise ValueError("A turn must be at least one instruction!")
+            
+        self.sliceSteps = sliceSteps
+        self.clock = clock
+        
+        # Heap of (virtual time, sequence number, task). The sequence number
+        # breaks ties in the order tasks were queued, which makes tasks with
+        # the same priority take turns round-robin.
+        self._queue = []
+        self._sequence = itertools.count()
+        
+        # The lowest virtual time of any waiting task, where new tasks start
+        # so they don't get to catch up on turns from before they arrived.
+        self._now = 0.0
+        
+        self.running = 0
+        
+    def add(self, vm, budget=None, deadline=None, priority=1, callback=None,
+            name=None):
+        """ Queues a VM to be run, and gives its Task. See Task for the 
+        arguments.
+        
+        """
+        
+        task = Task(vm, budget, deadline, priority, callback, name)
+        task._pass = self._now
+        
+        self._push(task)
+        self.running += 1
+        
+        return task
+        
+    def cancel(self, task):
+        """ Stops a task before its next turn. """
+        
+        if not task.done:
+            self._finish(task, 'cancelled')
+            
+    def run_slice(self):
+        """ Gives the next task its turn. Returns the task, or None if there 
+        are no tasks left.
+        
+        """
+        
+        queue = self._queue
+        
+        while queue:
+            task = heapq.heappop(queue)[2]
+            
+            # Cancelled tasks are left in the queue until they come up.
+            if not task.done:
+                break
+        else:
+            return None
+            
+        self._now = task._pass
+        
+        if task.deadline is not None and self.clock() >= task.deadline:
+            self._finish(task, 'deadline')
+            return task
+            
+        steps = self.sliceSteps
+        
+        if task.budget is not None:
+            steps = min(steps, task.budget - task.steps)
+            
+            if steps <= 0:
+                self._finish(task, 'budget')
+                return task
+                
+        vm = task.vm
+        before = vm.steps
+        
+        try:
+            vm.run(steps)
+            
+        except InfiniteLoop as e:
+            status = 'loop'
+            task.error = e
+            
+        except Exception as e:
+            status = 'error'
+            task.error = e
+            
+        else:
+            status = None
+            
+            if vm.halted:
+                status = 'halted'
+            elif vm.debugger is not None and vm.debugger.hit is not None:
+                status = 'hit'
+                
+        ran = vm.steps - before
+        task.steps += ran
+        task.turns += 1
+        
+        if status is None:
+            if task.budget is not None and task.steps >= task.budget:
+                status = 'budget'
+                
+        if status is not None:
+            self._finish(task, status)
+        else:
+            task._pass += float(max(ran, 1)) / task.priority
+            self._push(task)
+            
+        return task
+        
+    def run(self, maxSlices=None):
+        """ Runs turns until every task is done, or maxSlices turns have been 
+        taken. Returns the number of turns taken.
+        
+        """
+        
+        if maxSlices is None:
+            maxSlices = sys.maxint
+            
+        slices = 0
+        
+        while slices < maxSlices and self.run_slice() is not None:
+            slices += 1
+            
+        return slices
+        
+    def _push(self, task):
+        heapq.heappush(
+                self._queue, (task._pass, next(self._sequence), task)
+            )
+            
+    def _finish(self, task, status):
+        task.status = status
+        self.running -= 1
+        
+        if task.callback is not None:
+            task.callback(task)
+            
\ No newline at end of file
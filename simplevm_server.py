@@ -0,0 +1,436 @@
+"""
+
+simplevm_server.py
+By Ryan Lam
+
+Hosts many VM sessions in one process, for clients on a local TCP or Unix 
+socket, so a test farm can keep one warm interpreter instead of starting one 
+for every program.
+
+Clients send one JSON request per line and get one JSON response per line, in 
+the order the requests finish. Every request has an "op" and the name of a 
+"session", which belongs to the connection, and can have an "id" that is
+copied into its response. The ops are:
+
+- load: creates or replaces the session's VM, from the "path" of a *.hex, 
+  *.bin, or *.obj image or from "memory" as a hex string. "cycles", 
+  "detect_loops" (true by default), and "console" are as in simplevm and 
+  simplevm_batch.
+- run: runs "steps" instructions, which must be a non-negative integer, or 
+  until the machine halts if "steps" is left out, and gives the status and 
+  where the VM is.
+- read: gives "length" bytes of memory from "start" as a hex string.
+- state: gives the whole state, like simplevm -q.
+- close: drops the session. Requests to it that were sent before the close
+  was answered get errors, so wait for the answer before using its name
+  again.
+
+Sessions run in slices of at most a fixed number of instructions, taking
+turns with each other and with the network, so one runaway program can't hold 
+up the rest. Requests to the same session are handled in order.
+
+"""
+
+import os
+import sys
+import json
+import socket
+import asyncore
+import asynchat
+import argparse
+from collections import deque
+from cStringIO import StringIO
+
+from constants import MEMORY_SIZE
+from simplevm import VM, InfiniteLoop, load_memory
+from devices import console_map
+
+
+# Instructions each session runs before it lets the others have a turn.
+DEFAULT_SLICE_STEPS = 10000
+
+# Seconds to wait for the network when no session has anything to run.
+POLL_TIMEOUT = 1.0
+
+DEFAULT_PORT = 7878
+
+
+class RequestError(Exception):
+    """ A request can't be carried out. The message is sent to the client. """
+    pass
+    
+    
+class Session(object):
+    """ A VM and the requests that are waiting for it. """
+    
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+        
+        self.vm = None
+        self.console = None
+        self.requests = deque()
+        
+        # Instructions left to run for the run request in progress (None if
+        # it runs until the machine halts), and instructions run so far.
+        self.left = None
+        self.ran = 0
+        self.started = False
+        
+        self.closed = False
+        
+    def work(self, sliceSteps):
+        """ Works on the oldest waiting request for up to sliceSteps 
+        instructions. Gives its response once it's finished, or None.
+        
+        """
+        
+        request = self.requests[0]
+        op = request.get('op')
+        
+        try:
+            if op == 'run':
+                response = self._run(request, sliceSteps)
+            elif op == 'load':
+                response = self._load(request)
+            elif op == 'read':
+                response = self._read(request)
+            elif op == 'state':
+                response = self._state()
+            elif op == 'close':
+                response = self._close()
+            else:
+                raise RequestError("Unknown op: {}".format(op))
+                
+        except InfiniteLoop as e:
+            response = {
+                'status'    :   'loop',
+                'steps'     :   self.vm.steps,
+                'pc'        :   e.pc,
+                'period'    :   e.period,
+            }
+            
+        except (RequestError, IOError, ValueError, KeyError, TypeError) as e:
+            response = {'error' : str(e)}
+            
+        except Exception as e:
+            # Anything else was raised by the program, like an invalid
+            # instruction, and leaves the VM where it stopped.
+            response = {'status' : 'error', 'error' : str(e)}
+            
+        if response is None:
+            return None
+            
+        self.requests.popleft()
+        self.started = False
+        
+        return self._answer(request, response)
+        
+    def reject_waiting(self, message):
+        """ Gives an error response, with the given message, to every
+        request that is still waiting, and forgets them.
+        
+        """
+        
+        responses = [
+            self._answer(request, {'error' : message})
+            for request in self.requests
+        ]
+        
+        self.requests.clear()
+        self.started = False
+        
+        return responses
+        
+    def _answer(self, request, response):
+        """ Fills in the session and ID of the request that a response is
+        for.
+        
+        """
+        
+        response['session'] = self.name
+        
+        if 'id' in request:
+            response['id'] = request['id']
+            
+        return response
+        
+    def _require_vm(self):
+        if self.vm is None:
+            raise RequestError("No image loaded in this session!")
+            
+        return self.vm
+        
+    def _load(self, request):
+        if 'path' in request:
+            memory = load_memory(request['path'])
+        elif 'memory' in request:
+            memory = bytearray(request['memory'].decode('hex'))
+        else:
+            raise RequestError("Must provide a path or memory to load!")
+            
+        if request.get('console'):
+            self.console = StringIO()
+            devices = console_map(self.console)
+        else:
+            self.console = devices = None
+            
+        self.vm = VM(
+                memory,
+                countCycles=request.get('cycles', False),
+                detectLoops=request.get('detect_loops', True),
+                devices=devices,
+            )
+            
+        return {'status' : 'loaded'}
+        
+    def _run(self, request, sliceSteps):
+        vm = self._require_vm()
+        
+        if not self.started:
+            steps = request.get('steps')
+            
+            # bool is a subclass of int, but true isn't a number of steps.
+            if steps is not None and (
+                    isinstance(steps, bool) or
+                    not isinstance(steps, (int, long)) or
+                    steps < 0
+                ):
+                raise RequestError("Steps must be a non-negative integer!")
+                
+            self.left = steps
+            self.ran = 0
+            self.started = True
+            
+        if self.left is None:
+            steps = sliceSteps
+        else:
+            steps = min(sliceSteps, self.left)
+            
+        ran = vm.run(steps)
+        self.ran += ran
+        
+        if self.left is not None:
+            self.left -= ran
+            
+        if not vm.halted and self.left != 0:
+            return None
+            
+        response = {
+            'status'    :   'halted' if vm.halted else 'paused',
+            'ran'       :   self.ran,
+            'steps'     :   vm.steps,
+            'pc'        :   vm.pc,
+        }
+        
+        if vm.countCycles:
+            response['cycles'] = vm.cycles
+            
+        if self.console is not None:
+            vm.devices.flush()
+            response['output'] = self.console.getvalue()
+            self.console.seek(0)
+            self.console.truncate()
+            
+        return response
+        
+    def _read(self, request):
+        vm = self._require_vm()
+        
+        start = request.get('start', 0)
+        length = request.get('length', MEMORY_SIZE - start)
+        
+        if not 0 <= start <= start + length <= MEMORY_SIZE:
+            raise RequestError("Invalid memory range!")
+            
+        return {'memory' : str(vm.memory[start:start + length]).encode('hex')}
+        
+    def _state(self):
+        vm = self._require_vm()
+        
+        response = vm.result().to_dict()
+        
+        if vm.countCycles:
+            response['cycles'] = vm.cycles
+            response['cpi'] = vm.cpi()
+            
+        return response
+        
+    def _close(self):
+        self.closed = True
+        self.vm = None
+        self.connection.sessions.pop(self.name, None)
+        
+        return {'status' : 'closed'}
+        
+        
+class Connection(asynchat.async_chat):
+    """ A client, and the sessions it has opened. """
+    
+    def __init__(self, server, sock):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.set_terminator('\n')
+        
+        self.server = server
+        self.sessions = {}
+        self.buffer = []
+        
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+        
+    def found_terminator(self):
+        line = ''.join(self.buffer).strip()
+        self.buffer = []
+        
+        if not line:
+            return
+            
+        try:
+            request = json.loads(line)
+            
+            if not isinstance(request, dict):
+                raise ValueError("A request must be a JSON object!")
+                
+            name = request['session']
+            
+        except (ValueError, KeyError) as e:
+            self.respond({'error' : "Invalid request: {}".format(e)})
+            return
+            
+        session = self.sessions.get(name)
+        
+        if session is None:
+            session = self.sessions[name] = Session(self, name)
+            
+        session.requests.append(request)
+        self.server.schedule(session)
+        
+    def respond(self, response):
+        self.push(json.dumps(response, sort_keys=True) + '\n')
+        
+    def handle_close(self):
+        for session in self.sessions.itervalues():
+            session.closed = True
+            
+        self.sessions.clear()
+        self.close()
+        
+        
+class Server(asyncore.dispatcher):
+    """ Accepts connections, and shares the process between their sessions. 
+    Give address as a (host, port) tuple to listen on TCP, or as a path to 
+    listen on a Unix socket.
+    
+    """
+    
+    def __init__(self, address, sliceSteps=DEFAULT_SLICE_STEPS):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        
+        if isinstance(address, basestring):
+            self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+            
+        self.bind(address)
+        self.listen(64)
+        
+        self.sliceSteps = sliceSteps
+        
+        # Sessions with requests waiting, in the order they get their turns.
+        self.active = deque()
+        
+    def handle_accept(self):
+        pair = self.accept()
+        
+        if pair is not None:
+            Connection(self, pair[0])
+            
+    def schedule(self, session):
+        """ Gives a session a turn, if it isn't already waiting for one. """
+        
+        if len(session.requests) == 1:
+            self.active.append(session)
+            
+    def run_slice(self):
+        """ Gives the next session with work its turn. """
+        
+        session = self.active.popleft()
+        
+        # Sessions whose connection has gone away are dropped here.
+        if session.closed:
+            return
+            
+        response = session.work(self.sliceSteps)
+        connection = session.connection
+        
+        if response is not None and connection.connected:
+            connection.respond(response)
+            
+        if session.closed:
+            # Requests that were pipelined after a close are refused, rather
+            # than dropped without an answer.
+            for response in session.reject_waiting("The session was closed!"):
+                if connection.connected:
+                    connection.respond(response)
+                    
+        elif session.requests:
+            self.active.append(session)
+            
+    def serve_forever(self):
+        while self.map:
+            if self.active:
+                asyncore.loop(timeout=0, map=self.map, count=1)
+                self.run_slice()
+            else:
+                asyncore.loop(timeout=POLL_TIMEOUT, map=self.map, count=1)
+                
+                
+def main(argv):
+    parser = argparse.ArgumentParser(
+            prog=argv[0],
+            description="Serves SIMPL VM sessions over a local socket.",
+        )
+        
+    parser.add_argument(
+            '--port', type=int, default=DEFAULT_PORT,
+            help="TCP port to listen on, on localhost",
+        )
+    parser.add_argument(
+            '--unix', metavar='PATH', default=None,
+            help="listen on a Unix socket at this path instead",
+        )
+    parser.add_argument(
+            '--slice', type=int, default=DEFAULT_SLICE_STEPS,
+            help="instructions each session runs before yielding",
+        )
+        
+    args = parser.parse_args(argv[1:])
+    
+    if args.unix is not None:
+        if os.path.exists(args.unix):
+            os.unlink(args.unix)
+            
+        address = args.unix
+    else:
+        address = ('127.0.0.1', args.port)
+        
+    server = Server(address, args.slice)
+    
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        
+        if args.unix is not None and os.path.exists(args.unix):
+            os.unlink(args.unix)
+            
+    return 0
+    
+    
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
+    
\ No newline at end of file
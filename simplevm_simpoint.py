@@ -0,0 +1,488 @@
+"""
+
+simplevm_simpoint.py
+By Ryan Lam
+
+Sampled simulation in the style of SimPoint: the VM runs the whole program, 
+recording a basic block vector for each fixed-length interval of it, and the 
+intervals are clustered so that only one representative of each cluster has
+to be simulated on the datapath. The representatives' cycles per instruction 
+and controller state occupancy, weighted by the share of the program their 
+clusters cover, are extrapolated to the whole run.
+
+A basic block vector counts the instructions that each basic block executed 
+during an interval, normalized to sum to 1, so that intervals that spend
+their time in the same code have nearby vectors. Clustering is k-means with 
+k-means++ seeding, for every k up to a limit, and the smallest k whose
+Bayesian Information Criterion score is within 90% of the best is used.
+
+"""
+
+import sys
+import json
+import math
+import random
+import argparse
+
+from constants import State
+from simplevm import (
+    VM, InvalidFile, InvalidInstruction, load_memory, error, step_budget,
+)
+from simplevm_blocks import TERMINATORS, instruction_length
+import simplesim
+
+
+DEFAULT_INTERVAL = 10000
+DEFAULT_MAX_K = 10
+
+# The most passes k-means makes before settling for what it has.
+MAX_ITERATIONS = 100
+
+# The fraction of the range of BIC scores that a clustering has to reach to
+# be chosen over one with more clusters.
+BIC_THRESHOLD = 0.9
+
+# Maps controller states to their names, for reports.
+STATE_NAMES = dict(
+        (value, name)
+        for name, value in vars(State).iteritems()
+        if name.isupper()
+    )
+    
+    
+class BlockVectorSink(object):
+    """ A trace sink that counts the instructions executed in each basic
+    block, by the address the block starts at. A block starts wherever 
+    execution doesn't fall through from the previous instruction, and after 
+    every jump, taken or not.
+    
+    """
+    
+    def __init__(self):
+        self.counts = {}
+        self.block = None
+        self.nextPC = None
+        
+    def record(self, pc, op, registers):
+        if pc != self.nextPC:
+            self.block = pc
+            
+        counts = self.counts
+        counts[self.block] = counts.get(self.block, 0) + 1
+        
+        if op in TERMINATORS:
+            self.nextPC = None
+        else:
+            self.nextPC = (pc + (instruction_length(op) or 1)) & 0xFF
+            
+    def flush(self):
+        pass
+        
+    def close(self):
+        pass
+        
+        
+class Interval(object):
+    """ A stretch of a program's run: its index, a VM snapshot from its start, 
+    the number of instructions it ran, and its basic block counts.
+    
+    """
+    
+    def __init__(self, index, snapshot, steps, counts):
+        self.index = index
+        self.snapshot = snapshot
+        self.steps = steps
+        self.counts = counts
+        
+    def vector(self):
+        """ Gives the basic block vector, as a dict normalized to sum to 1. """
+        
+        total = float(sum(self.counts.itervalues()))
+        return dict((block, n / total) for block, n in self.counts.iteritems())
+        
+        
+class SimPoint(object):
+    """ An interval chosen to stand for a cluster, and the fraction of the 
+    program's instructions that the cluster covers.
+    
+    """
+    
+    def __init__(self, interval, weight, cluster):
+        self.interval = interval
+        self.weight = weight
+        self.cluster = cluster
+        
+        
+def collect_intervals(vm, size=DEFAULT_INTERVAL, maxSteps=None):
+    """ Runs the VM until it halts or has run maxSteps instructions, and
+    gives a list of Intervals of size instructions each. The last one can be 
+    shorter. The VM runs one instruction at a time while it's recording.
+    
+    """
+    
+    if size <= 0:
+        raise ValueError("An interval must be at least one instruction!")
+        
+    previous = vm.trace
+    sink = BlockVectorSink()
+    
+    vm.set_trace(sink)
+    intervals = []
+    budget = step_budget(maxSteps)
+    steps = 0
+    
+    try:
+        while not vm.halted and steps < budget:
+            chunk = min(size, budget - steps)
+            
+            snapshot = vm.snapshot()
+            sink.counts = {}
+            
+            ran = vm.run(chunk)
+            
+            if not ran:
+                break
+                
+            intervals.append(
+                    Interval(len(intervals), snapshot, ran, sink.counts)
+                )
+            steps += ran
+            
+    finally:
+        vm.set_trace(previous)
+        
+    return intervals
+    
+    
+def distance(vector, centroid):
+    """ Gives the squared Euclidean distance between two sparse vectors. """
+    
+    total = 0.0
+    
+    for key, value in vector.iteritems():
+        difference = value - centroid.get(key, 0.0)
+        total += difference * difference
+        
+    for key, value in centroid.iteritems():
+        if key not in vector:
+            total += value * value
+            
+    return total
+    
+    
+def mean(vectors):
+    """ Gives the mean of a list of sparse vectors. """
+    
+    total = {}
+    
+    for vector in vectors:
+        for key, value in vector.iteritems():
+            total[key] = total.get(key, 0.0) + value
+            
+    n = float(len(vectors))
+    return dict((key, value / n) for key, value in total.iteritems())
+    
+    
+def kmeans(vectors, k, rng):
+    """ Clusters sparse vectors into at most k clusters. Gives a list of the 
+    cluster that each vector is in, and a list of the clusters' centroids.
+    
+    """
+    
+    # k-means++: each new centroid is a vector chosen with probability
+    # proportional to its squared distance from the nearest centroid so far.
+    centroids = [dict(rng.choice(vectors))]
+    nearest = [distance(vector, centroids[0]) for vector in vectors]
+    
+    while len(centroids) < k:
+        total = sum(nearest)
+        
+        if not total:
+            break
+            
+        target = rng.random() * total
+        
+        for i, d in enumerate(nearest):
+            target -= d
+            
+            if target < 0:
+                break
+                
+        centroids.append(dict(vectors[i]))
+        nearest = [
+            min(d, distance(vector, centroids[-1]))
+            for d, vector in zip(nearest, vectors)
+        ]
+        
+    assignments = None
+    
+    for _ in xrange(MAX_ITERATIONS):
+        new = [
+            min(
+                xrange(len(centroids)),
+                key=lambda c: distance(vector, centroids[c])
+            )
+            for vector in vectors
+        ]
+        
+        if new == assignments:
+            break
+            
+        assignments = new
+        
+        # Clusters that lose all their vectors are dropped.
+        members = [[] for _ in centroids]
+        
+        for vector, cluster in zip(vectors, assignments):
+            members[cluster].append(vector)
+            
+        used = [c for c in xrange(len(centroids)) if members[c]]
+        
+        if len(used) < len(centroids):
+            renumber = dict((old, new) for new, old in enumerate(used))
+            assignments = [renumber[c] for c in assignments]
+            
+        centroids = [mean(members[c]) for c in used]
+        
+    return assignments, centroids
+    
+    
+def bic(vectors, assignments, centroids):
+    """ Scores a clustering with the Bayesian Information Criterion, treating 
+    the clusters as spherical Gaussians with a shared variance, as X-means
+    and SimPoint do. Higher is better.
+    
+    """
+    
+    r = len(vectors)
+    k = len(centroids)
+    d = len(set(key for vector in vectors for key in vector))
+    
+    distortion = sum(
+            distance(vector, centroids[cluster])
+            for vector, cluster in zip(vectors, assignments)
+        )
+        
+    if r <= k or not distortion:
+        variance = 1e-12
+    else:
+        variance = distortion / (d * (r - k))
+        
+    sizes = [assignments.count(c) for c in xrange(k)]
+    
+    likelihood = sum(
+            n * math.log(n) - n * math.log(r) -
+            n * d / 2.0 * math.log(2 * math.pi * variance) -
+            (n - 1) * d / 2.0
+            for n in sizes
+        )
+        
+    parameters = k * (d + 1)
+    return likelihood - parameters / 2.0 * math.log(r)
+    
+    
+def choose_simpoints(intervals, maxK=DEFAULT_MAX_K, seed=0):
+    """ Clusters intervals by their basic block vectors, and gives a SimPoint 
+    for the interval nearest the centroid of each cluster.
+    
+    """
+    
+    if not intervals:
+        return []
+        
+    rng = random.Random(seed)
+    vectors = [interval.vector() for interval in intervals]
+    
+    distinct = len(set(tuple(sorted(v.iteritems())) for v in vectors))
+    results = []
+    
+    for k in xrange(1, min(maxK, distinct) + 1):
+        assignments, centroids = kmeans(vectors, k, rng)
+        results.append(
+                (bic(vectors, assignments, centroids), assignments, centroids)
+            )
+            
+    scores = [score for score, _, _ in results]
+    low = min(scores)
+    cutoff = low + BIC_THRESHOLD * (max(scores) - low)
+    
+    score, assignments, centroids = next(
+            result for result in results if result[0] >= cutoff
+        )
+        
+    total = float(sum(interval.steps for interval in intervals))
+    simpoints = []
+    
+    for cluster, centroid in enumerate(centroids):
+        members = [
+            i for i, c in enumerate(assignments) if c == cluster
+        ]
+        
+        best = min(members, key=lambda i: distance(vectors[i], centroid))
+        weight = sum(intervals[i].steps for i in members) / total
+        
+        simpoints.append(SimPoint(intervals[best], weight, cluster))
+        
+    return simpoints
+    
+    
+class Estimate(object):
+    """ Whole-program figures extrapolated from simulated simpoints: the CPI, 
+    the total cycles, and the fraction of cycles spent in each controller 
+    state.
+    
+    """
+    
+    def __init__(self, instructions, cpi, occupancy):
+        self.instructions = instructions
+        self.cpi = cpi
+        self.cycles = cpi * instructions
+        self.occupancy = occupancy
+        
+    def to_dict(self):
+        return {
+            'instructions'  :   self.instructions,
+            'cpi'           :   self.cpi,
+            'cycles'        :   self.cycles,
+            'occupancy'     :   dict(
+                    (STATE_NAMES.get(state, hex(state)), fraction)
+                    for state, fraction in self.occupancy.iteritems()
+                ),
+        }
+        
+        
+def simulate_simpoints(simpoints, intervals):
+    """ Simulates each simpoint's interval on the datapath, starting from its 
+    snapshot, and gives the Estimate for the whole run of the given
+    intervals. Builds a quiet datapath, so this should only be called once
+    per process (see simplesim.build_datapath()).
+    
+    """
+    
+    vm = VM.from_snapshot(simpoints[0].interval.snapshot)
+    datapath = simplesim.build_datapath(str(vm.memory), quiet=True)
+    
+    cpi = 0.0
+    occupancy = {}
+    
+    for simpoint in simpoints:
+        interval = simpoint.interval
+        
+        vm.restore(interval.snapshot)
+        datapath.load_state(vm.get_state())
+        
+        states = {}
+        cycles, instructions = simplesim.simulate_instructions(
+                datapath, interval.steps, states
+            )
+            
+        simpoint.cycles = cycles
+        cpi += simpoint.weight * cycles / float(instructions)
+        
+        for state, n in states.iteritems():
+            occupancy[state] = (
+                occupancy.get(state, 0.0) + simpoint.weight * n / float(cycles)
+            )
+            
+    instructions = sum(interval.steps for interval in intervals)
+    return Estimate(instructions, cpi, occupancy)
+    
+    
+def main(argv):
+    parser = argparse.ArgumentParser(
+            prog=argv[0],
+            description=(
+                "Estimates a SIMPL program's CPI by simulating only "
+                "representative intervals of it on the datapath."
+            ),
+        )
+        
+    parser.add_argument('file', help="the *.hex, *.bin, or *.obj file to run")
+    parser.add_argument(
+            '--interval', type=int, default=DEFAULT_INTERVAL,
+            help="instructions per interval",
+        )
+    parser.add_argument(
+            '--max-k', type=int, default=DEFAULT_MAX_K,
+            help="the most clusters, and so intervals, to simulate",
+        )
+    parser.add_argument(
+            '--max-steps', type=int, default=None,
+            help="stop after this many instructions",
+        )
+    parser.add_argument(
+            '--seed', type=int, default=0,
+            help="seed for choosing the initial clusters",
+        )
+    parser.add_argument(
+            '-q', '--quiet', action='store_true',
+            help="print the results as JSON",
+        )
+        
+    args = parser.parse_args(argv[1:])
+    
+    try:
+        memory = load_memory(args.file)
+    except InvalidFile as e:
+        return error(str(e))
+        
+    vm = VM(memory, countCycles=True)
+    
+    try:
+        intervals = collect_intervals(vm, args.interval, args.max_steps)
+    except InvalidInstruction as e:
+        return error(str(e))
+        
+    if not intervals:
+        return error("The program didn't run any instructions!")
+        
+    simpoints = choose_simpoints(intervals, args.max_k, args.seed)
+    estimate = simulate_simpoints(simpoints, intervals)
+    
+    if args.quiet:
+        result = estimate.to_dict()
+        result['vm_cycles'] = vm.cycles
+        result['simpoints'] = [
+            {
+                'interval'  :   simpoint.interval.index,
+                'weight'    :   simpoint.weight,
+                'cycles'    :   simpoint.cycles,
+            }
+            for simpoint in simpoints
+        ]
+        
+        print json.dumps(result, sort_keys=True)
+        return 0
+        
+    print "{} intervals of up to {} instructions, {} simulated:".format(
+            len(intervals), args.interval, len(simpoints)
+        )
+        
+    for simpoint in simpoints:
+        print "  Interval {:>5}  weight {:.3f}  {} cycles".format(
+                simpoint.interval.index, simpoint.weight, simpoint.cycles
+            )
+            
+    print ""
+    print "Estimated CPI: {:.3f}".format(estimate.cpi)
+    print "Estimated cycles: {:.0f} (VM count: {})".format(
+            estimate.cycles, vm.cycles
+        )
+    print ""
+    print "Controller state occupancy:"
+    
+    occupancy = sorted(
+            estimate.occupancy.iteritems(), key=lambda item: -item[1]
+        )
+        
+    for state, fraction in occupancy:
+        print "  {:<12} {:6.2%}".format(
+                STATE_NAMES.get(state, hex(state)), fraction
+            )
+            
+    return 0
+    
+    
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
+    
\ No newline at end of file
@@ -0,0 +1,91 @@
+"""
+
+simplevm_state.py
+By Ryan Lam
+
+The architectural state of a SIMPL machine as a single value, for the VM and 
+the tools built around it (tracers, snapshots, loop detection, batch runs).
+
+"""
+
+import hashlib
+
+
+class MachineState(object):
+    """ The PC, packed flags, 16 registers, and memory of a SIMPL machine.
+    
+    Registers and memory are bytearrays, so storing a value that doesn't fit
+    in a byte raises an error instead of corrupting the state, and copying or 
+    comparing them is a single memcpy or memcmp. view is a memoryview of 
+    memory, for reading parts of it without copying.
+    
+    States compare equal when all four parts are equal. They can be hashed,
+    but like any mutable object they shouldn't be changed while they're in a 
+    set or used as a dict key. key() gives an immutable copy for that.
+    
+    """
+    
+    __slots__ = ('pc', 'flags', 'registers', 'memory', 'view')
+    
+    def __init__(self, memory, registers=None, pc=0, flags=0):
+        if registers is None:
+            registers = bytearray(16)
+            
+        if len(registers) != 16:
+            raise ValueError("A machine state must have 16 registers!")
+            
+        self.pc = pc
+        self.flags = flags
+        self.registers = bytearray(registers)
+        self.memory = bytearray(memory)
+        self.view = memoryview(self.memory)
+        
+    def copy(self):
+        return MachineState(self.memory, self.registers, self.pc, self.flags)
+        
+    def key(self):
+        """ Gives the state as a string of bytes: the PC, the flags, the 
+        registers, and then memory.
+        
+        """
+        
+        return (
+            chr(self.pc) + chr(self.flags) +
+            str(self.registers) + str(self.memory)
+        )
+        
+    def digest(self):
+        """ Gives a hex digest of the state, which is the same as the digest
+        of the equivalent VM Result.
+        
+        """
+        
+        return hashlib.sha1(self.key()).hexdigest()
+        
+    def __eq__(self, other):
+        if not isinstance(other, MachineState):
+            return NotImplemented
+            
+        return (
+            self.pc == other.pc and self.flags == other.flags and
+            self.registers == other.registers and self.memory == other.memory
+        )
+        
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        
+        if equal is NotImplemented:
+            return equal
+            
+        return not equal
+        
+    def __hash__(self):
+        return hash(self.key())
+        
+    def __getstate__(self):
+        return self.pc, self.flags, str(self.registers), str(self.memory)
+        
+    def __setstate__(self, state):
+        pc, flags, registers, memory = state
+        self.__init__(memory, registers, pc, flags)
+        
\ No newline at end of file
@@ -0,0 +1,167 @@
+"""
+
+simplevm_trace.py
+By Ryan Lam
+
+Trace sinks for the VM. A sink is given to the VM when it's constructed, and 
+receives a record of the PC, opcode, and registers before each instruction is 
+executed.
+
+"""
+
+import struct
+from collections import deque
+
+
+class NullSink(object):
+    """ Throws every record away. A VM given one of these runs exactly as fast 
+    as a VM with no sink at all.
+    
+    """
+    
+    def record(self, pc, op, registers):
+        pass
+        
+    def flush(self):
+        pass
+        
+    def close(self):
+        pass
+        
+        
+class RingSink(object):
+    """ Keeps the most recent records as (pc, op, registers) tuples. """
+    
+    def __init__(self, size=1024):
+        self.records = deque(maxlen=size)
+        
+    def record(self, pc, op, registers):
+        self.records.append((pc, op, tuple(registers)))
+        
+    def flush(self):
+        pass
+        
+    def close(self):
+        pass
+        
+        
+class TeeSink(object):
+    """ Passes every record on to each of several sinks. """
+    
+    def __init__(self, *sinks):
+        self.sinks = sinks
+        
+    def record(self, pc, op, registers):
+        for sink in self.sinks:
+            sink.record(pc, op, registers)
+            
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+            
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+            
+            
+class FileSink(object):
+    """ Writes records to a file as lines of text, in batches of bufferLines 
+    lines.
+    
+    The file can be given as a path or as an open file object. Files opened by 
+    the sink are closed by close(), and files given to it are only flushed.
+    
+    """
+    
+    FORMAT = "PC: {}\tInstruction: {}\tRegisters: {}\n"
+    
+    def __init__(self, file, bufferLines=4096):
+        if isinstance(file, basestring):
+            self.file = open(file, 'w')
+            self.ownsFile = True
+        else:
+            self.file = file
+            self.ownsFile = False
+            
+        self.bufferLines = bufferLines
+        self.buffer = []
+        
+    def record(self, pc, op, registers):
+        self.buffer.append(self.FORMAT.format(pc, hex(op), list(registers)))
+        
+        if len(self.buffer) >= self.bufferLines:
+            self.flush()
+            
+    def flush(self):
+        if self.buffer:
+            self.file.write(''.join(self.buffer))
+            self.buffer = []
+            
+        self.file.flush()
+        
+    def close(self):
+        self.flush()
+        
+        if self.ownsFile:
+            self.file.close()
+            
+            
+class BinarySink(object):
+    """ Writes records to a file in a compact binary format, in batches of 
+    about bufferSize bytes.
+    
+    Each record is RECORD.size bytes long: the PC, the opcode, and then the 16 
+    registers, one byte each. Use read_binary_trace() to read them back.
+    
+    """
+    
+    RECORD = struct.Struct('18B')
+    
+    def __init__(self, file, bufferSize=65536):
+        if isinstance(file, basestring):
+            self.file = open(file, 'wb')
+            self.ownsFile = True
+        else:
+            self.file = file
+            self.ownsFile = False
+            
+        self.bufferSize = bufferSize
+        self.buffer = bytearray()
+        
+    def record(self, pc, op, registers):
+        self.buffer += self.RECORD.pack(pc, op, *registers)
+        
+        if len(self.buffer) >= self.bufferSize:
+            self.flush()
+            
+    def flush(self):
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+            
+        self.file.flush()
+        
+    def close(self):
+        self.flush()
+        
+        if self.ownsFile:
+            self.file.close()
+            
+            
+def read_binary_trace(file):
+    """ Reads a trace written by a BinarySink, and yields its records as
+    (pc, op, registers) tuples.
+    
+    """
+    
+    size = BinarySink.RECORD.size
+    
+    while 1:
+        data = file.read(size)
+        
+        if len(data) < size:
+            break
+            
+        values = BinarySink.RECORD.unpack(data)
+        yield values[0], values[1], values[2:]
+        
\ No newline at end of file
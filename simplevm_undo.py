@@ -0,0 +1,113 @@
+"""
+
+simplevm_undo.py
+By Ryan Lam
+
+A bounded undo log for stepping the VM backwards.
+
+The log is a trace sink, so it sees every instruction just before it runs, 
+while the state it's about to overwrite is still there. Each instruction 
+overwrites at most one register or one byte of memory, so each record is just 
+the old PC, the old value of that register or byte, and the old flags if the 
+instruction sets them: five bytes, in preallocated arrays that are reused as
+a ring buffer.
+
+"""
+
+from array import array
+
+from constants import Op
+from simplevm_blocks import RESULTS, instruction_length
+from simplevm_debug import WRITES_REGISTER
+
+
+# Targets are stored as the address of a byte of memory, or REGISTERS plus
+# the number of a register. NOTHING means the instruction overwrites neither.
+REGISTERS = 0x100
+NOTHING = 0xFFFF
+
+# Stored in place of the flags for instructions that don't set them.
+NO_FLAGS = 0xFF
+
+
+class UndoLog(object):
+    """ Keeps undo records for the last size instructions a VM has run.
+    
+    vm is the VM being logged, for its memory and flags. When the log is
+    full, each new record overwrites the oldest one, so memory use never
+    grows past about 5 * size bytes.
+    
+    """
+    
+    def __init__(self, vm, size=65536):
+        if size <= 0:
+            raise ValueError("An undo log must have room for a record!")
+            
+        self.vm = vm
+        self.size = size
+        
+        self.pcs = bytearray(size)
+        self.targets = array('H', [NOTHING]) * size
+        self.values = bytearray(size)
+        self.flags = bytearray(size)
+        
+        # The slot the next record goes in, and the number of records kept.
+        self.next = 0
+        self.count = 0
+        
+    def record(self, pc, op, registers):
+        # An invalid instruction won't run, so there's nothing to undo.
+        if instruction_length(op) is None:
+            return
+            
+        vm = self.vm
+        memory = vm.memory
+        i = self.next
+        
+        self.pcs[i] = pc
+        
+        if op in WRITES_REGISTER:
+            reg = memory[(pc + 1) & 0xFF] >> 4
+            self.targets[i] = REGISTERS + reg
+            self.values[i] = registers[reg]
+        elif op == Op.STM:
+            addr = registers[memory[(pc + 1) & 0xFF] & 0xF]
+            self.targets[i] = addr
+            self.values[i] = memory[addr]
+        else:
+            self.targets[i] = NOTHING
+            
+        if op in RESULTS:
+            self.flags[i] = vm.get_flags()
+        else:
+            self.flags[i] = NO_FLAGS
+            
+        self.next = (i + 1) % self.size
+        
+        if self.count < self.size:
+            self.count += 1
+            
+    def pop(self):
+        """ Removes the newest record and gives it as a tuple of (pc, target, 
+        value, flags), or gives None if the log is empty.
+        
+        """
+        
+        if not self.count:
+            return None
+            
+        i = self.next = (self.next - 1) % self.size
+        self.count -= 1
+        
+        return self.pcs[i], self.targets[i], self.values[i], self.flags[i]
+        
+    def clear(self):
+        self.next = 0
+        self.count = 0
+        
+    def flush(self):
+        pass
+        
+    def close(self):
+        pass
+        
\ No newline at end of file